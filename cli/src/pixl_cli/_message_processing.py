@@ -15,6 +15,7 @@
 
 from __future__ import annotations
 
+import asyncio
 from time import sleep
 from typing import TYPE_CHECKING
 
@@ -22,7 +23,7 @@ import pandas as pd
 import tqdm
 from core.patient_queue._base import PixlBlockingInterface
 from core.patient_queue.message import Message
-from core.patient_queue.producer import PixlProducer
+from core.patient_queue.producer import PixlBulkProducer
 from decouple import config
 from loguru import logger
 
@@ -31,6 +32,7 @@ from pixl_cli._database import exported_images_for_project, filter_exported_or_a
 
 if TYPE_CHECKING:
     import pandas as pd
+    from core.patient_queue.producer import PublishStats
 
 
 def messages_from_df(
@@ -149,8 +151,21 @@ def populate_queue_and_db(
             messages_df = filter_exported_or_add_to_db(messages_df)
 
         messages = messages_from_df(messages_df)
-        with PixlProducer(queue_name=queue, **SERVICE_SETTINGS["rabbitmq"]) as producer:
-            producer.publish(messages, priority=messages_priority)
+        stats = asyncio.run(_publish(queue, messages, messages_priority))
+        if stats.failed:
+            logger.warning(
+                "{} of {} messages were not confirmed by {}, they will be published again if "
+                "the extract is retried",
+                stats.failed,
+                len(messages),
+                queue,
+            )
         output_messages.extend(messages)
 
     return output_messages
+
+
+async def _publish(queue: str, messages: list[Message], priority: int) -> PublishStats:
+    """Publish messages to a queue with publisher confirms, see `PixlBulkProducer`."""
+    async with PixlBulkProducer(queue_name=queue, **SERVICE_SETTINGS["rabbitmq"]) as producer:
+        return await producer.publish(messages, priority=priority)
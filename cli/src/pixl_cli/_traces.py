@@ -0,0 +1,129 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Summaries of the study traces written by the imaging API."""
+
+from __future__ import annotations
+
+import datetime
+import json
+import math
+from collections import Counter, defaultdict
+from typing import TYPE_CHECKING, Any
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
+    from pathlib import Path
+
+PERCENTILES = (50, 90, 99)
+
+
+def read_traces(paths: Iterable[Path]) -> list[dict[str, Any]]:
+    """Read traces from JSONL files, skipping any lines which aren't valid JSON."""
+    traces = []
+    for path in paths:
+        with path.open() as trace_file:
+            for line_number, line in enumerate(trace_file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    traces.append(json.loads(line))
+                except json.JSONDecodeError:
+                    logger.warning("Skipping invalid trace on line {} of {}", line_number, path)
+    return traces
+
+
+def stage_seconds(trace: dict[str, Any]) -> dict[str, float]:
+    """Total time spent in each stage of a trace, as a stage can be recorded more than once."""
+    totals: dict[str, float] = defaultdict(float)
+    for span in trace["spans"]:
+        totals[span["name"]] += span["seconds"]
+    totals["total"] = trace["seconds"]
+    return totals
+
+
+def percentile(sorted_values: list[float], percent: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def stage_percentiles(traces: Iterable[dict[str, Any]]) -> dict[str, dict[str, float]]:
+    """Count, percentiles and maximum of the seconds spent in each stage."""
+    values: dict[str, list[float]] = defaultdict(list)
+    for trace in traces:
+        for stage, seconds in stage_seconds(trace).items():
+            values[stage].append(seconds)
+
+    summary = {}
+    for stage, stage_values in values.items():
+        stage_values.sort()
+        summary[stage] = {
+            "count": len(stage_values),
+            **{f"p{p}": percentile(stage_values, p) for p in PERCENTILES},
+            "max": stage_values[-1],
+        }
+    return summary
+
+
+def throughput(
+    traces: Iterable[dict[str, Any]], interval: datetime.timedelta
+) -> dict[datetime.datetime, Counter[str]]:
+    """Number of messages finished in each interval, by outcome."""
+    counts: dict[datetime.datetime, Counter[str]] = defaultdict(Counter)
+    for trace in traces:
+        finished = datetime.datetime.fromisoformat(trace["started"]) + datetime.timedelta(
+            seconds=trace["seconds"]
+        )
+        bucket = datetime.datetime.fromtimestamp(
+            finished.timestamp() // interval.total_seconds() * interval.total_seconds(),
+            tz=finished.tzinfo,
+        )
+        counts[bucket][trace["outcome"]] += 1
+    return dict(sorted(counts.items()))
+
+
+def slowest(traces: Iterable[dict[str, Any]], number: int) -> list[dict[str, Any]]:
+    """The traces which took longest."""
+    return sorted(traces, key=lambda trace: trace["seconds"], reverse=True)[:number]
+
+
+def format_summary(
+    traces: list[dict[str, Any]], interval: datetime.timedelta, number_slowest: int
+) -> str:
+    """Report of stage percentiles, throughput over time and the slowest studies."""
+    lines = [f"{len(traces)} traced messages", "", "Seconds per stage:"]
+    header = f"  {'stage':<14}{'count':>8}" + "".join(f"{f'p{p}':>10}" for p in PERCENTILES)
+    lines.append(header + f"{'max':>10}")
+    for stage, summary in sorted(stage_percentiles(traces).items()):
+        row = f"  {stage:<14}{summary['count']:>8}"
+        row += "".join(f"{summary[f'p{p}']:>10.2f}" for p in PERCENTILES)
+        lines.append(row + f"{summary['max']:>10.2f}")
+
+    lines += ["", f"Messages finished per {interval}:"]
+    for start, outcomes in throughput(traces, interval).items():
+        details = ", ".join(f"{outcome} {count}" for outcome, count in outcomes.most_common())
+        lines.append(f"  {start.isoformat()}  {sum(outcomes.values()):>6}  ({details})")
+
+    lines += ["", f"Slowest {number_slowest} messages:"]
+    for trace in slowest(traces, number_slowest):
+        stages = stage_seconds(trace)
+        stages.pop("total")
+        worst_stage = max(stages, key=stages.__getitem__, default="-")
+        lines.append(
+            f"  {trace['seconds']:>10.2f}s  {trace['outcome']:<20} "
+            f"slowest stage {worst_stage}  {trace['identifier']}"
+        )
+    return "\n".join(lines)
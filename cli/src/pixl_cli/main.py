@@ -15,6 +15,7 @@
 
 from __future__ import annotations
 
+import datetime
 import json
 import os
 import sys
@@ -41,6 +42,7 @@ from pixl_cli._message_processing import (
     populate_queue_and_db,
     retry_until_export_count_is_unchanged,
 )
+from pixl_cli._traces import format_summary, read_traces
 
 # localhost needs to be added to the NO_PROXY environment variables on GAEs
 os.environ["NO_PROXY"] = os.environ["no_proxy"] = "localhost"
@@ -333,6 +335,36 @@ def status(queues: str) -> None:
         logger.info(f"[{queue:^10s}] refresh rate = ", _get_extract_rate(queue))
 
 
+@cli.command()
+@click.argument(
+    "trace_files", nargs=-1, required=True, type=click.Path(exists=True, path_type=Path)
+)
+@click.option(
+    "--interval",
+    default=60,
+    show_default=True,
+    help="Minutes in each interval when counting messages finished over time",
+)
+@click.option(
+    "--slowest",
+    default=10,
+    show_default=True,
+    help="Number of the slowest messages to list",
+)
+def traces(trace_files: tuple[Path, ...], interval: int, slowest: int) -> None:
+    """
+    Summarise study traces written by the imaging API (see PIXL_TRACE_FILE).
+
+    Prints percentiles of the time spent in each stage, messages finished over time and the
+    slowest messages. Rotated trace files can be passed together.
+    """
+    all_traces = read_traces(trace_files)
+    if not all_traces:
+        logger.warning("No traces found in {}", ", ".join(map(str, trace_files)))
+        return
+    click.echo(format_summary(all_traces, datetime.timedelta(minutes=interval), slowest))
+
+
 def _get_extract_rate(queue_name: str) -> str:
     """
     Get the extraction rate in items per second from a queue
@@ -25,7 +25,7 @@ import pandas as pd
 import pytest
 from core.db.models import Base, Extract, Image
 from core.patient_queue.message import Message
-from core.patient_queue.producer import PixlProducer
+from core.patient_queue.producer import PixlBulkProducer, PublishStats
 from sqlalchemy import Engine, create_engine
 from sqlalchemy.orm import Session, sessionmaker
 
@@ -245,7 +245,7 @@ def rows_in_session(db_session) -> Session:
 @pytest.fixture()
 def mock_publisher(mocker) -> Generator[Mock, None, None]:
     """Patched publisher that does nothing, returns MagicMock of the publish method."""
-    mocker.patch.object(PixlProducer, "__init__", return_value=None)
-    mocker.patch.object(PixlProducer, "__enter__", return_value=PixlProducer)
-    mocker.patch.object(PixlProducer, "__exit__")
-    return mocker.patch.object(PixlProducer, "publish")
+    mocker.patch.object(PixlBulkProducer, "__init__", return_value=None)
+    mocker.patch.object(PixlBulkProducer, "__aenter__", return_value=PixlBulkProducer)
+    mocker.patch.object(PixlBulkProducer, "__aexit__")
+    return mocker.patch.object(PixlBulkProducer, "publish", return_value=PublishStats())
@@ -20,7 +20,7 @@ from unittest.mock import Mock
 
 import pytest
 from _pytest.monkeypatch import MonkeyPatch
-from core.patient_queue.producer import PixlProducer
+from core.patient_queue.producer import PixlBulkProducer, PublishStats
 from pixl_cli._message_processing import retry_until_export_count_is_unchanged
 
 
@@ -33,10 +33,10 @@ def _zero_message_count(monkeypatch: MonkeyPatch) -> None:
 @pytest.fixture()
 def mock_publisher(mocker) -> Generator[Mock, None, None]:
     """Patched publisher that does nothing, returns MagicMock of the publish method."""
-    mocker.patch.object(PixlProducer, "__init__", return_value=None)
-    mocker.patch.object(PixlProducer, "__enter__", return_value=PixlProducer)
-    mocker.patch.object(PixlProducer, "__exit__")
-    return mocker.patch.object(PixlProducer, "publish")
+    mocker.patch.object(PixlBulkProducer, "__init__", return_value=None)
+    mocker.patch.object(PixlBulkProducer, "__aenter__", return_value=PixlBulkProducer)
+    mocker.patch.object(PixlBulkProducer, "__aexit__")
+    return mocker.patch.object(PixlBulkProducer, "publish", return_value=PublishStats())
 
 
 @pytest.mark.usefixtures("_zero_message_count")
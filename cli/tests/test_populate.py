@@ -21,29 +21,30 @@ from typing import TYPE_CHECKING
 
 import pixl_cli._message_processing
 from click.testing import CliRunner
-from core.patient_queue.producer import PixlProducer
+from core.patient_queue.producer import PixlBulkProducer, PublishStats
 from pixl_cli.main import populate
 
 if TYPE_CHECKING:
+    from collections.abc import Iterable
     from pathlib import Path
 
     from core.patient_queue.message import Message
 
 
-class MockProducer(PixlProducer):
+class MockProducer(PixlBulkProducer):
     """Mock producer of PIXL task messages."""
 
-    def __enter__(self) -> PixlProducer:
+    async def __aenter__(self) -> PixlBulkProducer:
         """Context entrypoint."""
         return self
 
-    def __exit__(self, *args: object, **kwargs) -> None:
+    async def __aexit__(self, *args: object, **kwargs) -> None:
         """Context exit point."""
         return
 
-    def publish(self, messages: list[Message], priority: int) -> None:  # noqa: ARG002 don't access messages or priority
+    async def publish(self, messages: Iterable[Message], priority: int) -> PublishStats:  # noqa: ARG002 don't access priority
         """Dummy method for publish."""
-        return
+        return PublishStats(published=len(list(messages)))
 
 
 def test_populate_queue_parquet(
@@ -53,7 +54,7 @@ def test_populate_queue_parquet(
     omop_parquet_dir = str(omop_resources / "omop")
     runner = CliRunner()
 
-    monkeypatch.setattr(pixl_cli._message_processing, "PixlProducer", MockProducer)
+    monkeypatch.setattr(pixl_cli._message_processing, "PixlBulkProducer", MockProducer)
 
     result = runner.invoke(
         populate,
@@ -70,7 +71,7 @@ def test_populate_queue_and_start(
     runner = CliRunner()
 
     mocked_start = mocker.patch("pixl_cli.main._start_or_update_extract")
-    monkeypatch.setattr(pixl_cli._message_processing, "PixlProducer", MockProducer)
+    monkeypatch.setattr(pixl_cli._message_processing, "PixlBulkProducer", MockProducer)
 
     result = runner.invoke(
         populate,
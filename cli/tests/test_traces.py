@@ -0,0 +1,76 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests for summarising study traces"""
+
+from __future__ import annotations
+
+import json
+from typing import TYPE_CHECKING
+
+from click.testing import CliRunner
+from pixl_cli._traces import stage_percentiles
+from pixl_cli.main import traces
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+def _trace(identifier: str, c_move_seconds: float, outcome: str = "success") -> dict:
+    return {
+        "identifier": identifier,
+        "study_uid": "1.2.3",
+        "archive": "primary",
+        "started": "2024-01-01T10:00:00+00:00",
+        "seconds": c_move_seconds + 1,
+        "outcome": outcome,
+        "spans": [
+            {"name": "local_lookup", "start": 0.0, "seconds": 0.25},
+            {"name": "c_move", "start": 0.25, "seconds": c_move_seconds},
+            {"name": "local_lookup", "start": c_move_seconds, "seconds": 0.25},
+        ],
+    }
+
+
+def test_stage_percentiles() -> None:
+    """
+    Given traces where one stage was recorded twice for each message
+    When summarising the stages
+    Then each message's time in the stage is totalled before taking percentiles
+    """
+    summary = stage_percentiles([_trace(str(i), c_move_seconds=i) for i in range(1, 101)])
+
+    assert summary["local_lookup"]["p50"] == 0.5
+    assert summary["c_move"]["p90"] == 90
+    assert summary["c_move"]["max"] == 100
+    assert summary["total"]["count"] == 100
+
+
+def test_traces_command(tmp_path: Path) -> None:
+    """
+    Given a trace file, with a line which isn't valid JSON
+    When the traces command is run
+    Then it reports the stages, throughput and slowest message
+    """
+    trace_file = tmp_path / "traces.jsonl"
+    lines = [json.dumps(_trace("fast", 1)), "not json", json.dumps(_trace("slow", 60, "Error"))]
+    trace_file.write_text("\n".join(lines))
+
+    result = CliRunner().invoke(traces, args=[str(trace_file), "--slowest", "1"])
+
+    assert result.exit_code == 0
+    assert "2 traced messages" in result.output
+    assert "c_move" in result.output
+    assert "2024-01-01T10:00:00+00:00       2  (success 1, Error 1)" in result.output
+    assert "slowest stage c_move  slow" in result.output
+    assert "fast" not in result.output.split("Slowest 1 messages:")[1]
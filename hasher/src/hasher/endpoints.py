@@ -15,8 +15,9 @@
 
 from __future__ import annotations
 
+from core.metrics import REGISTRY, STAGE_SECONDS
 from fastapi import APIRouter
-from starlette.responses import Response
+from starlette.responses import PlainTextResponse, Response
 
 from hasher.hashing import Hasher
 
@@ -28,6 +29,11 @@ async def heart_beat() -> str:
     return "OK"
 
 
+@router.get("/metrics", summary="Metrics in the Prometheus text format")
+async def metrics() -> PlainTextResponse:
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
 @router.get(
     "/hash",
     summary="Produce secure hash with optional max output length (2 <= length <= 64)",
@@ -37,6 +43,7 @@ async def hash(  # noqa: A001
     message: str,
     length: int = 64,
 ) -> Response:
-    hasher = Hasher(project_slug)
-    output = hasher.generate_hash(message, length)
+    with STAGE_SECONDS.time(stage="hash"):
+        hasher = Hasher(project_slug)
+        output = hasher.generate_hash(message, length)
     return Response(content=output, media_type="application/text")
@@ -41,3 +41,10 @@ def test_hash_endpoint_with_custom_length():
     expected = "b721eef65328a79c"
     assert response.status_code == 200
     assert response.text == expected
+
+
+def test_metrics_endpoint_times_hashing():
+    client.get("/hash", params={"project_slug": TEST_PROJECT_SLUG, "message": "test"})
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'pixl_stage_seconds_count{stage="hash"}' in response.text
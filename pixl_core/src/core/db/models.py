@@ -58,6 +58,13 @@ class Image(Base):
     extract: Mapped[Extract] = relationship()
     extract_id: Mapped[int] = mapped_column(ForeignKey("extract.extract_id"))
     pseudo_patient_id: Mapped[Optional[str]]
+    # When the imaging API completed each stage of processing the study for this project
+    found_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=True)
+    query_id: Mapped[Optional[str]]
+    query_answer_id: Mapped[Optional[str]]
+    retrieved_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=True)
+    tagged_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=True)
+    sent_at: Mapped[DateTime] = mapped_column(DateTime(timezone=True), nullable=True)
 
     def __repr__(self) -> str:
         """Nice representation for printing."""
@@ -66,3 +73,34 @@ class Image(Base):
             f"{self.image_id=} {self.accession_number=} {self.mrn=} {self.study_uid=}"
             f"{self.pseudo_study_uid} {self.extract_id}>"
         ).replace(" self.", " ")
+
+
+class TokenBucketState(Base):
+    """token_bucket table, shared by every worker limiting the rate of a key"""
+
+    __tablename__ = "token_bucket"
+
+    key: Mapped[str] = mapped_column(primary_key=True)
+    tokens: Mapped[float]
+    replenished_at: Mapped[float]
+
+    def __repr__(self) -> str:
+        """Nice representation for printing."""
+        return f"<{self.__class__.__name__} {self.key=} {self.tokens=}>".replace(" self.", " ")
+
+
+class TokenBucketRate(Base):
+    """token_bucket_rate table, the rates shared by every worker limiting the rate of a key"""
+
+    __tablename__ = "token_bucket_rate"
+
+    key: Mapped[str] = mapped_column(primary_key=True)
+    rate: Mapped[float]
+    # When a rate controller last adjusted the rate, seconds since the epoch
+    adjusted_at: Mapped[Optional[float]]
+    # Window of the rate schedule which set the rate, if it was set by the schedule
+    scheduled_window: Mapped[Optional[str]]
+
+    def __repr__(self) -> str:
+        """Nice representation for printing."""
+        return f"<{self.__class__.__name__} {self.key=} {self.rate=}>".replace(" self.", " ")
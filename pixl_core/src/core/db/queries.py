@@ -14,13 +14,28 @@
 
 """Interaction with the PIXL database."""
 
-from datetime import datetime
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, Optional
 
 from decouple import config
-from sqlalchemy import URL, create_engine
+from sqlalchemy import URL, create_engine, select, update
 from sqlalchemy.orm import Session, sessionmaker
 
-from core.db.models import Image
+from core.db.models import Extract, Image
+
+if TYPE_CHECKING:
+    from datetime import date, datetime
+
+# Columns recording how far the imaging API got with each image, in order
+STUDY_PROGRESS_COLUMNS = (
+    "found_at",
+    "query_id",
+    "query_answer_id",
+    "retrieved_at",
+    "tagged_at",
+    "sent_at",
+)
 
 url = URL.create(
     drivername="postgresql+psycopg2",
@@ -60,3 +75,41 @@ def _query_existing_image(pixl_session: Session, pseudo_study_uid: str) -> Image
         .one()
     )
     return existing_image
+
+
+def get_study_progress(
+    project_slug: str, mrn: str, accession_number: str, study_date: date
+) -> Optional[dict[str, Any]]:
+    """Stages completed for an image of a project, or None if the image isn't in the database."""
+    query = (
+        select(*(getattr(Image, column) for column in STUDY_PROGRESS_COLUMNS))
+        .join(Extract)
+        .where(
+            Extract.slug == project_slug,
+            Image.mrn == mrn,
+            Image.accession_number == accession_number,
+            Image.study_date == study_date,
+        )
+    )
+    with engine.connect() as connection:
+        row = connection.execute(query).first()
+    return row._asdict() if row is not None else None
+
+
+def update_study_progress(
+    project_slug: str, mrn: str, accession_number: str, study_date: date, **progress: Any
+) -> None:
+    """Update the stages completed for an image of a project, see `STUDY_PROGRESS_COLUMNS`."""
+    extract_id = select(Extract.extract_id).where(Extract.slug == project_slug).scalar_subquery()
+    statement = (
+        update(Image)
+        .where(
+            Image.extract_id == extract_id,
+            Image.mrn == mrn,
+            Image.accession_number == accession_number,
+            Image.study_date == study_date,
+        )
+        .values(**progress)
+    )
+    with engine.begin() as connection:
+        connection.execute(statement)
@@ -24,6 +24,10 @@ class PixlDiscardError(RuntimeError):
     """
 
 
+class PixlJobFailedError(PixlDiscardError):
+    """Orthanc job failed, or didn't finish in time."""
+
+
 class PixlRequeueMessageError(RuntimeError):
     """Requeue PIXL message."""
 
@@ -0,0 +1,245 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Metrics registry for the PIXL services, rendered in the Prometheus text format.
+
+Metrics are created once at import time and updated from anywhere in the process, e.g.
+
+    with STAGE_SECONDS.time(stage="c-move"):
+        ...
+
+The registry is exposed on the `/metrics` endpoint of each service.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import math
+import threading
+from abc import ABC, abstractmethod
+from time import monotonic
+from typing import TYPE_CHECKING, ClassVar, TypeVar
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator, Sequence
+
+LabelValues = tuple[str, ...]
+M = TypeVar("M", bound="_Metric")
+
+# Buckets in seconds, from quick HTTP requests up to slow DICOM transfers
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, math.inf)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Metric(ABC):
+    """A named metric with a value for each combination of its labels."""
+
+    metric_type: ClassVar[str]
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            msg = f"{self.name} needs labels {self.labelnames}, not {tuple(labels)}"
+            raise ValueError(msg)
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, values: LabelValues, **extra: str) -> str:
+        pairs = [*zip(self.labelnames, values, strict=True), *extra.items()]
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self) -> list[str]:
+        """Lines of the Prometheus text format for this metric."""
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+            *self._samples(),
+        ]
+
+    @abstractmethod
+    def _samples(self) -> list[str]:
+        """Sample lines of the Prometheus text format, one for each value of the metric."""
+
+
+class Counter(_Metric):
+    """Total which only increases, e.g. the number of messages processed."""
+
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        """Counter with the given label names, starting from zero."""
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increase the counter for the given labels."""
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        """Current value of the counter for the given labels."""
+        return self._values.get(self._label_values(labels), 0)
+
+    def _samples(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{self._format_labels(key)} {value}" for key, value in values.items()]
+
+
+class Gauge(Counter):
+    """Value which can go up and down, e.g. the number of messages in flight."""
+
+    metric_type = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        """Set the gauge for the given labels."""
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        """Decrease the gauge for the given labels."""
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, e.g. how long each stage of processing takes."""
+
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        """Histogram with the given upper bounds for its buckets, in addition to +Inf."""
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        if self.buckets[-1] != math.inf:
+            self.buckets = (*self.buckets, math.inf)
+        self._counts: dict[LabelValues, list[int]] = {}
+        self._sums: dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Record a value for the given labels."""
+        key = self._label_values(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._sums[key] = self._sums.get(key, 0) + value
+
+    @contextlib.contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Record how long the code in the context takes, in seconds, whether or not it raises."""
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        """Number of values observed for the given labels."""
+        counts = self._counts.get(self._label_values(labels))
+        return counts[-1] if counts else 0
+
+    def _samples(self) -> list[str]:
+        lines = []
+        with self._lock:
+            counts = {key: list(value) for key, value in self._counts.items()}
+            sums = dict(self._sums)
+        for key, bucket_counts in counts.items():
+            for bound, count in zip(self.buckets, bucket_counts, strict=True):
+                le = "+Inf" if bound == math.inf else str(bound)
+                lines.append(f"{self.name}_bucket{self._format_labels(key, le=le)} {count}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {sums[key]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {bucket_counts[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """Collection of metrics, each created once by name."""
+
+    def __init__(self) -> None:
+        """Empty registry."""
+        self._metrics: dict[str, _Metric] = {}
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        """Get or create a counter."""
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        """Get or create a gauge."""
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Histogram:
+        """Get or create a histogram, with the default buckets."""
+        return self._get_or_create(Histogram, name, documentation, labelnames)
+
+    def _get_or_create(
+        self, metric_class: type[M], name: str, documentation: str, labelnames: Sequence[str]
+    ) -> M:
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = metric_class(name, documentation, labelnames)
+        if type(metric) is not metric_class or metric.labelnames != tuple(labelnames):
+            msg = f"Metric {name} already exists as a {metric.metric_type} with {metric.labelnames}"
+            raise ValueError(msg)
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text format."""
+        lines = [line for metric in self._metrics.values() for line in metric.render()]
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "pixl_stage_seconds",
+    "Time taken by each stage of processing a study",
+    ["stage"],
+)
+MESSAGES_IN_FLIGHT = REGISTRY.gauge(
+    "pixl_messages_in_flight", "Messages currently being processed", ["queue"]
+)
+MESSAGE_OUTCOMES = REGISTRY.counter(
+    "pixl_messages_total",
+    "Messages processed, by outcome ('success' or the exception raised)",
+    ["queue", "outcome"],
+)
+TOKEN_BUCKET_RATE = REGISTRY.gauge(
+    "pixl_token_bucket_rate", "Token bucket rate in items per second", ["key"]
+)
+TOKEN_BUCKET_TOKENS = REGISTRY.gauge(
+    "pixl_token_bucket_tokens", "Tokens currently in the token bucket", ["key"]
+)
+HTTP_CLIENT_SECONDS = REGISTRY.histogram(
+    "pixl_http_client_seconds",
+    "Time taken by HTTP requests to other services",
+    ["server", "method"],
+)
@@ -15,15 +15,27 @@
 
 from __future__ import annotations
 
+import datetime
+import json
 from dataclasses import dataclass
-from typing import TYPE_CHECKING, Any
+from typing import Any
 
 from jsonpickle import decode, encode
+from loguru import logger
 
-if TYPE_CHECKING:
-    from datetime import date, datetime
+# Version of the JSON format written by `Message.serialise()`, stored in the "v" field
+MESSAGE_FORMAT_VERSION = 1
 
-from loguru import logger
+# Types which may appear in legacy jsonpickle messages
+_LEGACY_TYPES = {
+    "core.patient_queue.message.Message",
+    "datetime.date",
+    "datetime.datetime",
+    "datetime.timedelta",
+    "datetime.timezone",
+}
+_LEGACY_TYPE_KEYS = {"py/object", "py/type"}
+_LEGACY_STRUCTURE_KEYS = {"py/id", "py/reduce", "py/tuple"}
 
 
 @dataclass
@@ -33,10 +45,10 @@ class Message:
     mrn: str
     accession_number: str
     study_uid: str
-    study_date: date
+    study_date: datetime.date
     procedure_occurrence_id: int
     project_name: str
-    extract_generated_timestamp: datetime
+    extract_generated_timestamp: datetime.datetime
 
     @property
     def identifier(self) -> str:
@@ -49,13 +61,27 @@ class Message:
         """
         Serialise the message into a JSON string and convert to bytes.
 
-        :param deserialisable: If True, the serialised message will be deserialisable, by setting
-            the unpicklable flag to False in jsonpickle.encode(), meaning that the original Message
-            object can be recovered by `deserialise()`. If False, calling `deserialise()` on the
-            serialised message will return a dictionary.
+        :param deserialisable: If True, the message is serialised as compact JSON with a format
+            version, from which the original Message object can be recovered by `deserialise()`.
+            If False, the message is serialised as plain JSON and calling `deserialise()` on it
+            will return a dictionary.
         """
         logger.trace("Serialising {}", self)
-        return str.encode(encode(self, unpicklable=deserialisable))
+        if not deserialisable:
+            return str.encode(encode(self, unpicklable=False))
+        return json.dumps(
+            {
+                "v": MESSAGE_FORMAT_VERSION,
+                "mrn": self.mrn,
+                "accession_number": self.accession_number,
+                "study_uid": self.study_uid,
+                "study_date": self.study_date.isoformat(),
+                "procedure_occurrence_id": self.procedure_occurrence_id,
+                "project_name": self.project_name,
+                "extract_generated_timestamp": self.extract_generated_timestamp.isoformat(),
+            },
+            separators=(",", ":"),
+        ).encode()
 
 
 def deserialise(serialised_msg: bytes) -> Any:
@@ -64,6 +90,52 @@ def deserialise(serialised_msg: bytes) -> Any:
     If the message was serialised with `deserialisable=True`, the original Message object will be
     returned. Otherwise, a dictionary will be returned.
 
+    Messages serialised by earlier versions of PIXL with jsonpickle can still be read, as long as
+    they only contain a Message and its dates.
+
     :param serialised_msg: The serialised message.
     """
-    return decode(serialised_msg)  # noqa: S301, since we control the input, so no security risks
+    data = json.loads(serialised_msg)
+    if not isinstance(data, dict):
+        msg = f"Expected a JSON object for a message, not {type(data).__name__}"
+        raise TypeError(msg)
+
+    if "py/object" in data:
+        _check_legacy_types(data)
+        return decode(serialised_msg)  # noqa: S301, types checked above
+
+    version = data.pop("v", None)
+    if version is None:
+        return data
+    if version != MESSAGE_FORMAT_VERSION:
+        msg = f"Unsupported message format version {version}"
+        raise ValueError(msg)
+    return Message(
+        mrn=data["mrn"],
+        accession_number=data["accession_number"],
+        study_uid=data["study_uid"],
+        study_date=datetime.date.fromisoformat(data["study_date"]),
+        procedure_occurrence_id=data["procedure_occurrence_id"],
+        project_name=data["project_name"],
+        extract_generated_timestamp=datetime.datetime.fromisoformat(
+            data["extract_generated_timestamp"]
+        ),
+    )
+
+
+def _check_legacy_types(data: Any) -> None:
+    """Check that a legacy jsonpickle message only refers to the types a Message contains."""
+    if isinstance(data, list):
+        for item in data:
+            _check_legacy_types(item)
+    elif isinstance(data, dict):
+        for key, value in data.items():
+            if key in _LEGACY_TYPE_KEYS:
+                if value not in _LEGACY_TYPES:
+                    msg = f"Unexpected type {value} in legacy message"
+                    raise ValueError(msg)
+            elif key.startswith("py/") and key not in _LEGACY_STRUCTURE_KEYS:
+                msg = f"Unexpected {key} in legacy message"
+                raise ValueError(msg)
+            else:
+                _check_legacy_types(value)
@@ -15,13 +15,23 @@
 
 from __future__ import annotations
 
-from typing import TYPE_CHECKING
+import asyncio
+from dataclasses import dataclass
+from time import monotonic
+from typing import TYPE_CHECKING, Any
 
+import aio_pika
+from aio_pika.exceptions import DeliveryError, PublishError
 from pika import BasicProperties, DeliveryMode
 
-from ._base import PixlBlockingInterface
+from ._base import PixlBlockingInterface, PixlQueueInterface
 
 if TYPE_CHECKING:
+    from collections.abc import Iterable
+
+    from aio_pika.abc import AbstractChannel
+    from typing_extensions import Self
+
     from core.patient_queue.message import Message
 
 from loguru import logger
@@ -61,3 +71,156 @@ class PixlProducer(PixlBlockingInterface):
         clean after tests.
         """
         self._channel.queue_purge(queue=self.queue_name)
+
+
+@dataclass
+class PublishStats:
+    """Outcome of a bulk publish."""
+
+    published: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        """Messages published per second."""
+        return self.published / self.seconds if self.seconds > 0 else 0.0
+
+
+class PixlBulkProducer(PixlQueueInterface):
+    """
+    Publisher for large numbers of messages, with publisher confirms.
+
+    Messages are streamed from an iterable and published over an aio_pika connection, with up to
+    `window` publishes waiting for the broker to confirm them at once. Publishes which aren't
+    confirmed are retried up to `max_retries` times.
+    """
+
+    def __init__(
+        self,
+        queue_name: str,
+        *,
+        window: int = 1000,
+        max_retries: int = 3,
+        progress_interval: float = 10,
+        **kwargs: Any,
+    ) -> None:
+        """
+        Publisher for a RabbitMQ queue.
+
+        :param window: maximum number of publishes waiting for confirmation
+        :param max_retries: number of times to retry a publish which isn't confirmed
+        :param progress_interval: seconds between logging progress
+        """
+        super().__init__(queue_name=queue_name, **kwargs)
+        self.window = window
+        self.max_retries = max_retries
+        self.progress_interval = progress_interval
+
+    async def __aenter__(self) -> Self:
+        """Establishes connection to queue."""
+        self._connection = await aio_pika.connect_robust(self._url)
+        self._channel = await self._connection.channel(publisher_confirms=True)
+        self._queue = await self._channel.declare_queue(
+            self.queue_name,
+            durable=True,
+            arguments={"x-max-priority": 5},
+        )
+        return self
+
+    async def __aexit__(self, *args: object, **kwargs: Any) -> None:
+        """Shutdown the connection to RabbitMQ service."""
+        await self._connection.close()
+
+    async def publish(self, messages: Iterable[Message], priority: int) -> PublishStats:
+        """
+        Publish messages to the queue, returning once the broker has confirmed them all.
+
+        Errors other than a publish not being confirmed, e.g. the connection closing, are raised
+        once the publishes still waiting for confirmation have been cancelled.
+
+        :param messages: messages to be sent to queue, consumed lazily
+        :param priority: priority of the messages, from 1 (lowest) to 5 (highest)
+        :return: how many messages were published or failed, and how long it took
+        """
+        stats = PublishStats()
+        start = monotonic()
+        last_progress = start
+        pending: set[asyncio.Task[bool]] = set()
+
+        def collect(done: set[asyncio.Task[bool]]) -> None:
+            errors = []
+            for task in done:
+                error = task.exception()
+                if error is not None:
+                    errors.append(error)
+                elif task.result():
+                    stats.published += 1
+                else:
+                    stats.failed += 1
+            if errors:
+                # e.g. the channel or connection was closed, so later publishes would fail too
+                raise errors[0]
+
+        try:
+            for message in messages:
+                if len(pending) >= self.window:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    collect(done)
+                pending.add(asyncio.create_task(self._publish_one(message, priority)))
+
+                if monotonic() - last_progress >= self.progress_interval:
+                    last_progress = monotonic()
+                    stats.seconds = last_progress - start
+                    logger.info(
+                        "Published {} messages to {} ({:.0f}/s)",
+                        stats.published,
+                        self.queue_name,
+                        stats.rate,
+                    )
+
+            if pending:
+                done, pending = await asyncio.wait(pending)
+                collect(done)
+        except BaseException:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            raise
+
+        stats.seconds = monotonic() - start
+        logger.info(
+            "Published {} messages to {} in {:.1f}s ({:.0f}/s), {} failed",
+            stats.published,
+            self.queue_name,
+            stats.seconds,
+            stats.rate,
+            stats.failed,
+        )
+        return stats
+
+    async def _publish_one(self, message: Message, priority: int) -> bool:
+        """Publish a message, retrying if it isn't confirmed. Returns whether it was confirmed."""
+        channel: AbstractChannel = self._channel
+        body = message.serialise()
+        for attempt in range(self.max_retries + 1):
+            try:
+                await channel.default_exchange.publish(
+                    aio_pika.Message(
+                        body=body,
+                        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                        priority=priority,
+                    ),
+                    routing_key=self.queue_name,
+                )
+            except (DeliveryError, PublishError, TimeoutError) as error:  # noqa: PERF203 - retry
+                logger.warning(
+                    "Publish of {} not confirmed (attempt {}): {}",
+                    message.identifier,
+                    attempt + 1,
+                    error,
+                )
+            else:
+                return True
+        logger.error("Failed to publish {} to {}", message.identifier, self.queue_name)
+        return False
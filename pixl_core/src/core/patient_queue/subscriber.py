@@ -17,7 +17,8 @@
 from __future__ import annotations
 
 import asyncio
-from typing import TYPE_CHECKING, Any
+import contextlib
+from typing import TYPE_CHECKING, Any, Optional
 
 import aio_pika
 from decouple import config
@@ -28,14 +29,14 @@ from core.exceptions import (
     PixlRequeueMessageError,
     PixlStudyNotInPrimaryArchiveError,
 )
+from core.metrics import MESSAGE_OUTCOMES, MESSAGES_IN_FLIGHT
 from core.patient_queue._base import PixlQueueInterface
 from core.patient_queue.message import deserialise
-from core.patient_queue.producer import PixlProducer
 
 if TYPE_CHECKING:
     from collections.abc import Awaitable, Callable
 
-    from aio_pika.abc import AbstractIncomingMessage
+    from aio_pika.abc import AbstractChannel, AbstractIncomingMessage
     from typing_extensions import Self
 
     from core.patient_queue.message import Message
@@ -43,29 +44,62 @@ if TYPE_CHECKING:
 
 from loguru import logger
 
+# Header counting how many times a message has been retried through the retry queues
+RETRY_ATTEMPT_HEADER = "x-pixl-attempt"
+
 
 class PixlConsumer(PixlQueueInterface):
     """Connector to RabbitMQ. Consumes messages from a queue"""
 
-    def __init__(
+    def __init__(  # noqa: PLR0913 - too many args
         self,
         queue_name: str,
         token_bucket: TokenBucket,
         token_bucket_key: str,
         callback: Callable[[Message], Awaitable[None]],
+        is_active: Optional[Callable[[], bool]] = None,
+        active_check_interval: float = 60,
     ) -> None:
         """
         Creating connection to RabbitMQ queue
+
+        If PIXL_RETRY_MAX_ATTEMPTS is set, messages which need to be retried are published to a
+        retry queue for their attempt, `<queue>-retry-<attempt>`, and acknowledged straight away.
+        They expire back into the queue after an exponential backoff, starting from
+        PIXL_RETRY_BASE_DELAY seconds and up to PIXL_RETRY_MAX_DELAY seconds. The delay is the
+        message TTL of each retry queue rather than of each message, as RabbitMQ only expires
+        messages at the head of a queue. Messages which still fail after the maximum number of
+        attempts are parked in `<queue>-parked`.
+
+        If `is_active` is given, the consumer only consumes while it returns True, checking every
+        `active_check_interval` seconds. Outside that window, the consumer is cancelled so that
+        messages stay in the queue, and it resumes once the window opens again.
+
+        If PIXL_WAIT_FOR_TOKENS is set, messages are held (unacknowledged) until a token is
+        available, for up to PIXL_MAX_TOKEN_WAIT seconds, rather than being requeued straight
+        away. This keeps messages in priority order and saves redelivering them. The same applies
+        while the token bucket's schedule limits the number of messages in flight.
+
         :param token_bucket: Token bucket for the queue
+        :param is_active: called to check whether messages should be consumed now
         """
         super().__init__(queue_name=queue_name)
         self.token_bucket = token_bucket
         self.token_bucket_key = token_bucket_key
         self._callback = callback
-
-    @property
-    def _url(self) -> str:
-        return f"amqp://{self._username}:{self._password}@{self._host}:{self._port}/"
+        self._is_active = is_active
+        self._active_check_interval = active_check_interval
+        self._consumer_tag: Optional[str] = None
+        self._publish_channel: Optional[AbstractChannel] = None
+        self._publish_channel_lock = asyncio.Lock()
+        self._declared_queues: set[str] = set()
+        self._wait_for_tokens = config("PIXL_WAIT_FOR_TOKENS", default=False, cast=bool)
+        self._max_token_wait = config("PIXL_MAX_TOKEN_WAIT", default=600, cast=float)
+        self._retry_max_attempts: int = config("PIXL_RETRY_MAX_ATTEMPTS", default=0, cast=int)
+        self._retry_base_delay: float = config("PIXL_RETRY_BASE_DELAY", default=10, cast=float)
+        self._retry_max_delay: float = config("PIXL_RETRY_MAX_DELAY", default=600, cast=float)
+        self._in_flight = 0
+        self._in_flight_changed = asyncio.Condition()
 
     async def __aenter__(self) -> Self:
         """Establishes connection to queue."""
@@ -83,19 +117,31 @@ class PixlConsumer(PixlQueueInterface):
         return self
 
     async def _process_message(self, message: AbstractIncomingMessage) -> None:
-        if not self.token_bucket.has_token(key=self.token_bucket_key):
+        if not await self._start_in_flight():
             await asyncio.sleep(1)
             await message.reject(requeue=True)
             return
+        try:
+            if not await self._take_token():
+                await asyncio.sleep(1)
+                await message.reject(requeue=True)
+                return
+            await self._handle_message(message)
+        finally:
+            await self._finish_in_flight()
 
+    async def _handle_message(self, message: AbstractIncomingMessage) -> None:
         pixl_message: Message = deserialise(message.body)
         logger.debug("Picked up from queue: {}", pixl_message.identifier)
         try:
-            await self._callback(pixl_message)
+            await self._run_callback(pixl_message)
         except PixlRequeueMessageError as requeue:
             logger.trace("Requeue message: {} from {}", pixl_message.identifier, requeue)
-            await asyncio.sleep(1)
-            await message.reject(requeue=True)
+            if self._retry_max_attempts > 0:
+                await self._retry_later(message)
+            else:
+                await asyncio.sleep(1)
+                await message.reject(requeue=True)
         except PixlStudyNotInPrimaryArchiveError as discard:
             logger.info(
                 "Discard message: {} from {}. Sending to secondary imaging queue with priority {}.",
@@ -104,21 +150,17 @@ class PixlConsumer(PixlQueueInterface):
                 message.priority,
             )
             await asyncio.sleep(1)
+            await self._republish(message, queue_name="imaging-secondary")
             await message.reject(requeue=False)
-            with PixlProducer(
-                queue_name="imaging-secondary",
-                host=config("RABBITMQ_HOST"),
-                port=config("RABBITMQ_PORT", cast=int),
-                username=config("RABBITMQ_USERNAME"),
-                password=config("RABBITMQ_PASSWORD"),
-            ) as producer:
-                producer.publish([pixl_message], priority=message.priority)
         except PixlOutOfHoursError as nack_requeue:
             logger.trace(
                 "Nack and requeue message: {} from {}", pixl_message.identifier, nack_requeue
             )
-            await asyncio.sleep(10)
-            await message.nack(requeue=True)
+            if self._retry_max_attempts > 0:
+                await self._retry_later(message, count_attempt=False)
+            else:
+                await asyncio.sleep(10)
+                await message.nack(requeue=True)
         except PixlDiscardError as exception:
             logger.warning("Failed message {}: {}", pixl_message.identifier, exception)
             await (
@@ -136,9 +178,149 @@ class PixlConsumer(PixlQueueInterface):
             logger.success("Finished message {}", pixl_message.identifier)
             await message.ack()
 
+    async def _run_callback(self, pixl_message: Message) -> None:
+        """Run the callback, counting its outcome."""
+        try:
+            await self._callback(pixl_message)
+        except Exception as exception:
+            MESSAGE_OUTCOMES.inc(queue=self.queue_name, outcome=type(exception).__name__)
+            raise
+        MESSAGE_OUTCOMES.inc(queue=self.queue_name, outcome="success")
+
+    async def _retry_later(
+        self, message: AbstractIncomingMessage, *, count_attempt: bool = True
+    ) -> None:
+        """
+        Publish a message to the retry queue for its attempt, or park it after the last attempt.
+
+        Messages which aren't counted as an attempt (e.g. out of hours) use the last retry queue.
+        """
+        attempt = int(str((message.headers or {}).get(RETRY_ATTEMPT_HEADER, 0)))
+        if count_attempt and attempt >= self._retry_max_attempts:
+            logger.warning(
+                "Parking message from {} after {} attempts", self.queue_name, attempt + 1
+            )
+            await self._republish(message, queue_name=f"{self.queue_name}-parked")
+            await message.ack()
+            return
+
+        last_retry_queue = self._retry_max_attempts - 1
+        retry_queue = min(attempt, last_retry_queue) if count_attempt else last_retry_queue
+        await self._republish(
+            message,
+            queue_name=f"{self.queue_name}-retry-{retry_queue}",
+            arguments={
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": self.queue_name,
+                "x-message-ttl": int(self._retry_delay(retry_queue) * 1000),
+            },
+            headers={RETRY_ATTEMPT_HEADER: attempt + 1 if count_attempt else attempt},
+        )
+        await message.ack()
+
+    def _retry_delay(self, attempt: int) -> float:
+        """Exponential backoff for an attempt, in seconds."""
+        delay: float = min(self._retry_base_delay * 2**attempt, self._retry_max_delay)
+        return delay
+
+    async def _republish(
+        self,
+        message: AbstractIncomingMessage,
+        queue_name: str,
+        *,
+        arguments: Optional[dict[str, Any]] = None,
+        headers: Optional[dict[str, Any]] = None,
+    ) -> None:
+        """
+        Publish a message to another queue, over this consumer's connection.
+
+        The publish is confirmed by the broker before returning, so the original message can
+        then be safely rejected.
+        """
+        channel = await self._get_publish_channel()
+        if queue_name not in self._declared_queues:
+            await channel.declare_queue(
+                queue_name,
+                durable=True,
+                arguments=arguments or {"x-max-priority": 5},
+            )
+            self._declared_queues.add(queue_name)
+        await channel.default_exchange.publish(
+            aio_pika.Message(
+                body=message.body,
+                headers=headers,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                priority=message.priority,
+            ),
+            routing_key=queue_name,
+        )
+
+    async def _get_publish_channel(self) -> AbstractChannel:
+        """Channel with publisher confirms, opened the first time a message is republished."""
+        async with self._publish_channel_lock:
+            if self._publish_channel is None or self._publish_channel.is_closed:
+                channel: AbstractChannel = await self._connection.channel(publisher_confirms=True)
+                self._publish_channel = channel
+                self._declared_queues.clear()
+            return self._publish_channel
+
+    async def _start_in_flight(self) -> bool:
+        """Count a message as in flight, if the token bucket's schedule allows another one."""
+        async with self._in_flight_changed:
+            if self._wait_for_tokens:
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(
+                        self._in_flight_changed.wait_for(self._can_start_in_flight),
+                        timeout=self._max_token_wait,
+                    )
+            if not self._can_start_in_flight():
+                return False
+            self._in_flight += 1
+            MESSAGES_IN_FLIGHT.set(self._in_flight, queue=self.queue_name)
+            return True
+
+    async def _finish_in_flight(self) -> None:
+        async with self._in_flight_changed:
+            self._in_flight -= 1
+            MESSAGES_IN_FLIGHT.set(self._in_flight, queue=self.queue_name)
+            self._in_flight_changed.notify_all()
+
+    def _can_start_in_flight(self) -> bool:
+        max_in_flight = self.token_bucket.max_in_flight(self.token_bucket_key)
+        return max_in_flight is None or self._in_flight < max_in_flight
+
+    async def _take_token(self) -> bool:
+        if self._wait_for_tokens:
+            return await self.token_bucket.wait_for_token(
+                key=self.token_bucket_key, timeout=self._max_token_wait
+            )
+        return await self.token_bucket.take_token(key=self.token_bucket_key)
+
     async def run(self) -> None:
-        """Processes messages from queue asynchronously."""
-        await self._queue.consume(self._process_message)
+        """
+        Processes messages from queue asynchronously.
+
+        With an `is_active` check, this keeps running to pause and resume consuming, until
+        cancelled.
+        """
+        if self._is_active is None:
+            await self._queue.consume(self._process_message)
+            return
+
+        while True:
+            await self._update_consuming()
+            await asyncio.sleep(self._active_check_interval)
+
+    async def _update_consuming(self) -> None:
+        """Start or stop consuming, if the consumer's active window has opened or closed."""
+        active = self._is_active is None or self._is_active()
+        if active and self._consumer_tag is None:
+            logger.info("Consuming from {}", self.queue_name)
+            self._consumer_tag = await self._queue.consume(self._process_message)
+        elif not active and self._consumer_tag is not None:
+            logger.info("Pausing consumption from {} until its window opens", self.queue_name)
+            await self._queue.cancel(self._consumer_tag)
+            self._consumer_tag = None
 
     async def __aexit__(self, *args: object, **kwargs: Any) -> None:
         """Requirement for the asynchronous context manager"""
@@ -15,9 +15,20 @@
 
 from __future__ import annotations
 
+import asyncio
+
 from fastapi import APIRouter, HTTPException, status
+from fastapi.responses import PlainTextResponse
 
-from core.token_buffer.models import AppState, TokenRefreshUpdate
+from core.metrics import REGISTRY, TOKEN_BUCKET_RATE, TOKEN_BUCKET_TOKENS
+from core.token_buffer.models import (
+    AppState,
+    ConcurrencyLimitsState,
+    ConcurrencyLimitsUpdate,
+    RateControllerState,
+    TokenRefreshUpdate,
+)
+from core.token_buffer.schedule import RateSchedule
 
 state = AppState()
 router = APIRouter()
@@ -28,6 +39,19 @@ async def heart_beat() -> str:  # noqa: D103
     return "OK"
 
 
+@router.get("/metrics", summary="Metrics in the Prometheus text format")
+async def metrics() -> PlainTextResponse:  # noqa: D103
+    # The token bucket's storage may be the database, which mustn't block the event loop
+    await asyncio.to_thread(_update_token_bucket_metrics)
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+def _update_token_bucket_metrics() -> None:
+    for key in state.token_bucket.keys:
+        TOKEN_BUCKET_RATE.set(state.token_bucket.key_rate(key), key=key)
+        TOKEN_BUCKET_TOKENS.set(state.token_bucket.token_count(key), key=key)
+
+
 @router.post("/token-bucket-refresh-rate", summary="Update the refresh rate in items per second")
 async def update_tb_refresh_rate(item: TokenRefreshUpdate) -> str:  # noqa: D103
     if not isinstance(item.rate, float) or item.rate < 0:
@@ -36,14 +60,97 @@ async def update_tb_refresh_rate(item: TokenRefreshUpdate) -> str:  # noqa: D103
             detail=f"Refresh rate mush be a positive integer. Had {item.rate}",
         )
 
-    state.token_bucket.rate = float(item.rate)
+    await asyncio.to_thread(_set_token_bucket_rate, float(item.rate))
     return "Successfully updated the refresh rate"
 
 
+def _set_token_bucket_rate(rate: float) -> None:
+    # Shared with every worker through the database, if the tokens are
+    state.token_bucket.rate = rate
+
+
 @router.get(
     "/token-bucket-refresh-rate",
     summary="Get the refresh rate in items per second",
     response_model=TokenRefreshUpdate,
 )
 async def get_tb_refresh_rate() -> TokenRefreshUpdate:  # noqa: D103
-    return TokenRefreshUpdate(rate=state.token_bucket.rate)
+    rate = await asyncio.to_thread(lambda: state.token_bucket.rate)
+    return TokenRefreshUpdate(rate=rate)
+
+
+@router.get(
+    "/rate-controller",
+    summary="Get the rates set by the automatic rate controller",
+    response_model=RateControllerState,
+)
+async def get_rate_controller() -> RateControllerState:  # noqa: D103
+    controller = state.rate_controller
+    if controller is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Automatic rate control is not enabled",
+        )
+    rates = await asyncio.to_thread(_token_bucket_key_rates)
+    return RateControllerState(
+        rates=rates,
+        reasons=controller.last_reasons,
+        min_rate=controller.min_rate,
+        max_rate=controller.max_rate,
+        pending_jobs=controller.last_pending_jobs,
+    )
+
+
+def _token_bucket_key_rates() -> dict[str, float]:
+    return {key: state.token_bucket.key_rate(key) for key in state.token_bucket.keys}
+
+
+@router.get(
+    "/rate-schedule",
+    summary="Get the time-of-day schedule of rates for each queue",
+    response_model=RateSchedule,
+)
+async def get_rate_schedule() -> RateSchedule:  # noqa: D103
+    return state.token_bucket.schedule or RateSchedule()
+
+
+@router.put("/rate-schedule", summary="Replace the time-of-day schedule of rates for each queue")
+async def update_rate_schedule(schedule: RateSchedule) -> str:  # noqa: D103
+    unknown_queues = set(schedule.queues) - set(state.token_bucket.keys)
+    if unknown_queues:
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+            detail=f"Queues must be in {state.token_bucket.keys}. Had {sorted(unknown_queues)}",
+        )
+
+    state.token_bucket.schedule = schedule
+    return "Successfully updated the rate schedule"
+
+
+@router.get(
+    "/concurrency-limits",
+    summary="Get the limit on messages in each archive and stage at once, and current usage",
+    response_model=ConcurrencyLimitsState,
+)
+async def get_concurrency_limits() -> ConcurrencyLimitsState:  # noqa: D103
+    limits = state.concurrency_limits
+    return ConcurrencyLimitsState(limits=limits.limits, in_use=limits.in_use)
+
+
+@router.put(
+    "/concurrency-limits",
+    summary="Update the limits of some archives or stages, null for no limit",
+)
+async def update_concurrency_limits(item: ConcurrencyLimitsUpdate) -> str:  # noqa: D103
+    unknown_names = set(item.limits) - set(state.concurrency_limits.names)
+    if unknown_names:
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+            detail=(
+                f"Limits must be for {list(state.concurrency_limits.names)}. "
+                f"Had {sorted(unknown_names)}"
+            ),
+        )
+
+    await state.concurrency_limits.update(item.limits)
+    return "Successfully updated the concurrency limits"
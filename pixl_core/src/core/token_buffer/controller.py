@@ -0,0 +1,218 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Automatic adjustment of token bucket rates from how the archives are coping."""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import TYPE_CHECKING, Optional
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable, Iterator
+
+    from core.token_buffer.tokens import TokenBucket
+
+
+@dataclass
+class _Signals:
+    """What was observed for a key since the last adjustment."""
+
+    query_seconds: list[float] = field(default_factory=list)
+    retrieval_seconds: list[float] = field(default_factory=list)
+    failed_retrievals: int = 0
+
+    @property
+    def retrievals(self) -> int:
+        return len(self.retrieval_seconds)
+
+    @property
+    def observed(self) -> bool:
+        return bool(self.query_seconds or self.retrieval_seconds)
+
+
+class RateController:
+    """
+    Adjust the token bucket rate of each key with additive-increase/multiplicative-decrease.
+
+    Every `interval` seconds, each key's rate is multiplied by `decrease_factor` if its archive
+    looks overloaded: queries or retrievals taking longer on average than `max_query_seconds` or
+    `max_retrieval_seconds`, more than `max_failure_rate` of retrievals failing, or Orthanc Raw
+    having more than `max_pending_jobs` pending jobs. Otherwise, if the key was used, its rate is
+    increased by `increase`. Rates are kept between `min_rate` and `max_rate`, and keys with a
+    rate of zero are left alone, so that the operator can still pause extraction.
+
+    While a window of the token bucket's schedule is active for a key, the window's rate is the
+    highest rate that the controller sets. Each change of window sets the key's rate to the
+    window's rate, which the controller then adjusts.
+
+    With the token bucket's rates shared through the database, every worker runs a controller,
+    but only the first to adjust a key in each interval changes its rate.
+    """
+
+    def __init__(  # noqa: PLR0913 - too many args
+        self,
+        token_bucket: TokenBucket,
+        *,
+        min_rate: float,
+        max_rate: float,
+        increase: float = 0.1,
+        decrease_factor: float = 0.5,
+        max_query_seconds: float = 10,
+        max_retrieval_seconds: float = 300,
+        max_failure_rate: float = 0.2,
+        max_pending_jobs: int = 10,
+        interval: float = 30,
+        pending_jobs: Optional[Callable[[], Awaitable[int]]] = None,
+    ) -> None:
+        """
+        Controller for the rates of a token bucket's keys.
+
+        :param min_rate: lowest rate that the controller will set, in items per second
+        :param max_rate: highest rate that the controller will set, in items per second
+        :param pending_jobs: called to get the number of pending jobs in Orthanc Raw
+        """
+        if not 0 <= min_rate <= max_rate:
+            msg = f"Rates must satisfy 0 <= min_rate <= max_rate, not {min_rate} and {max_rate}"
+            raise ValueError(msg)
+        self.token_bucket = token_bucket
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.max_query_seconds = max_query_seconds
+        self.max_retrieval_seconds = max_retrieval_seconds
+        self.max_failure_rate = max_failure_rate
+        self.max_pending_jobs = max_pending_jobs
+        self.interval = interval
+        self._pending_jobs = pending_jobs
+
+        self.last_pending_jobs = 0
+        self.last_reasons: dict[str, str] = {}
+        self._signals: dict[str, _Signals] = {}
+
+    def record_query(self, key: str, seconds: float) -> None:
+        """Record how long a query of the archive for the key took."""
+        self._signals.setdefault(key, _Signals()).query_seconds.append(seconds)
+
+    def record_retrieval(self, key: str, seconds: float, *, success: bool) -> None:
+        """Record how long a retrieval from the archive for the key took, and whether it worked."""
+        signals = self._signals.setdefault(key, _Signals())
+        signals.retrieval_seconds.append(seconds)
+        if not success:
+            signals.failed_retrievals += 1
+
+    @contextlib.contextmanager
+    def timed_query(self, key: str) -> Iterator[None]:
+        """Record how long the query in the context takes, if it succeeds."""
+        start = monotonic()
+        yield
+        self.record_query(key, monotonic() - start)
+
+    @contextlib.contextmanager
+    def timed_retrieval(
+        self, key: str, failures: tuple[type[BaseException], ...] = (Exception,)
+    ) -> Iterator[None]:
+        """
+        Record how long the retrieval in the context takes, and whether it fails.
+
+        :param failures: errors showing that the archive failed the retrieval, other errors
+            aren't recorded at all
+        """
+        start = monotonic()
+        try:
+            yield
+        except failures:
+            self.record_retrieval(key, monotonic() - start, success=False)
+            raise
+        self.record_retrieval(key, monotonic() - start, success=True)
+
+    async def run(self) -> None:
+        """Adjust the rates every interval, until cancelled."""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.update()
+            except Exception:  # noqa: BLE001
+                logger.exception("Failed to adjust token bucket rates")
+
+    async def update(self) -> dict[str, float]:
+        """
+        Get the number of pending jobs, then adjust the rates.
+
+        The rates are adjusted from a worker thread, as they may be kept in the database.
+        """
+        pending_jobs = await self._pending_jobs() if self._pending_jobs is not None else 0
+        return await asyncio.to_thread(self.adjust, pending_jobs)
+
+    def adjust(self, pending_jobs: int = 0) -> dict[str, float]:
+        """
+        Adjust the rate of each key from the signals observed since the last adjustment.
+
+        :returns: the new rate of each key
+        """
+        self.last_pending_jobs = pending_jobs
+        signals, self._signals = self._signals, {}
+        rates = {}
+        for key in self.token_bucket.keys:
+            rate = current_rate = self.token_bucket.key_rate(key)
+            max_rate = self._max_rate(key)
+            reason = self._congestion(signals.get(key, _Signals()), pending_jobs)
+            if rate == 0:
+                reason = "paused"
+            elif reason is not None:
+                rate = max(rate * self.decrease_factor, self.min_rate)
+            elif key in signals and signals[key].observed:
+                rate = min(rate + self.increase, max_rate)
+                reason = "increase"
+            else:
+                reason = "idle"
+            rate = min(max(rate, self.min_rate), max_rate) if rate > 0 else 0.0
+            if rate != current_rate:
+                if self.token_bucket.adjust_key_rate(key, rate, self.interval):
+                    logger.info("Setting {} rate to {:.2f} ({})", key, rate, reason)
+                else:
+                    rate = self.token_bucket.key_rate(key)
+                    reason = "adjusted by another worker"
+            self.last_reasons[key] = reason
+            rates[key] = rate
+        return rates
+
+    def _max_rate(self, key: str) -> float:
+        """Highest rate for the key, lowered to the rate of its scheduled window if it has one."""
+        scheduled_rate = self.token_bucket.scheduled_rate(key)
+        if scheduled_rate is None:
+            return self.max_rate
+        return min(self.max_rate, scheduled_rate)
+
+    def _congestion(self, signals: _Signals, pending_jobs: int) -> Optional[str]:
+        """Reason for slowing down, or None if the archive is coping."""
+        if pending_jobs > self.max_pending_jobs:
+            return f"{pending_jobs} pending jobs"
+        if signals.query_seconds:
+            mean_query = sum(signals.query_seconds) / len(signals.query_seconds)
+            if mean_query > self.max_query_seconds:
+                return f"queries taking {mean_query:.1f}s"
+        if signals.retrieval_seconds:
+            mean_retrieval = sum(signals.retrieval_seconds) / signals.retrievals
+            if mean_retrieval > self.max_retrieval_seconds:
+                return f"retrievals taking {mean_retrieval:.1f}s"
+            failure_rate = signals.failed_retrievals / signals.retrievals
+            if failure_rate > self.max_failure_rate:
+                return f"{failure_rate:.0%} of retrievals failing"
+        return None
@@ -0,0 +1,142 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Limits on how many messages are in each archive and each stage of processing at once."""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+from typing import TYPE_CHECKING, Optional
+
+from decouple import config
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator
+
+ARCHIVES = ("primary", "secondary")
+STAGES = ("c-find", "c-move", "modify", "c-store")
+
+
+def _check_limit(limit: Optional[int]) -> None:
+    if limit is not None and limit < 1:
+        msg = f"Limit must be at least 1, or None for no limit, not {limit}"
+        raise ValueError(msg)
+
+
+class ResizableLimiter:
+    """Semaphore whose limit can be changed while it is in use, with None for no limit."""
+
+    def __init__(self, limit: Optional[int] = None) -> None:
+        """Limiter allowing up to `limit` holders at once."""
+        _check_limit(limit)
+        self._limit = limit
+        self._in_use = 0
+        self._condition = asyncio.Condition()
+
+    @property
+    def limit(self) -> Optional[int]:
+        """Maximum number of holders, or None if unlimited"""
+        return self._limit
+
+    @property
+    def in_use(self) -> int:
+        """Number of current holders"""
+        return self._in_use
+
+    async def set_limit(self, limit: Optional[int]) -> None:
+        """
+        Change the limit, waking waiters if it was raised.
+
+        Lowering the limit doesn't interrupt current holders, new ones wait until enough finish.
+        """
+        _check_limit(limit)
+        async with self._condition:
+            self._limit = limit
+            self._condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def hold(self) -> AsyncIterator[None]:
+        """Wait until below the limit, and hold a place until the context exits."""
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self._limit is None or self._in_use < self._limit
+            )
+            self._in_use += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._in_use -= 1
+                self._condition.notify()
+
+
+class ConcurrencyLimits:
+    """
+    Independent limits for each archive and each stage of processing a message.
+
+    The archive limits bound how many studies are retrieved from each archive at once, and the
+    stage limits how many messages are in each of the C-FIND, C-MOVE, modify and C-STORE stages,
+    so that slow stages don't hold places needed by quick ones.
+    """
+
+    names = (*ARCHIVES, *STAGES)
+
+    def __init__(self, limits: Optional[dict[str, Optional[int]]] = None) -> None:
+        """Limits by archive or stage name, which are unlimited unless given."""
+        limits = limits or {}
+        self._check_names(limits)
+        self._limiters = {name: ResizableLimiter(limits.get(name)) for name in self.names}
+
+    @classmethod
+    def from_config(cls) -> ConcurrencyLimits:
+        """
+        Limits from the PIXL_LIMIT_<NAME> environment variables, e.g. PIXL_LIMIT_C_MOVE.
+
+        Zero or unset means no limit.
+        """
+        limits = {}
+        for name in cls.names:
+            variable = "PIXL_LIMIT_" + name.upper().replace("-", "_")
+            limit: int = config(variable, default=0, cast=int)
+            limits[name] = limit or None
+        return cls(limits)
+
+    def hold(self, name: str) -> contextlib.AbstractAsyncContextManager[None]:
+        """Hold a place in the archive or stage for the duration of the context."""
+        self._check_names([name])
+        return self._limiters[name].hold()
+
+    @property
+    def limits(self) -> dict[str, Optional[int]]:
+        """Limit of each archive and stage"""
+        return {name: limiter.limit for name, limiter in self._limiters.items()}
+
+    @property
+    def in_use(self) -> dict[str, int]:
+        """Number of messages currently in each archive and stage"""
+        return {name: limiter.in_use for name, limiter in self._limiters.items()}
+
+    async def update(self, limits: dict[str, Optional[int]]) -> None:
+        """Change the limits of the given archives and stages, leaving the others alone."""
+        self._check_names(limits)
+        for limit in limits.values():
+            _check_limit(limit)
+        for name, limit in limits.items():
+            await self._limiters[name].set_limit(limit)
+
+    def _check_names(self, names: dict[str, Optional[int]] | list[str]) -> None:
+        unknown = set(names) - set(self.names)
+        if unknown:
+            msg = f"Limits must be for one of {list(self.names)}, not {sorted(unknown)}"
+            raise ValueError(msg)
@@ -19,20 +19,54 @@ This module defines the data models used by the PIXL core service
 from __future__ import annotations
 
 from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, PositiveInt
 
 from core.token_buffer import TokenBucket
+from core.token_buffer.limits import ConcurrencyLimits
+from core.token_buffer.storage import token_bucket_storage
+
+if TYPE_CHECKING:
+    from core.token_buffer.controller import RateController
 
 
 @dataclass
 class AppState:
-    """Stores the token bucket"""
+    """
+    Stores the token bucket, the concurrency limits of each archive and stage, and the
+    controller adjusting the token bucket's rates if enabled
+    """
 
-    token_bucket = TokenBucket(rate=0, capacity=5)
+    token_bucket = TokenBucket(rate=0, capacity=5, storage=token_bucket_storage())
+    concurrency_limits = ConcurrencyLimits.from_config()
+    rate_controller: Optional[RateController] = None
 
 
 class TokenRefreshUpdate(BaseModel):
     """Stores the refresh rate of the token bucket"""
 
     rate: float
+
+
+class RateControllerState(BaseModel):
+    """Stores the current rates of the token bucket's keys, and why they were last adjusted"""
+
+    rates: dict[str, float]
+    reasons: dict[str, str]
+    min_rate: float
+    max_rate: float
+    pending_jobs: int
+
+
+class ConcurrencyLimitsUpdate(BaseModel):
+    """Stores new limits for some archives or stages, None for no limit"""
+
+    limits: dict[str, Optional[PositiveInt]]
+
+
+class ConcurrencyLimitsState(BaseModel):
+    """Stores the limit of each archive and stage, and how many messages are in each"""
+
+    limits: dict[str, Optional[int]]
+    in_use: dict[str, int]
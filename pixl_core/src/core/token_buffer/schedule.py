@@ -0,0 +1,104 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Time-of-day schedules for token bucket rates."""
+
+from __future__ import annotations
+
+import datetime
+from typing import TYPE_CHECKING, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+import yaml
+from decouple import config
+from loguru import logger
+from pydantic import BaseModel, Field, field_validator
+
+if TYPE_CHECKING:
+    from pathlib import Path
+
+
+class RateWindow(BaseModel):
+    """
+    A time window with its own rate and limit on messages in flight.
+
+    The window is active from `start` until `end` on the given `days` (0 is Monday), and runs
+    overnight if `end` is before `start`. With the default start and end it lasts all day.
+    """
+
+    rate: float = Field(ge=0)
+    max_in_flight: Optional[int] = Field(default=None, ge=1)
+    days: list[int] = Field(default=list(range(7)))
+    start: datetime.time = datetime.time(0, 0)
+    end: datetime.time = datetime.time(0, 0)
+
+    @field_validator("days")
+    @classmethod
+    def _valid_days(cls, days: list[int]) -> list[int]:
+        if any(day not in range(7) for day in days):
+            msg = f"Days must be from 0 (Monday) to 6 (Sunday), not {days}"
+            raise ValueError(msg)
+        return days
+
+    def is_active(self, now: datetime.datetime) -> bool:
+        """Is this window active at the given local time?"""
+        if now.weekday() not in self.days:
+            return False
+        time = now.time()
+        if self.start < self.end:
+            return self.start <= time < self.end
+        return time >= self.start or time < self.end
+
+
+class RateSchedule(BaseModel):
+    """
+    Rate windows for each token bucket key, the first active window for a key applies.
+
+    Times are in `timezone`, which defaults to the TZ environment variable when the schedule is
+    loaded.
+    """
+
+    timezone: str = Field(default=None, validate_default=True)
+    queues: dict[str, list[RateWindow]] = Field(default_factory=dict)
+
+    @field_validator("timezone", mode="before")
+    @classmethod
+    def _valid_timezone(cls, timezone: Optional[str]) -> Optional[str]:
+        if timezone is None:
+            timezone = str(config("TZ", default="UTC"))
+        if not isinstance(timezone, str):
+            # Rejected as not a string
+            return timezone
+        try:
+            ZoneInfo(timezone)
+        except (ZoneInfoNotFoundError, ValueError) as error:
+            msg = f"Unknown timezone '{timezone}'"
+            raise ValueError(msg) from error
+        return timezone
+
+    def active_window(
+        self, key: str, now: Optional[datetime.datetime] = None
+    ) -> Optional[RateWindow]:
+        """The window which applies to a key now, or None if no windows are active."""
+        if now is None:
+            now = datetime.datetime.now(tz=ZoneInfo(self.timezone))
+        return next((window for window in self.queues.get(key, []) if window.is_active(now)), None)
+
+
+def load_rate_schedule(filename: Path) -> RateSchedule:
+    """
+    Load a rate schedule from a yaml file.
+    :param filename: Path to the yaml file
+    """
+    logger.debug("Loading rate schedule from {}", filename)
+    return RateSchedule.model_validate(yaml.safe_load(filename.read_text()))
@@ -0,0 +1,235 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Storage for token bucket tokens, either in memory or shared through the PIXL database."""
+
+from __future__ import annotations
+
+import time
+from typing import TYPE_CHECKING, Optional
+
+import token_bucket as tb
+from decouple import config
+from sqlalchemy import case, delete, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from core.db.models import TokenBucketRate, TokenBucketState
+
+if TYPE_CHECKING:
+    from sqlalchemy import Engine
+
+STORAGE_TYPES = ("memory", "database")
+
+# Key of the rate used by every key without a rate of its own
+BASE_RATE_KEY = "*"
+
+
+class DatabaseStorage(tb.StorageBase):
+    """
+    Tokens held in the `token_bucket` table, so that every worker shares the same buckets.
+
+    Each method is a single conditional statement, so concurrent workers can't take the same
+    token or add the same tokens twice. Times are wall-clock seconds since the epoch, as they
+    are compared across processes.
+
+    The rates are held in the `token_bucket_rate` table, so that a rate set through any worker
+    is used by every worker to replenish the buckets.
+    """
+
+    def __init__(self, engine: Engine) -> None:
+        """Storage using the given database engine."""
+        self._engine = engine
+
+    def get_token_count(self, key: str) -> float:
+        """Tokens in the bucket when it was last replenished, zero if it doesn't exist yet."""
+        with self._engine.connect() as connection:
+            tokens = connection.scalar(
+                select(TokenBucketState.tokens).where(TokenBucketState.key == key)
+            )
+        return float(tokens) if tokens is not None else 0.0
+
+    def replenish(self, key: str, rate: float, capacity: int) -> None:
+        """Add the tokens due since the bucket was last replenished, creating a full bucket."""
+        now = time.time()
+        refilled = TokenBucketState.tokens + (now - TokenBucketState.replenished_at) * rate
+        with self._engine.begin() as connection:
+            result = connection.execute(
+                update(TokenBucketState)
+                .where(TokenBucketState.key == key, TokenBucketState.replenished_at < now)
+                .values(
+                    tokens=case((refilled > capacity, capacity), else_=refilled),
+                    replenished_at=now,
+                )
+            )
+        if result.rowcount:
+            return
+
+        # Either the bucket doesn't exist yet, or another worker has just replenished it
+        try:
+            with self._engine.begin() as connection:
+                connection.execute(
+                    insert(TokenBucketState).values(
+                        key=key, tokens=float(capacity), replenished_at=now
+                    )
+                )
+        except IntegrityError:
+            pass
+
+    def consume(self, key: str, num_tokens: int) -> bool:
+        """Take tokens from the bucket if it has enough, returning whether they were taken."""
+        with self._engine.begin() as connection:
+            result = connection.execute(
+                update(TokenBucketState)
+                .where(TokenBucketState.key == key, TokenBucketState.tokens >= num_tokens)
+                .values(tokens=TokenBucketState.tokens - num_tokens)
+            )
+        return bool(result.rowcount == 1)
+
+    def get_rates(self, key: str) -> tuple[Optional[float], Optional[float]]:
+        """The base rate and the rate set for the key, each None if it hasn't been set."""
+        with self._engine.connect() as connection:
+            rates: dict[str, float] = dict(
+                connection.execute(
+                    select(TokenBucketRate.key, TokenBucketRate.rate).where(
+                        TokenBucketRate.key.in_([key, BASE_RATE_KEY])
+                    )
+                )
+                .tuples()
+                .all()
+            )
+        return rates.get(BASE_RATE_KEY), rates.get(key)
+
+    def set_rate(self, key: str, rate: Optional[float]) -> None:
+        """Set the rate for the key only, or with None go back to using the base rate."""
+        if rate is None:
+            with self._engine.begin() as connection:
+                connection.execute(delete(TokenBucketRate).where(TokenBucketRate.key == key))
+            return
+
+        with self._engine.begin() as connection:
+            result = connection.execute(
+                update(TokenBucketRate).where(TokenBucketRate.key == key).values(rate=rate)
+            )
+        if result.rowcount:
+            return
+
+        try:
+            with self._engine.begin() as connection:
+                connection.execute(insert(TokenBucketRate).values(key=key, rate=rate))
+        except IntegrityError:
+            # Another worker has just set a rate for the key, this one is the latest
+            with self._engine.begin() as connection:
+                connection.execute(
+                    update(TokenBucketRate).where(TokenBucketRate.key == key).values(rate=rate)
+                )
+
+    def adjust_rate(self, key: str, rate: float, interval: float) -> bool:
+        """
+        Set the rate for the key as an adjustment, unless it was adjusted within `interval` seconds.
+
+        :returns: whether the rate was set, False if another worker has just adjusted it
+        """
+        now = time.time()
+        # Allow for each worker's adjustments being timed slightly differently
+        adjusted_before = now - 0.9 * interval
+        with self._engine.begin() as connection:
+            result = connection.execute(
+                update(TokenBucketRate)
+                .where(
+                    TokenBucketRate.key == key,
+                    or_(
+                        TokenBucketRate.adjusted_at.is_(None),
+                        TokenBucketRate.adjusted_at <= adjusted_before,
+                    ),
+                )
+                .values(rate=rate, adjusted_at=now)
+            )
+        if result.rowcount:
+            return True
+
+        # Either the key has no rate of its own yet, or it has just been adjusted
+        try:
+            with self._engine.begin() as connection:
+                connection.execute(
+                    insert(TokenBucketRate).values(key=key, rate=rate, adjusted_at=now)
+                )
+        except IntegrityError:
+            return False
+        return True
+
+    def set_scheduled_rate(
+        self, key: str, window: Optional[str], rate: Optional[float] = None
+    ) -> None:
+        """
+        Set the rate of the schedule's window which is now active for the key, or with no window,
+        clear the rate set by the previous window.
+
+        Nothing is changed if the key's rate was already set by the same window, so that a worker
+        starting up doesn't replace a rate set since the window became active.
+        """
+        if window is None:
+            with self._engine.begin() as connection:
+                connection.execute(
+                    delete(TokenBucketRate).where(
+                        TokenBucketRate.key == key, TokenBucketRate.scheduled_window.is_not(None)
+                    )
+                )
+            return
+
+        with self._engine.begin() as connection:
+            result = connection.execute(
+                update(TokenBucketRate)
+                .where(
+                    TokenBucketRate.key == key,
+                    or_(
+                        TokenBucketRate.scheduled_window.is_(None),
+                        TokenBucketRate.scheduled_window != window,
+                    ),
+                )
+                .values(rate=rate, scheduled_window=window)
+            )
+        if result.rowcount:
+            return
+
+        # Either the key has no rate of its own yet, or the window has already set it
+        try:
+            with self._engine.begin() as connection:
+                connection.execute(
+                    insert(TokenBucketRate).values(key=key, rate=rate, scheduled_window=window)
+                )
+        except IntegrityError:
+            pass
+
+    def set_base_rate(self, rate: float) -> None:
+        """Set the base rate, replacing the rates set for individual keys."""
+        with self._engine.begin() as connection:
+            connection.execute(delete(TokenBucketRate).where(TokenBucketRate.key != BASE_RATE_KEY))
+        self.set_rate(BASE_RATE_KEY, rate)
+
+
+def token_bucket_storage() -> tb.StorageBase:
+    """
+    Storage for the token bucket set by `PIXL_TOKEN_BUCKET_STORAGE`.
+
+    "memory" (the default) limits the rate of this process only, "database" shares the tokens
+    with every worker using the same PIXL database.
+    """
+    storage_type: str = config("PIXL_TOKEN_BUCKET_STORAGE", default="memory")
+    if storage_type not in STORAGE_TYPES:
+        msg = f"PIXL_TOKEN_BUCKET_STORAGE must be one of {STORAGE_TYPES}, not '{storage_type}'"
+        raise ValueError(msg)
+    if storage_type == "database":
+        from core.db.queries import engine
+
+        return DatabaseStorage(engine)
+    return tb.MemoryStorage()
@@ -14,9 +14,20 @@
 #  limitations under the License.
 from __future__ import annotations
 
+import asyncio
 import typing
+from time import monotonic
 
 import token_bucket as tb
+from loguru import logger
+
+from core.token_buffer.storage import BASE_RATE_KEY, DatabaseStorage
+
+if typing.TYPE_CHECKING:
+    from core.token_buffer.schedule import RateSchedule, RateWindow
+
+# Longest time to sleep while waiting for a token, so that rate changes are picked up
+MAX_TOKEN_WAIT_INTERVAL = 1.0
 
 
 class TokenBucket(tb.Limiter):
@@ -30,6 +41,15 @@ class TokenBucket(tb.Limiter):
     different "streams", which are specified by a string object, also called key. This
     key has been hard coded here to accept one of two values: 'primary' or 'secondary',
     representing two different streams.
+
+    Each key uses the bucket's rate, unless given its own rate with `set_key_rate()`. If the
+    bucket has a rate schedule, a key's rate is set whenever a different window of the schedule
+    becomes active for it, and lasts until the next change of window. A bucket rate of zero
+    stops every key, whatever its own or scheduled rate, and setting the bucket's rate applies
+    the schedule again.
+
+    With a `DatabaseStorage`, the rates are also kept in the database, so that a rate set through
+    any worker is used by every worker sharing the buckets.
     """
 
     _keys: typing.ClassVar = ["primary", "secondary"]
@@ -38,6 +58,7 @@ class TokenBucket(tb.Limiter):
         self,
         rate: float = 5,
         capacity: int = 5,
+        storage: typing.Optional[tb.StorageBase] = None,
     ) -> None:
         """
         Uses the token bucket implementation from `Falconry`
@@ -46,7 +67,7 @@ class TokenBucket(tb.Limiter):
 
         :param rate: The number of tokens added per second
         :param capacity: The maximum number of tokens in the bucket at any point in time
-        :param storage: Type of storage used to hold the tokens
+        :param storage: Type of storage used to hold the tokens, in memory by default
         """
         self._zero_rate = False
 
@@ -54,19 +75,182 @@ class TokenBucket(tb.Limiter):
             rate = 1  # tb.Limiter does not allow zero rates, so keep track...
             self._zero_rate = True
 
-        super().__init__(rate=rate, capacity=capacity, storage=tb.MemoryStorage())
+        super().__init__(rate=rate, capacity=capacity, storage=storage or tb.MemoryStorage())
+        self._key_rates: dict[str, float] = {}
+        self._schedule: typing.Optional[RateSchedule] = None
+        self._active_windows: dict[str, typing.Optional[RateWindow]] = {}
+        self._shared_rates = storage if isinstance(storage, DatabaseStorage) else None
 
     def has_token(self, key: str) -> bool:
         """Does this token bucket have a token for the given key?"""
+        rate = self.key_rate(key)
+        if rate == 0:
+            return False
+        self._storage.replenish(key, rate, self._capacity)
+        return bool(self._storage.consume(key, 1))
+
+    async def take_token(self, key: str) -> bool:
+        """
+        Take a token for the given key if there is one, see `has_token()`.
+
+        The storage is used from a worker thread, as a database storage makes round trips which
+        would otherwise block the event loop.
+        """
+        return await asyncio.to_thread(self.has_token, key)
+
+    def token_count(self, key: str) -> float:
+        """Number of tokens currently in the bucket for the given key, without taking one"""
+        rate = self.key_rate(key)
+        if rate > 0:
+            self._storage.replenish(key, rate, self._capacity)
+        return float(self._storage.get_token_count(key))
+
+    @property
+    def keys(self) -> list[str]:
+        """Keys of the streams which this token bucket limits"""
+        return list(self._keys)
+
+    def key_rate(self, key: str) -> float:
+        """Rate in items per second for the given key"""
+        self._check_key(key)
+        self._apply_schedule(key)
+        base_rate, key_rate = self._rates(key)
+        if base_rate == 0:
+            # Stopped by the operator
+            return 0
+        return key_rate if key_rate is not None else base_rate
+
+    def _rates(self, key: str) -> tuple[float, typing.Optional[float]]:
+        """The bucket's rate and the key's own rate, if it has one."""
+        if self._shared_rates is None:
+            return self._local_rate, self._key_rates.get(key)
+        base_rate, key_rate = self._shared_rates.get_rates(key)
+        return base_rate if base_rate is not None else self._local_rate, key_rate
+
+    @property
+    def _local_rate(self) -> float:
+        return 0 if self._zero_rate else float(self._rate)
+
+    def scheduled_rate(self, key: str) -> typing.Optional[float]:
+        """Rate of the schedule's window which is active for the given key, if any"""
+        self._check_key(key)
+        window = self._apply_schedule(key)
+        return window.rate if window is not None else None
+
+    def max_in_flight(self, key: str) -> typing.Optional[int]:
+        """Maximum number of messages in flight for the given key set by the schedule, if any"""
+        self._check_key(key)
+        if self._schedule is None:
+            return None
+        # Only reads the schedule, so that it can be called from the event loop
+        window = self._schedule.active_window(key)
+        return window.max_in_flight if window is not None else None
+
+    @property
+    def schedule(self) -> typing.Optional[RateSchedule]:
+        """Time-of-day schedule of rates for each key"""
+        return self._schedule
+
+    @schedule.setter
+    def schedule(self, schedule: typing.Optional[RateSchedule]) -> None:
+        self._schedule = schedule
+        self._active_windows.clear()
+
+    def _apply_schedule(self, key: str) -> typing.Optional[RateWindow]:
+        """Set the key's rate if a different window of the schedule is now active."""
+        if self._schedule is None:
+            return None
+        window = self._schedule.active_window(key)
+        if key in self._active_windows and window is self._active_windows[key]:
+            return window
+
+        self._active_windows[key] = window
+        if window is None:
+            logger.info("No scheduled rate window for {}, using rate {}", key, self.rate)
+            self._key_rates.pop(key, None)
+        else:
+            logger.info("Scheduled rate window for {} started, using rate {}", key, window.rate)
+            self._key_rates[key] = window.rate
+        if self._shared_rates is not None:
+            self._shared_rates.set_scheduled_rate(
+                key,
+                window.model_dump_json() if window is not None else None,
+                self._key_rates.get(key),
+            )
+        return window
+
+    def set_key_rate(self, key: str, rate: float) -> None:
+        """Set the rate in items per second for the given key only, zero to stop it."""
+        self._check_key(key)
+        if rate < 0:
+            msg = f"Rate must not be negative, not {rate}"
+            raise ValueError(msg)
+        self._key_rates[key] = float(rate)
+        if self._shared_rates is not None:
+            self._shared_rates.set_rate(key, float(rate))
+
+    def adjust_key_rate(self, key: str, rate: float, interval: float) -> bool:
+        """
+        Set the rate for the given key as an automatic adjustment made every `interval` seconds.
+
+        With a `DatabaseStorage`, the rate isn't set if a worker has adjusted it within the
+        interval, so that the key is adjusted once per interval however many workers there are.
+
+        :returns: whether the rate was set
+        """
+        if self._shared_rates is None:
+            self.set_key_rate(key, rate)
+            return True
+        self._check_key(key)
+        if not self._shared_rates.adjust_rate(key, float(rate), interval):
+            return False
+        self._key_rates[key] = float(rate)
+        return True
+
+    def _check_key(self, key: str) -> None:
         if key not in self._keys:
             message = f"Key must be one of {self._keys}, not '{key}'"
             raise ValueError(message)
-        return not self._zero_rate and bool(self.consume(key))
+
+    async def wait_for_token(self, key: str, timeout: typing.Optional[float] = None) -> bool:
+        """
+        Wait until this token bucket has a token for the given key, and take it.
+
+        Rather than polling, sleeps until the next token is due to be added to the bucket
+        (but no longer than a second, in case the rate changes). The storage is used from a
+        worker thread, as for `take_token()`.
+
+        :param timeout: Maximum number of seconds to wait, or None to wait indefinitely
+        :returns: True if a token was taken, False if none was available before the timeout
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        while (delay := await asyncio.to_thread(self._take_token_or_delay, key)) is not None:
+            if deadline is not None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+            await asyncio.sleep(delay)
+        return True
+
+    def _take_token_or_delay(self, key: str) -> typing.Optional[float]:
+        """Take a token, or if there isn't one, return how long until the next is due."""
+        if self.has_token(key):
+            return None
+        return self._time_to_next_token(key)
+
+    def _time_to_next_token(self, key: str) -> float:
+        rate = self.key_rate(key)
+        if rate == 0:
+            return MAX_TOKEN_WAIT_INTERVAL
+        # has_token() has just replenished the bucket, so the count is up to date
+        missing_tokens = 1 - float(self._storage.get_token_count(key))
+        return min(max(missing_tokens / rate, 0.001), MAX_TOKEN_WAIT_INTERVAL)
 
     @property
     def rate(self) -> float:
-        """Rate in items per second"""
-        return 0 if self._zero_rate else float(self._rate)
+        """Rate in items per second, setting it replaces any rates set for individual keys"""
+        return self._rates(BASE_RATE_KEY)[0]
 
     @rate.setter
     def rate(self, value: float) -> None:
@@ -74,8 +258,12 @@ class TokenBucket(tb.Limiter):
             msg = "Cannot set the rate with a non integer value"
             raise TypeError(msg)
 
+        self._key_rates.clear()
+        self._active_windows.clear()
         if value == 0:
             self._zero_rate = True
         else:
             self._zero_rate = False
             self._rate = value
+        if self._shared_rates is not None:
+            self._shared_rates.set_base_rate(value)
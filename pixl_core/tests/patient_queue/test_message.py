@@ -13,6 +13,8 @@
 #  limitations under the License.
 from __future__ import annotations
 
+import jsonpickle
+import pytest
 from core.patient_queue.message import deserialise
 
 
@@ -32,3 +34,35 @@ def test_deserialise(mock_message) -> None:
     """Checks if deserialised messages are the same as the original"""
     serialised_msg = mock_message.serialise()
     assert deserialise(serialised_msg) == mock_message
+
+
+def test_serialise_compact(mock_message) -> None:
+    """Checks that messages are serialised as compact JSON with a format version"""
+    assert mock_message.serialise() == (
+        b'{"v":1,"mrn":"111","accession_number":"123","study_uid":"1.2.3",'
+        b'"study_date":"2022-11-22","procedure_occurrence_id":"234",'
+        b'"project_name":"test project","extract_generated_timestamp":"2023-12-07T14:08:00+00:00"}'
+    )
+
+
+def test_deserialise_legacy(mock_message) -> None:
+    """Checks that messages serialised with jsonpickle can still be deserialised"""
+    assert deserialise(jsonpickle.encode(mock_message).encode()) == mock_message
+
+
+def test_deserialise_legacy_rejects_other_types(mock_message) -> None:
+    """Checks that legacy messages can't create objects other than a Message and its dates"""
+    serialised_msg = jsonpickle.encode(mock_message).replace(
+        '"py/type": "datetime.date"', '"py/type": "os.system"'
+    )
+
+    with pytest.raises(ValueError, match="Unexpected type os.system"):
+        deserialise(serialised_msg.encode())
+
+
+def test_deserialise_unknown_version(mock_message) -> None:
+    """Checks that messages in a newer format aren't misread"""
+    serialised_msg = mock_message.serialise().replace(b'"v":1', b'"v":2')
+
+    with pytest.raises(ValueError, match="Unsupported message format version 2"):
+        deserialise(serialised_msg)
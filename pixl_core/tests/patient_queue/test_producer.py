@@ -13,8 +13,12 @@
 #  limitations under the License.
 from __future__ import annotations
 
+import asyncio
+from unittest.mock import MagicMock
+
 import pytest
-from core.patient_queue.producer import PixlProducer
+from aio_pika.exceptions import ChannelInvalidStateError, DeliveryError
+from core.patient_queue.producer import PixlBulkProducer, PixlProducer
 
 TEST_QUEUE = "test_publish"
 
@@ -38,3 +42,80 @@ def test_publish(mock_message) -> None:
 
     with PixlProducer(queue_name=TEST_QUEUE) as pp:
         assert pp.message_count == 1
+
+
+class FakeConfirmingExchange:
+    """Exchange which confirms publishes after a short delay, unless told to fail them."""
+
+    def __init__(self, failures: int, error: Exception | None = None) -> None:
+        """Fail the first `failures` publishes, with `error` if given."""
+        self.failures = failures
+        self.error = error
+        self.attempts = 0
+        self.outstanding = 0
+        self.max_outstanding = 0
+
+    async def publish(self, message, routing_key) -> None:  # noqa: ARG002 only count attempts
+        """Wait for a confirmation, raising an error if the publish fails."""
+        self.attempts += 1
+        fail = self.failures > 0
+        self.failures -= 1
+        self.outstanding += 1
+        self.max_outstanding = max(self.max_outstanding, self.outstanding)
+        await asyncio.sleep(0.01)
+        self.outstanding -= 1
+        if fail:
+            raise self.error or DeliveryError(None, None)
+
+
+@pytest.mark.asyncio()
+async def test_bulk_publish_retries_with_window(mock_message) -> None:
+    """
+    Given a bulk producer with a window of two, and a broker which doesn't confirm one publish
+    When nine messages are published
+    Then at most two publishes wait for confirmation at once, and the unconfirmed one is retried
+    """
+    producer = PixlBulkProducer(TEST_QUEUE, window=2, max_retries=1)
+    exchange = FakeConfirmingExchange(failures=1)
+    producer._channel = MagicMock(default_exchange=exchange)  # noqa: SLF001
+
+    stats = await producer.publish([mock_message] * 9, priority=1)
+
+    assert (stats.published, stats.failed) == (9, 0)
+    assert exchange.attempts == 10
+    assert exchange.max_outstanding == 2
+
+
+@pytest.mark.asyncio()
+async def test_bulk_publish_counts_failures(mock_message) -> None:
+    """
+    Given a bulk producer, and a broker which never confirms publishes
+    When a message is published
+    Then it is retried and then counted as failed
+    """
+    producer = PixlBulkProducer(TEST_QUEUE, max_retries=2)
+    exchange = FakeConfirmingExchange(failures=10)
+    producer._channel = MagicMock(default_exchange=exchange)  # noqa: SLF001
+
+    stats = await producer.publish([mock_message], priority=1)
+
+    assert (stats.published, stats.failed) == (0, 1)
+    assert exchange.attempts == 3
+
+
+@pytest.mark.asyncio()
+async def test_bulk_publish_cancels_pending_on_error(mock_message) -> None:
+    """
+    Given a bulk producer, and a channel which is closed during the first publish
+    When messages are published
+    Then the error is raised, and the publishes still waiting for confirmation are cancelled
+    """
+    producer = PixlBulkProducer(TEST_QUEUE, window=3)
+    exchange = FakeConfirmingExchange(failures=1, error=ChannelInvalidStateError("closed"))
+    producer._channel = MagicMock(default_exchange=exchange)  # noqa: SLF001
+
+    with pytest.raises(ChannelInvalidStateError):
+        await producer.publish([mock_message] * 9, priority=1)
+
+    assert asyncio.all_tasks() == {asyncio.current_task()}
+    assert exchange.attempts < 9
@@ -14,11 +14,13 @@
 from __future__ import annotations
 
 import asyncio
-from unittest.mock import AsyncMock
+from unittest.mock import AsyncMock, MagicMock
 
 import pytest
+from core.exceptions import PixlRequeueMessageError, PixlStudyNotInPrimaryArchiveError
 from core.patient_queue.producer import PixlProducer
 from core.patient_queue.subscriber import PixlConsumer
+from core.token_buffer.schedule import RateSchedule, RateWindow
 from core.token_buffer.tokens import TokenBucket
 
 TEST_QUEUE = "test_consume"
@@ -57,3 +59,189 @@ async def test_create(mock_message) -> None:
         consume.assert_called_once()
     # Fail on purpose to check async test awaited
     raise ExpectedTestError
+
+
+@pytest.mark.asyncio()
+async def test_consumer_waits_for_token(mock_message, monkeypatch) -> None:
+    """
+    Given a consumer which waits for tokens, with an empty token bucket
+    When a message is consumed
+    Then the message is processed once the bucket refills, without being requeued
+    """
+    monkeypatch.setenv("PIXL_WAIT_FOR_TOKENS", "true")
+    token_bucket = TokenBucket(rate=10, capacity=1)
+    assert token_bucket.has_token(key="primary")
+    consume = AsyncMock()
+    consumer = PixlConsumer(
+        queue_name=TEST_QUEUE,
+        token_bucket=token_bucket,
+        token_bucket_key="primary",  # noqa: S106
+        callback=consume,
+    )
+    message = AsyncMock(body=mock_message.serialise())
+
+    await consumer._process_message(message)  # noqa: SLF001
+
+    consume.assert_awaited_once()
+    message.ack.assert_awaited_once()
+    message.reject.assert_not_awaited()
+
+
+@pytest.mark.asyncio()
+async def test_consumer_limits_messages_in_flight(mock_message) -> None:
+    """
+    Given a consumer whose rate schedule allows one message in flight
+    When a second message arrives while the first is being processed
+    Then the second message is requeued without being processed
+    """
+    token_bucket = TokenBucket(rate=100)
+    token_bucket.schedule = RateSchedule(
+        queues={"primary": [RateWindow(rate=100, max_in_flight=1)]}
+    )
+    processing = asyncio.Event()
+    finish = asyncio.Event()
+
+    async def consume(_message) -> None:
+        processing.set()
+        await finish.wait()
+
+    consumer = PixlConsumer(
+        queue_name=TEST_QUEUE,
+        token_bucket=token_bucket,
+        token_bucket_key="primary",  # noqa: S106
+        callback=consume,
+    )
+    first, second = (AsyncMock(body=mock_message.serialise()) for _ in range(2))
+
+    task = asyncio.create_task(consumer._process_message(first))  # noqa: SLF001
+    await processing.wait()
+    await consumer._process_message(second)  # noqa: SLF001
+    finish.set()
+    await task
+
+    first.ack.assert_awaited_once()
+    second.reject.assert_awaited_once_with(requeue=True)
+
+
+@pytest.mark.asyncio()
+async def test_consumer_paused_outside_window() -> None:
+    """
+    Given a consumer with an active window
+    When the window opens, closes and then opens again
+    Then the consumer starts consuming, is cancelled, and then resumes consuming
+    """
+    active = True
+    consumer = PixlConsumer(
+        queue_name=TEST_QUEUE,
+        token_bucket=TokenBucket(),
+        token_bucket_key="primary",  # noqa: S106
+        callback=AsyncMock(),
+        is_active=lambda: active,
+    )
+    consumer._queue = AsyncMock()  # noqa: SLF001
+    consumer._queue.consume.side_effect = ["tag-1", "tag-2"]  # noqa: SLF001
+
+    await consumer._update_consuming()  # noqa: SLF001
+    await consumer._update_consuming()  # noqa: SLF001
+    assert consumer._queue.consume.await_count == 1  # noqa: SLF001
+
+    active = False
+    await consumer._update_consuming()  # noqa: SLF001
+    consumer._queue.cancel.assert_awaited_once_with("tag-1")  # noqa: SLF001
+
+    active = True
+    await consumer._update_consuming()  # noqa: SLF001
+    assert consumer._queue.consume.await_count == 2  # noqa: SLF001
+
+
+@pytest.mark.asyncio()
+async def test_not_in_primary_republished_on_consumer_connection(mock_message) -> None:
+    """
+    Given a consumer whose callback finds the study isn't in the primary archive
+    When a message is consumed
+    Then it is published to the secondary queue on the consumer's connection, and then rejected
+    """
+    consumer = PixlConsumer(
+        queue_name=TEST_QUEUE,
+        token_bucket=TokenBucket(),
+        token_bucket_key="primary",  # noqa: S106
+        callback=AsyncMock(side_effect=PixlStudyNotInPrimaryArchiveError("not found")),
+    )
+    channel = MagicMock(is_closed=False, declare_queue=AsyncMock())
+    channel.default_exchange.publish = AsyncMock()
+    consumer._connection = MagicMock(channel=AsyncMock(return_value=channel))  # noqa: SLF001
+    message = AsyncMock(body=mock_message.serialise(), priority=3)
+
+    await consumer._process_message(message)  # noqa: SLF001
+
+    channel.default_exchange.publish.assert_awaited_once()
+    (published,) = channel.default_exchange.publish.await_args.args
+    assert published.body == message.body
+    assert published.priority == 3
+    assert channel.default_exchange.publish.await_args.kwargs["routing_key"] == "imaging-secondary"
+    message.reject.assert_awaited_once_with(requeue=False)
+
+
+def _retrying_consumer(monkeypatch) -> tuple[PixlConsumer, MagicMock]:
+    """Consumer with retry queues whose callback always asks for a retry, and its channel."""
+    monkeypatch.setenv("PIXL_RETRY_MAX_ATTEMPTS", "3")
+    monkeypatch.setenv("PIXL_RETRY_BASE_DELAY", "10")
+    consumer = PixlConsumer(
+        queue_name=TEST_QUEUE,
+        token_bucket=TokenBucket(),
+        token_bucket_key="primary",  # noqa: S106
+        callback=AsyncMock(side_effect=PixlRequeueMessageError("try again")),
+    )
+    channel = MagicMock(is_closed=False, declare_queue=AsyncMock())
+    channel.default_exchange.publish = AsyncMock()
+    consumer._connection = MagicMock(channel=AsyncMock(return_value=channel))  # noqa: SLF001
+    return consumer, channel
+
+
+@pytest.mark.asyncio()
+async def test_requeued_message_sent_to_retry_queue(mock_message, monkeypatch) -> None:
+    """
+    Given a consumer with retry queues, and a message which has been retried once
+    When the message needs to be retried again
+    Then it is published to the second retry queue with a backoff, and acknowledged
+    """
+    consumer, channel = _retrying_consumer(monkeypatch)
+    message = AsyncMock(body=mock_message.serialise(), priority=1, headers={"x-pixl-attempt": 1})
+
+    await consumer._process_message(message)  # noqa: SLF001
+
+    published = channel.default_exchange.publish.await_args.args[0]
+    assert channel.default_exchange.publish.await_args.kwargs["routing_key"] == (
+        f"{TEST_QUEUE}-retry-1"
+    )
+    assert published.headers == {"x-pixl-attempt": 2}
+    assert published.expiration is None
+    channel.declare_queue.assert_awaited_once_with(
+        f"{TEST_QUEUE}-retry-1",
+        durable=True,
+        arguments={
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": TEST_QUEUE,
+            "x-message-ttl": 20000,
+        },
+    )
+    message.ack.assert_awaited_once()
+    message.reject.assert_not_awaited()
+
+
+@pytest.mark.asyncio()
+async def test_requeued_message_parked_after_max_attempts(mock_message, monkeypatch) -> None:
+    """
+    Given a consumer with three retry attempts, and a message which has been retried three times
+    When the message needs to be retried again
+    Then it is parked and acknowledged
+    """
+    consumer, channel = _retrying_consumer(monkeypatch)
+    message = AsyncMock(body=mock_message.serialise(), priority=1, headers={"x-pixl-attempt": 3})
+
+    await consumer._process_message(message)  # noqa: SLF001
+
+    assert channel.default_exchange.publish.await_args.kwargs["routing_key"] == (
+        f"{TEST_QUEUE}-parked"
+    )
+    message.ack.assert_awaited_once()
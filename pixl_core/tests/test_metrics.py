@@ -0,0 +1,97 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests for the metrics registry."""
+
+from __future__ import annotations
+
+import pytest
+from core.metrics import Histogram, MetricsRegistry
+
+
+def test_render_counter_and_gauge() -> None:
+    """
+    Given a registry with a counter and a gauge
+    When they are updated and the registry rendered
+    Then each labelled value is in the Prometheus text format
+    """
+    registry = MetricsRegistry()
+    counter = registry.counter("test_total", "A counter", ["outcome"])
+    gauge = registry.gauge("test_level", "A gauge")
+
+    counter.inc(outcome="success")
+    counter.inc(2, outcome='say "hi"')
+    gauge.set(5)
+    gauge.dec()
+
+    assert registry.render() == (
+        "# HELP test_total A counter\n"
+        "# TYPE test_total counter\n"
+        'test_total{outcome="success"} 1\n'
+        'test_total{outcome="say \\"hi\\""} 2\n'
+        "# HELP test_level A gauge\n"
+        "# TYPE test_level gauge\n"
+        "test_level 4\n"
+    )
+
+
+def test_histogram_buckets() -> None:
+    """
+    Given a histogram with buckets up to 1 and 10
+    When values are observed
+    Then the buckets are cumulative, with the sum and count of all values
+    """
+    histogram = Histogram("test_seconds", "A histogram", ["stage"], buckets=[1, 10])
+
+    for value in (0.5, 5, 50):
+        histogram.observe(value, stage="c-move")
+
+    assert histogram.render()[2:] == [
+        'test_seconds_bucket{stage="c-move",le="1"} 1',
+        'test_seconds_bucket{stage="c-move",le="10"} 2',
+        'test_seconds_bucket{stage="c-move",le="+Inf"} 3',
+        'test_seconds_sum{stage="c-move"} 55.5',
+        'test_seconds_count{stage="c-move"} 3',
+    ]
+
+
+def test_histogram_times_errors() -> None:
+    """Time spent in the context is recorded even if it raises an error."""
+    histogram = Histogram("test_seconds", "A histogram", ["stage"])
+
+    with pytest.raises(RuntimeError), histogram.time(stage="hash"):
+        raise RuntimeError
+
+    assert histogram.count(stage="hash") == 1
+
+
+def test_registry_metrics_created_once() -> None:
+    """
+    Given a registry with a counter
+    When the counter is created again, or a gauge with the same name
+    Then the same counter is returned, and the gauge is rejected
+    """
+    registry = MetricsRegistry()
+    counter = registry.counter("test_total", "A counter", ["outcome"])
+
+    assert registry.counter("test_total", "A counter", ["outcome"]) is counter
+    with pytest.raises(ValueError, match="already exists as a counter"):
+        registry.gauge("test_total", "A gauge", ["outcome"])
+
+
+def test_labels_must_match() -> None:
+    """Values must be given for exactly the metric's labels."""
+    counter = MetricsRegistry().counter("test_total", "A counter", ["outcome"])
+
+    with pytest.raises(ValueError, match="needs labels"):
+        counter.inc(queue="imaging-primary")
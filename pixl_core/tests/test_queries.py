@@ -0,0 +1,46 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+from __future__ import annotations
+
+import datetime
+
+from core.db.queries import get_study_progress, update_study_progress
+
+# Study date of the images added by the rows_in_session fixture
+STUDY_DATE = datetime.date.fromisoformat("2023-01-01")
+
+
+def test_study_progress_round_trip(rows_in_session) -> None:
+    """
+    Given images in the database
+    When the progress of one image is updated
+    Then only that image's progress changes
+    """
+    retrieved_at = datetime.datetime(2024, 1, 1, 12, tzinfo=datetime.timezone.utc)
+
+    update_study_progress(
+        "i-am-a-project", "mrn", "234", STUDY_DATE, query_id="query-1", retrieved_at=retrieved_at
+    )
+
+    progress = get_study_progress("i-am-a-project", "mrn", "234", STUDY_DATE)
+    assert progress is not None
+    assert progress["query_id"] == "query-1"
+    assert progress["retrieved_at"].replace(tzinfo=datetime.timezone.utc) == retrieved_at
+    assert progress["sent_at"] is None
+    assert get_study_progress("i-am-a-project", "mrn", "123", STUDY_DATE)["query_id"] is None
+
+
+def test_study_progress_of_unknown_image(rows_in_session) -> None:
+    """Checks that images which aren't in the database have no progress."""
+    assert get_study_progress("another-project", "mrn", "234", STUDY_DATE) is None
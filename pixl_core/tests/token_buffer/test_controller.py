@@ -0,0 +1,119 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+from __future__ import annotations
+
+import pytest
+from core.exceptions import PixlDiscardError, PixlJobFailedError
+from core.token_buffer import TokenBucket
+from core.token_buffer.controller import RateController
+from core.token_buffer.schedule import RateSchedule, RateWindow
+
+
+@pytest.fixture()
+def controller() -> RateController:
+    """Controller for a token bucket with a rate of 1 per second."""
+    return RateController(TokenBucket(rate=1.0), min_rate=0.5, max_rate=1.2, increase=0.1)
+
+
+def test_rate_increased_while_coping(controller) -> None:
+    """
+    Given a controller for a token bucket
+    When the primary archive answers quickly and the secondary isn't used
+    Then only the primary rate is increased, up to the maximum rate
+    """
+    for expected_rate in (1.1, 1.2, 1.2):
+        controller.record_query("primary", 0.5)
+        controller.record_retrieval("primary", 20, success=True)
+
+        rates = controller.adjust()
+
+        assert rates == {"primary": pytest.approx(expected_rate), "secondary": 1.0}
+    assert controller.last_reasons == {"primary": "increase", "secondary": "idle"}
+
+
+@pytest.mark.parametrize(
+    ("record", "pending_jobs"),
+    [
+        (lambda controller: controller.record_query("primary", 60), 0),
+        (lambda controller: controller.record_retrieval("primary", 600, success=True), 0),
+        (lambda controller: controller.record_retrieval("primary", 20, success=False), 0),
+        (lambda _controller: None, 100),
+    ],
+)
+def test_rate_decreased_when_overloaded(controller, record, pending_jobs) -> None:
+    """
+    Given a controller for a token bucket
+    When queries or retrievals are slow, retrievals fail, or there are many pending jobs
+    Then the rate is halved, but not below the minimum rate
+    """
+    record(controller)
+    assert controller.adjust(pending_jobs)["primary"] == pytest.approx(0.5)
+
+    record(controller)
+    assert controller.adjust(pending_jobs)["primary"] == pytest.approx(0.5)
+
+
+def test_only_archive_failures_are_recorded(controller) -> None:
+    """
+    Given a controller for a token bucket
+    When a retrieval is discarded for a reason other than the archive failing it
+    Then the rate isn't decreased, but it is when an Orthanc job fails
+    """
+
+    def retrieve(error: Exception) -> None:
+        with controller.timed_retrieval("primary", failures=(PixlJobFailedError,)):
+            raise error
+
+    with pytest.raises(PixlDiscardError):
+        retrieve(PixlDiscardError("No series in study are wanted by its project"))
+    assert controller.adjust()["primary"] == pytest.approx(1.0)
+
+    with pytest.raises(PixlJobFailedError):
+        retrieve(PixlJobFailedError("Job failed"))
+    assert controller.adjust()["primary"] == pytest.approx(0.5)
+
+
+def test_paused_rate_left_alone(controller) -> None:
+    """
+    Given a controller for a token bucket whose rate the operator has set to zero
+    When the controller adjusts the rates
+    Then the rates stay at zero
+    """
+    controller.token_bucket.rate = 0.0
+    controller.record_query("primary", 0.5)
+
+    assert controller.adjust() == {"primary": 0, "secondary": 0}
+    assert controller.last_reasons["primary"] == "paused"
+
+
+def test_scheduled_rate_is_maximum(controller) -> None:
+    """
+    Given a controller for a token bucket with a scheduled window for the primary archive
+    When the primary archive keeps coping
+    Then its rate is increased up to the window's rate only
+    """
+    controller.token_bucket.schedule = RateSchedule(queues={"primary": [RateWindow(rate=0.7)]})
+    controller.record_query("primary", 0.5)
+    controller.record_retrieval("primary", 20, success=True)
+    controller.adjust(pending_jobs=20)
+
+    for expected_rate in (0.6, 0.7, 0.7):
+        controller.record_query("primary", 0.5)
+        assert controller.adjust()["primary"] == pytest.approx(expected_rate)
+
+
+def test_rate_limits_must_be_ordered() -> None:
+    """Checks that the minimum rate can't be above the maximum."""
+    with pytest.raises(ValueError, match="min_rate <= max_rate"):
+        RateController(TokenBucket(), min_rate=2, max_rate=1)
@@ -0,0 +1,126 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+from core.token_buffer.limits import ConcurrencyLimits, ResizableLimiter
+
+
+async def _hold_until_released(
+    limiter: ResizableLimiter, release: asyncio.Event, holding: list[int]
+) -> None:
+    async with limiter.hold():
+        holding.append(1)
+        await release.wait()
+
+
+@pytest.mark.asyncio()
+async def test_limiter_can_be_raised_while_in_use() -> None:
+    """
+    Given a limiter with a limit of one, and three tasks wanting to hold it
+    When the limit is raised to two
+    Then a second task holds it, and the third still waits
+    """
+    limiter = ResizableLimiter(1)
+    release = asyncio.Event()
+    holding: list[int] = []
+    tasks = [asyncio.create_task(_hold_until_released(limiter, release, holding)) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    assert limiter.in_use == 1
+
+    await limiter.set_limit(2)
+    await asyncio.sleep(0.01)
+    assert limiter.in_use == 2
+
+    release.set()
+    await asyncio.gather(*tasks)
+    assert len(holding) == 3
+    assert limiter.in_use == 0
+
+
+@pytest.mark.asyncio()
+async def test_lowered_limit_applies_to_new_holders() -> None:
+    """
+    Given an unlimited limiter held twice
+    When the limit is lowered to one
+    Then the current holders carry on, and a new one waits until both have finished
+    """
+    limiter = ResizableLimiter()
+    release = asyncio.Event()
+    holding: list[int] = []
+    tasks = [asyncio.create_task(_hold_until_released(limiter, release, holding)) for _ in range(2)]
+    await asyncio.sleep(0.01)
+
+    await limiter.set_limit(1)
+    waiting = asyncio.create_task(_hold_until_released(limiter, asyncio.Event(), holding))
+    await asyncio.sleep(0.01)
+    assert limiter.in_use == 2
+
+    release.set()
+    await asyncio.gather(*tasks)
+    await asyncio.sleep(0.01)
+    assert limiter.in_use == 1
+    waiting.cancel()
+
+
+@pytest.mark.asyncio()
+async def test_limits_are_independent() -> None:
+    """
+    Given limits of one message in c-move
+    When c-move is full
+    Then a message can still enter c-find
+    """
+    limits = ConcurrencyLimits({"c-move": 1})
+
+    async with limits.hold("c-move"):
+        acquired = asyncio.create_task(_enter(limits, "c-move"))
+        await asyncio.sleep(0.01)
+        assert not acquired.done()
+        await asyncio.wait_for(_enter(limits, "c-find"), timeout=1)
+
+    await asyncio.wait_for(acquired, timeout=1)
+    assert limits.in_use["c-move"] == 0
+
+
+async def _enter(limits: ConcurrencyLimits, name: str) -> None:
+    async with limits.hold(name):
+        pass
+
+
+@pytest.mark.asyncio()
+async def test_update_limits() -> None:
+    """Checks limits can be changed by name, and invalid names and limits are rejected."""
+    limits = ConcurrencyLimits({"primary": 10})
+
+    await limits.update({"c-move": 4, "primary": None})
+
+    assert limits.limits["c-move"] == 4
+    assert limits.limits["primary"] is None
+    with pytest.raises(ValueError, match="must be for one of"):
+        await limits.update({"c-echo": 1})
+    with pytest.raises(ValueError, match="at least 1"):
+        await limits.update({"c-move": 0})
+
+
+def test_limits_from_config(monkeypatch) -> None:
+    """Checks each limit is read from its environment variable, with zero for no limit."""
+    monkeypatch.setenv("PIXL_LIMIT_C_MOVE", "3")
+    monkeypatch.setenv("PIXL_LIMIT_SECONDARY", "0")
+
+    limits = ConcurrencyLimits.from_config().limits
+
+    assert limits["c-move"] == 3
+    assert limits["secondary"] is None
@@ -0,0 +1,158 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests for time-of-day rate schedules."""
+
+from __future__ import annotations
+
+import datetime
+
+import pytest
+from core.token_buffer import TokenBucket
+from core.token_buffer.schedule import RateSchedule, RateWindow, load_rate_schedule
+from pydantic import ValidationError
+
+# A Monday
+MONDAY = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+@pytest.mark.parametrize(
+    ("hour", "active"),
+    [(18, False), (19, True), (23, True), (3, True), (7, False), (12, False)],
+)
+def test_overnight_window(hour: int, *, active: bool) -> None:
+    """
+    Given a window from 19:00 to 07:00
+    When checking whether it is active at different times of day
+    Then it is active overnight only
+    """
+    window = RateWindow(rate=10, start=datetime.time(19), end=datetime.time(7))
+
+    assert window.is_active(MONDAY.replace(hour=hour)) is active
+
+
+def test_window_days() -> None:
+    """
+    Given a window at weekends only, lasting all day
+    When checking whether it is active on a Monday and a Saturday
+    Then it is only active on Saturday
+    """
+    window = RateWindow(rate=10, days=[5, 6])
+
+    assert not window.is_active(MONDAY)
+    assert window.is_active(MONDAY + datetime.timedelta(days=5))
+
+
+def test_invalid_days() -> None:
+    """Days outside Monday to Sunday are rejected."""
+    with pytest.raises(ValidationError, match="Days must be from 0"):
+        RateWindow(rate=1, days=[7])
+
+
+def test_first_active_window_applies() -> None:
+    """
+    Given a schedule with an overnight window and an all day window
+    When getting the active window overnight, during the day and for another queue
+    Then the first active window for the queue is used, or None if the queue has no windows
+    """
+    overnight = RateWindow(rate=10, start=datetime.time(19), end=datetime.time(7))
+    all_day = RateWindow(rate=1)
+    schedule = RateSchedule(queues={"primary": [overnight, all_day]})
+
+    assert schedule.active_window("primary", MONDAY.replace(hour=22)) is overnight
+    assert schedule.active_window("primary", MONDAY.replace(hour=12)) is all_day
+    assert schedule.active_window("secondary", MONDAY) is None
+
+
+def test_schedule_sets_key_rate() -> None:
+    """
+    Given a token bucket with a schedule for the primary queue which is always active
+    When the schedule is set, the rate is overridden, and then the schedule is removed
+    Then the window's rate and in-flight limit apply until overridden, then the bucket's own rate
+    """
+    bucket = TokenBucket(rate=1)
+    bucket.schedule = RateSchedule(queues={"primary": [RateWindow(rate=3, max_in_flight=2)]})
+
+    assert bucket.key_rate("primary") == 3
+    assert bucket.max_in_flight("primary") == 2
+    assert bucket.key_rate("secondary") == 1
+    assert bucket.max_in_flight("secondary") is None
+
+    bucket.set_key_rate("primary", 2)
+    assert bucket.key_rate("primary") == 2
+
+    bucket.schedule = None
+    assert bucket.max_in_flight("primary") is None
+
+
+def test_stopped_bucket_ignores_schedule(monkeypatch) -> None:
+    """
+    Given a stopped token bucket with a schedule for the primary queue
+    When a window is active, then the bucket is started and stopped, and then the window changes
+    Then the key only has the scheduled rate while the bucket is started
+    """
+    morning, afternoon = RateWindow(rate=3), RateWindow(rate=7)
+    active = [morning]
+    monkeypatch.setattr(RateSchedule, "active_window", lambda _self, _key: active[0])
+    bucket = TokenBucket(rate=0)
+    bucket.schedule = RateSchedule(queues={"primary": [morning, afternoon]})
+
+    assert bucket.key_rate("primary") == 0
+    assert not bucket.has_token("primary")
+
+    bucket.rate = 1.0
+    assert bucket.key_rate("primary") == 3
+
+    bucket.rate = 0.0
+    active[0] = afternoon
+    assert bucket.key_rate("primary") == 0
+    assert not bucket.has_token("primary")
+
+
+def test_invalid_timezone() -> None:
+    """Timezones which aren't known are rejected."""
+    with pytest.raises(ValidationError, match="Unknown timezone 'Not/AZone'"):
+        RateSchedule(timezone="Not/AZone")
+
+
+def test_default_timezone(monkeypatch) -> None:
+    """The timezone defaults to the TZ environment variable when the schedule is created."""
+    monkeypatch.setenv("TZ", "Europe/London")
+    assert RateSchedule().timezone == "Europe/London"
+
+    monkeypatch.setenv("TZ", "Not/AZone")
+    with pytest.raises(ValidationError, match="Unknown timezone"):
+        RateSchedule()
+
+
+def test_load_rate_schedule(tmp_path) -> None:
+    """Schedules are loaded from yaml, with times given as strings."""
+    schedule_file = tmp_path / "schedule.yaml"
+    schedule_file.write_text(
+        """
+timezone: Europe/London
+queues:
+  primary:
+    - start: "19:00"
+      end: "07:00"
+      rate: 10
+      max_in_flight: 20
+"""
+    )
+
+    schedule = load_rate_schedule(schedule_file)
+
+    assert schedule.timezone == "Europe/London"
+    assert schedule.queues["primary"] == [
+        RateWindow(rate=10, max_in_flight=20, start=datetime.time(19), end=datetime.time(7))
+    ]
@@ -0,0 +1,194 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+from __future__ import annotations
+
+import pytest
+import token_bucket as tb
+from core.db.models import TokenBucketRate, TokenBucketState
+from core.token_buffer import TokenBucket
+from core.token_buffer.controller import RateController
+from core.token_buffer.schedule import RateSchedule, RateWindow
+from core.token_buffer.storage import DatabaseStorage, token_bucket_storage
+from sqlalchemy.orm import sessionmaker
+
+
+@pytest.fixture()
+def clock(monkeypatch) -> list[float]:
+    """Wall-clock time seen by the storage, which tests can move forward."""
+    now = [1_000_000.0]
+    monkeypatch.setattr("core.token_buffer.storage.time.time", lambda: now[0])
+    return now
+
+
+@pytest.fixture()
+def storage(db_engine) -> DatabaseStorage:
+    """Database storage with no buckets or rates."""
+    with sessionmaker(db_engine)() as session:
+        session.query(TokenBucketState).delete()
+        session.query(TokenBucketRate).delete()
+        session.commit()
+    return DatabaseStorage(db_engine)
+
+
+def test_new_bucket_is_full(storage, clock) -> None:
+    """
+    Given a database storage without a bucket for the key
+    When the bucket is replenished
+    Then it is created with the full capacity
+    """
+    assert storage.get_token_count("primary") == 0
+    storage.replenish("primary", rate=1, capacity=5)
+    assert storage.get_token_count("primary") == 5
+
+
+def test_consume_is_all_or_nothing(storage, clock) -> None:
+    """
+    Given a bucket with two tokens
+    When three tokens are requested, then two
+    Then only the second request takes tokens
+    """
+    storage.replenish("primary", rate=1, capacity=2)
+    assert not storage.consume("primary", 3)
+    assert storage.consume("primary", 2)
+    assert storage.get_token_count("primary") == 0
+
+
+def test_replenish_adds_tokens_up_to_capacity(storage, clock) -> None:
+    """
+    Given an empty bucket with a rate of two tokens per second
+    When it is replenished after one second, then after ten more
+    Then it gains two tokens, then fills up to its capacity
+    """
+    storage.replenish("primary", rate=2, capacity=5)
+    assert storage.consume("primary", 5)
+
+    clock[0] += 1
+    storage.replenish("primary", rate=2, capacity=5)
+    assert storage.get_token_count("primary") == 2
+
+    clock[0] += 10
+    storage.replenish("primary", rate=2, capacity=5)
+    assert storage.get_token_count("primary") == 5
+
+
+def test_workers_share_tokens(storage, db_engine, clock) -> None:
+    """
+    Given two token buckets, as if in two workers, sharing the database
+    When both take tokens
+    Then together they take no more than the capacity
+    """
+    buckets = [
+        TokenBucket(rate=1, capacity=3, storage=storage),
+        TokenBucket(rate=1, capacity=3, storage=DatabaseStorage(db_engine)),
+    ]
+
+    taken = [bucket.has_token("primary") for _ in range(3) for bucket in buckets]
+
+    assert taken.count(True) == 3
+    assert buckets[1].token_count("primary") == 0
+    assert buckets[0].token_count("secondary") == 3
+
+
+def test_workers_share_rates(storage, db_engine) -> None:
+    """
+    Given two token buckets, as if in two workers, sharing the database
+    When the rate of a key, then the rate of the bucket, is set through one of them
+    Then the other uses the same rates
+    """
+    first = TokenBucket(rate=1, capacity=3, storage=storage)
+    second = TokenBucket(rate=1, capacity=3, storage=DatabaseStorage(db_engine))
+
+    first.set_key_rate("primary", 4)
+    assert second.key_rate("primary") == 4
+    assert second.key_rate("secondary") == 1
+
+    second.rate = 0.0
+    assert first.rate == 0
+    assert first.key_rate("primary") == 0
+    assert not first.has_token("secondary")
+
+    # A new worker doesn't reset the shared rate
+    assert TokenBucket(rate=1, capacity=3, storage=DatabaseStorage(db_engine)).rate == 0
+
+
+def test_workers_adjust_rates_once_per_interval(storage, db_engine, clock) -> None:
+    """
+    Given a rate controller in each of two workers sharing the database
+    When both see the archive struggling in the same interval, then in the next interval
+    Then the rate is halved once per interval
+    """
+    controllers = [
+        RateController(TokenBucket(rate=4, storage=worker_storage), min_rate=0.1, max_rate=5)
+        for worker_storage in (storage, DatabaseStorage(db_engine))
+    ]
+    controllers[0].token_bucket.rate = 4.0
+
+    for expected_rate in (2, 1):
+        for controller in controllers:
+            controller.adjust(pending_jobs=20)
+            assert controller.token_bucket.key_rate("primary") == expected_rate
+        clock[0] += controllers[0].interval
+
+    assert controllers[1].last_reasons["primary"] == "adjusted by another worker"
+
+
+def test_new_worker_keeps_rates_set_during_window(storage, db_engine, monkeypatch) -> None:
+    """
+    Given a worker with a scheduled window for the primary queue, whose rate is then set by hand
+    When another worker with the same schedule starts, and then the window ends
+    Then the rate set by hand is kept until the window ends, then the bucket's rate applies
+    """
+    window = RateWindow(rate=3)
+    active = [window]
+    monkeypatch.setattr(RateSchedule, "active_window", lambda _self, _key: active[0])
+    schedule = RateSchedule(queues={"primary": [window]})
+    first = TokenBucket(rate=1, storage=storage)
+    first.rate = 1.0
+    first.schedule = schedule
+    assert first.key_rate("primary") == 3
+
+    first.set_key_rate("primary", 2)
+    second = TokenBucket(rate=1, storage=DatabaseStorage(db_engine))
+    second.schedule = schedule
+    assert second.key_rate("primary") == 2
+
+    active[0] = None
+    assert second.key_rate("primary") == 1
+    assert first.key_rate("primary") == 1
+
+
+def test_new_worker_keeps_rates_set_outside_windows(storage, db_engine) -> None:
+    """
+    Given a worker whose primary rate is set by hand while no window is active
+    When another worker with a schedule, with no active window, starts
+    Then the rate set by hand is kept
+    """
+    TokenBucket(rate=1, storage=storage).set_key_rate("primary", 2)
+
+    second = TokenBucket(rate=1, storage=DatabaseStorage(db_engine))
+    second.schedule = RateSchedule(queues={"primary": []})
+
+    assert second.key_rate("primary") == 2
+
+
+def test_storage_from_config(monkeypatch) -> None:
+    """Checks the storage is picked from the environment, and invalid types are rejected."""
+    assert isinstance(token_bucket_storage(), tb.MemoryStorage)
+
+    monkeypatch.setenv("PIXL_TOKEN_BUCKET_STORAGE", "database")
+    assert isinstance(token_bucket_storage(), DatabaseStorage)
+
+    monkeypatch.setenv("PIXL_TOKEN_BUCKET_STORAGE", "redis")
+    with pytest.raises(ValueError, match="must be one of"):
+        token_bucket_storage()
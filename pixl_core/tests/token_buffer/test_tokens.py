@@ -14,9 +14,11 @@
 from __future__ import annotations
 
 import re
+import threading
 import time
 
 import pytest
+import token_bucket as tb
 from core.token_buffer import TokenBucket
 
 
@@ -60,3 +62,80 @@ def test_non_integer_rates_allowed() -> None:
 
 def _is_close(a: float, b: float) -> bool:
     return abs(a - b) < 1e-10
+
+
+@pytest.mark.asyncio()
+async def test_wait_for_token() -> None:
+    """
+    Given an empty token bucket
+    When waiting for a token
+    Then a token is taken as soon as the bucket has been refilled
+    """
+    bucket = TokenBucket(rate=10, capacity=1)
+    assert bucket.has_token(key="primary")
+
+    start = time.monotonic()
+    assert await bucket.wait_for_token(key="primary")
+
+    assert 0.05 < time.monotonic() - start < 0.5
+
+
+@pytest.mark.asyncio()
+async def test_wait_for_token_times_out() -> None:
+    """
+    Given a token bucket with a zero rate
+    When waiting for a token with a timeout
+    Then no token is taken
+    """
+    bucket = TokenBucket(rate=0)
+
+    assert not await bucket.wait_for_token(key="primary", timeout=0.1)
+
+
+class ThreadRecordingStorage(tb.MemoryStorage):
+    """Memory storage recording which threads it is used from."""
+
+    def __init__(self) -> None:
+        """Storage which hasn't been used yet."""
+        super().__init__()
+        self.threads: set[int] = set()
+
+    def replenish(self, key: str, rate: float, capacity: int) -> None:
+        """Replenish the bucket, recording the current thread."""
+        self.threads.add(threading.get_ident())
+        super().replenish(key, rate, capacity)
+
+
+@pytest.mark.asyncio()
+async def test_tokens_taken_off_event_loop() -> None:
+    """
+    Given a token bucket, whose storage could be a database
+    When tokens are taken, with and without waiting
+    Then the storage isn't used from the event loop's thread
+    """
+    storage = ThreadRecordingStorage()
+    bucket = TokenBucket(rate=100, capacity=1, storage=storage)
+
+    assert await bucket.take_token(key="primary")
+    assert await bucket.wait_for_token(key="primary")
+
+    assert storage.threads
+    assert threading.get_ident() not in storage.threads
+
+
+def test_key_rate() -> None:
+    """
+    Given a token bucket
+    When the rate of one key is set, and then the rate of the whole bucket
+    Then only that key's rate changes at first, and then all keys share the bucket's rate
+    """
+    bucket = TokenBucket(rate=1)
+
+    bucket.set_key_rate("secondary", 0)
+    assert _is_close(bucket.key_rate("primary"), 1)
+    assert bucket.key_rate("secondary") == 0
+    assert bucket.has_token(key="primary")
+    assert not bucket.has_token(key="secondary")
+
+    bucket.rate = 2.0
+    assert _is_close(bucket.key_rate("secondary"), 2)
@@ -23,6 +23,7 @@ from datetime import (
 from pathlib import Path
 
 from core.exports import ParquetExport
+from core.metrics import STAGE_SECONDS
 from core.rest_api.router import router
 from core.uploader import get_uploader
 from core.uploader._orthanc import get_tags_by_study
@@ -109,4 +110,5 @@ def export_dicom_from_orthanc(study_data: StudyData) -> None:
 
     uploader = get_uploader(project_slug)
     logger.debug("Sending {} via '{}'", study_id, type(uploader).__name__)
-    uploader.upload_dicom_and_update_database(study_id)
+    with STAGE_SECONDS.time(stage="upload"):
+        uploader.upload_dicom_and_update_database(study_id)
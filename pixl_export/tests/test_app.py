@@ -31,3 +31,9 @@ def test_heartbeat_response_is_200() -> None:
 def test_initial_state_has_no_token() -> None:
     assert not AppState().token_bucket.has_token(key="primary")
     assert not AppState().token_bucket.has_token(key="secondary")
+
+
+def test_metrics_include_token_bucket() -> None:
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'pixl_token_bucket_rate{key="primary"}' in response.text
@@ -0,0 +1,46 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Add adjusted_at column to token bucket rate table
+
+Revision ID: 2d9f6b4e8a17
+Revises: e41a7c93d5f8
+Create Date: 2026-10-18 18:21:43.907152
+
+"""
+
+from collections.abc import Sequence
+from typing import Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "2d9f6b4e8a17"
+down_revision: Union[str, None] = "e41a7c93d5f8"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "token_bucket_rate",
+        sa.Column("adjusted_at", sa.Float(), nullable=True),
+        schema="pipeline",
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("token_bucket_rate", "adjusted_at", schema="pipeline")
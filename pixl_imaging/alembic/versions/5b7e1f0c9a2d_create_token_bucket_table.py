@@ -0,0 +1,49 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Create token bucket table
+
+Revision ID: 5b7e1f0c9a2d
+Revises: d947cc715eb1
+Create Date: 2026-10-18 10:12:31.482913
+
+"""
+
+from collections.abc import Sequence
+from typing import Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "5b7e1f0c9a2d"
+down_revision: Union[str, None] = "d947cc715eb1"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "token_bucket",
+        sa.Column("key", sa.String(), nullable=False),
+        sa.Column("tokens", sa.Float(), nullable=False),
+        sa.Column("replenished_at", sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint("key"),
+        schema="pipeline",
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("token_bucket", schema="pipeline")
@@ -0,0 +1,46 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Add scheduled_window column to token bucket rate table
+
+Revision ID: 7a3c5e1f9b42
+Revises: 2d9f6b4e8a17
+Create Date: 2026-10-18 19:02:16.538820
+
+"""
+
+from collections.abc import Sequence
+from typing import Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "7a3c5e1f9b42"
+down_revision: Union[str, None] = "2d9f6b4e8a17"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "token_bucket_rate",
+        sa.Column("scheduled_window", sa.String(), nullable=True),
+        schema="pipeline",
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("token_bucket_rate", "scheduled_window", schema="pipeline")
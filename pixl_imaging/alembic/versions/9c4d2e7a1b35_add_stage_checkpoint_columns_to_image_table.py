@@ -0,0 +1,53 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Add stage checkpoint columns to image table
+
+Revision ID: 9c4d2e7a1b35
+Revises: 5b7e1f0c9a2d
+Create Date: 2026-10-18 11:47:05.219384
+
+"""
+
+from collections.abc import Sequence
+from typing import Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "9c4d2e7a1b35"
+down_revision: Union[str, None] = "5b7e1f0c9a2d"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+TIMESTAMP_COLUMNS = ("found_at", "retrieved_at", "tagged_at", "sent_at")
+QUERY_COLUMNS = ("query_id", "query_answer_id")
+
+
+def upgrade() -> None:
+    for column in TIMESTAMP_COLUMNS:
+        op.add_column(
+            "image",
+            sa.Column(column, sa.DateTime(timezone=True), nullable=True),
+            schema="pipeline",
+        )
+    for column in QUERY_COLUMNS:
+        op.add_column("image", sa.Column(column, sa.String(), nullable=True), schema="pipeline")
+
+
+def downgrade() -> None:
+    for column in (*QUERY_COLUMNS, *TIMESTAMP_COLUMNS):
+        op.drop_column("image", column, schema="pipeline")
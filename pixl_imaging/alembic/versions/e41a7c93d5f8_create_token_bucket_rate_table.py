@@ -0,0 +1,48 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Create token bucket rate table
+
+Revision ID: e41a7c93d5f8
+Revises: 9c4d2e7a1b35
+Create Date: 2026-10-18 16:47:05.219384
+
+"""
+
+from collections.abc import Sequence
+from typing import Union
+
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision: str = "e41a7c93d5f8"
+down_revision: Union[str, None] = "9c4d2e7a1b35"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "token_bucket_rate",
+        sa.Column("key", sa.String(), nullable=False),
+        sa.Column("rate", sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint("key"),
+        schema="pipeline",
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("token_bucket_rate", schema="pipeline")
@@ -0,0 +1,93 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Batching of study lookups by UID into multi-UID C-FINDs."""
+
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING, Optional
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    from pixl_imaging._orthanc import Orthanc, RemoteQuery
+
+
+class StudyQueryBatcher:
+    """
+    Collect study lookups by StudyInstanceUID for one modality and query them together.
+
+    The first lookup starts a window of `window` seconds, and all lookups made during it are sent
+    as a single C-FIND with the UIDs separated by backslashes (DICOM list of UID matching).
+    The batch is sent straight away once it has `max_size` UIDs. Each lookup then gets the answer
+    which matches its own UID.
+    """
+
+    def __init__(self, orthanc: Orthanc, modality: str, max_size: int, window: float) -> None:
+        self._orthanc = orthanc
+        self._modality = modality
+        self._max_size = max_size
+        self._window = window
+        self._pending: dict[str, list[asyncio.Future[Optional[RemoteQuery]]]] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    async def find(self, study_uid: str) -> Optional[RemoteQuery]:
+        """Find a study by its UID, returning None if the modality doesn't have it."""
+        future: asyncio.Future[Optional[RemoteQuery]] = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(study_uid, []).append(future)
+
+        if len(self._pending) >= self._max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self._window, self._flush)
+        return await future
+
+    async def close(self) -> None:
+        """Cancel any lookups which haven't been sent yet, and wait for those in flight."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for futures in self._pending.values():
+            for future in futures:
+                future.cancel()
+        self._pending = {}
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+        task = asyncio.create_task(self._query(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _query(self, batch: dict[str, list[asyncio.Future[Optional[RemoteQuery]]]]) -> None:
+        logger.debug("Querying {} for a batch of {} studies", self._modality, len(batch))
+        try:
+            answers = await self._orthanc.query_remote_study_uids(list(batch), self._modality)
+        except Exception as error:  # noqa: BLE001 - raised by each lookup instead
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(error)
+            return
+
+        for study_uid, futures in batch.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(answers.get(study_uid))
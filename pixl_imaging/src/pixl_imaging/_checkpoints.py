@@ -0,0 +1,141 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Durable checkpoints of the stages each study has completed, in the image table.
+
+When a message is redelivered, e.g. after a timeout or a crash, the stages it recently completed
+are skipped. Checkpoints older than PIXL_CHECKPOINT_MAX_AGE seconds are ignored, so that
+deliberately reprocessing a study later starts again from the archive.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import datetime
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Literal, Optional
+
+import aiohttp
+from core.db.queries import get_study_progress, update_study_progress
+from decouple import config
+from loguru import logger
+from sqlalchemy.exc import SQLAlchemyError
+
+from pixl_imaging._orthanc import RemoteQuery
+
+if TYPE_CHECKING:
+    from core.patient_queue.message import Message
+
+    from pixl_imaging._orthanc import Orthanc
+
+Stage = Literal["found", "retrieved", "tagged", "sent"]
+STAGES: tuple[Stage, ...] = ("found", "retrieved", "tagged", "sent")
+
+
+@dataclass
+class StudyCheckpoints:
+    """
+    Stages which a message's study has recently completed for its project.
+
+    If checkpoints aren't enabled with PIXL_STAGE_CHECKPOINTS, no stages are completed and
+    nothing is recorded. Database errors are logged rather than raised, as the checkpoints only
+    save repeating work.
+    """
+
+    message: Message
+    enabled: bool = False
+    completed: dict[str, datetime.datetime] = field(default_factory=dict)
+    query: Optional[RemoteQuery] = None
+
+    @classmethod
+    async def load(cls, message: Message) -> StudyCheckpoints:
+        """Load the checkpoints of the message's image, if enabled."""
+        if not config("PIXL_STAGE_CHECKPOINTS", default=False, cast=bool):
+            return cls(message)
+
+        checkpoints = cls(message, enabled=True)
+        try:
+            progress = await asyncio.to_thread(get_study_progress, *checkpoints.image_key)
+        except SQLAlchemyError as error:
+            logger.warning("Failed to load checkpoints for {}: {}", message.identifier, error)
+            return checkpoints
+        if progress is not None:
+            checkpoints.set_progress(progress)
+        return checkpoints
+
+    def set_progress(self, progress: dict[str, Any]) -> None:
+        """Set the stages completed from the image's progress, ignoring stale checkpoints."""
+        max_age = config("PIXL_CHECKPOINT_MAX_AGE", default=3600, cast=int)
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        for stage in STAGES:
+            completed_at = progress[f"{stage}_at"]
+            if completed_at is None:
+                continue
+            if completed_at.tzinfo is None:
+                completed_at = completed_at.replace(tzinfo=datetime.timezone.utc)
+            if now - completed_at <= datetime.timedelta(seconds=max_age):
+                self.completed[stage] = completed_at
+        if "found" in self.completed and progress["query_id"]:
+            self.query = RemoteQuery(progress["query_id"], progress["query_answer_id"])
+
+    @property
+    def image_key(self) -> tuple[str, str, str, datetime.date]:
+        """Project, MRN, accession number and study date identifying the message's image"""
+        message = self.message
+        return (message.project_name, message.mrn, message.accession_number, message.study_date)
+
+    def is_done(self, stage: Stage) -> bool:
+        """Has the stage recently been completed for this study?"""
+        return stage in self.completed
+
+    async def resume_query(self, orthanc_raw: Orthanc) -> Optional[RemoteQuery]:
+        """The query which recently found the study, if Orthanc Raw still has it."""
+        if self.query is None:
+            return None
+        try:
+            await orthanc_raw.get_remote_query_answers(self.query.query_id)
+        except aiohttp.ClientResponseError:
+            # Orthanc only keeps a limited number of queries, so it may have been dropped
+            logger.debug("Checkpointed query {} is no longer known to Orthanc", self.query)
+            return None
+        logger.info("Resuming {} from query {}", self.message.identifier, self.query.query_id)
+        return self.query
+
+    async def record(self, stage: Stage, query: Optional[RemoteQuery] = None) -> None:
+        """
+        Record that the study has completed a stage, clearing the checkpoints of later stages.
+
+        :param query: the query which found the study, for the "found" stage
+        """
+        if not self.enabled:
+            return
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        later_stages = STAGES[STAGES.index(stage) :]
+        progress: dict[str, Any] = {f"{later}_at": None for later in later_stages}
+        progress[f"{stage}_at"] = now
+        if stage == "found":
+            progress["query_id"] = query.query_id if query is not None else None
+            progress["query_answer_id"] = query.answer_id if query is not None else None
+        try:
+            await asyncio.to_thread(update_study_progress, *self.image_key, **progress)
+        except SQLAlchemyError as error:
+            logger.warning(
+                "Failed to record {} checkpoint for {}: {}", stage, self.message.identifier, error
+            )
+            return
+        for later in later_stages:
+            self.completed.pop(later, None)
+        self.completed[stage] = now
+        if stage == "found":
+            self.query = query
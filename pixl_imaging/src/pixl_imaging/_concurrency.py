@@ -0,0 +1,70 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Running requests to Orthanc concurrently, without overwhelming it."""
+
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING, Literal, Optional, TypeVar, overload
+
+from decouple import config
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Iterable
+
+T = TypeVar("T")
+
+
+@overload
+async def _gather_with_concurrency(
+    coroutines: Iterable[Awaitable[T]],
+    limit: Optional[int] = None,
+    *,
+    return_exceptions: Literal[False] = False,
+) -> list[T]: ...
+
+
+@overload
+async def _gather_with_concurrency(
+    coroutines: Iterable[Awaitable[T]],
+    limit: Optional[int] = None,
+    *,
+    return_exceptions: Literal[True],
+) -> list[T | BaseException]: ...
+
+
+async def _gather_with_concurrency(
+    coroutines: Iterable[Awaitable[T]],
+    limit: Optional[int] = None,
+    *,
+    return_exceptions: bool = False,
+) -> list[T] | list[T | BaseException]:
+    """
+    Run coroutines concurrently, with at most `limit` running at once.
+
+    By default the limit is the number of concurrent requests to Orthanc allowed for a study.
+
+    :param return_exceptions: wait for all coroutines, returning exceptions rather than raising
+    """
+    if limit is None:
+        limit = config("PIXL_ORTHANC_REQUESTS_PER_STUDY", default=10, cast=int)
+    semaphore = asyncio.Semaphore(limit)
+
+    async def _bounded(coroutine: Awaitable[T]) -> T:
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(
+        *(_bounded(coroutine) for coroutine in coroutines), return_exceptions=return_exceptions
+    )
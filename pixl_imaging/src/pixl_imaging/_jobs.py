@@ -0,0 +1,290 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Monitoring of Orthanc jobs shared by all in-flight messages."""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+from collections import Counter, deque
+from time import monotonic
+from typing import TYPE_CHECKING, Any, Optional
+
+import aiohttp
+from core.exceptions import PixlRequeueMessageError
+from loguru import logger
+
+if TYPE_CHECKING:
+    from pixl_imaging._orthanc import Orthanc
+
+FINISHED_JOB_STATES = ("Success", "Failure")
+
+
+class JobsSnapshot:
+    """
+    Cached list of all Orthanc jobs, shared by everything which needs to know about job states.
+
+    Concurrent requests for the jobs list are coalesced into a single `GET /jobs?expand`, and the
+    result is reused until it is older than `ttl` seconds. Coroutines can wait on `changed` to be
+    notified when job states may have changed.
+    """
+
+    def __init__(self, orthanc: Orthanc, ttl: float = 2) -> None:
+        self._orthanc = orthanc
+        self._ttl = ttl
+        self._jobs: list[dict] = []
+        self._fetched_at = float("-inf")
+        self._lock = asyncio.Lock()
+        self.changed = asyncio.Condition()
+
+    @property
+    def ttl(self) -> float:
+        """Seconds for which the jobs list is reused."""
+        return self._ttl
+
+    async def get(self, max_age: Optional[float] = None) -> list[dict]:
+        """Get all jobs, refreshing them if the snapshot is older than `max_age` seconds."""
+        if max_age is None:
+            max_age = self._ttl
+        async with self._lock:
+            if monotonic() - self._fetched_at > max_age:
+                self._jobs = await self._orthanc.get_jobs()
+                self._fetched_at = monotonic()
+                await self.notify()
+        return self._jobs
+
+    async def notify(self) -> None:
+        """Wake up all coroutines waiting for job states to change."""
+        async with self.changed:
+            self.changed.notify_all()
+
+
+class JobWatcher:
+    """
+    Watch Orthanc jobs with a single polling loop, waking up the coroutines waiting on each job.
+
+    All watched jobs are checked with one `GET /jobs?expand` per tick. The interval between ticks
+    adapts to the jobs: it starts at `min_interval` whenever a job is added or finishes, and
+    backs off exponentially up to `max_interval` while nothing changes, so short jobs are picked
+    up within milliseconds and long C-MOVEs don't hammer Orthanc.
+    """
+
+    def __init__(
+        self,
+        orthanc: Orthanc,
+        snapshot: JobsSnapshot,
+        min_interval: float = 0.05,
+        max_interval: float = 10,
+        backoff_factor: float = 2,
+    ) -> None:
+        self._orthanc = orthanc
+        self._snapshot = snapshot
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._backoff_factor = backoff_factor
+
+        self._interval = min_interval
+        self._jobs: dict[str, asyncio.Future[dict]] = {}
+        self._waiters: Counter[str] = Counter()
+        self._started_jobs = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task[None]] = None
+
+    @property
+    def watched_jobs(self) -> int:
+        """Number of unfinished jobs currently being watched."""
+        return len(self._jobs)
+
+    @property
+    def started_jobs(self) -> int:
+        """Number of jobs which have started being watched, ever."""
+        return self._started_jobs
+
+    async def wait(self, job_id: str, timeout: float) -> dict:
+        """
+        Wait for a job to finish, returning its final details from Orthanc.
+
+        :raises TimeoutError: if the job hasn't finished within `timeout` seconds
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            job = asyncio.get_running_loop().create_future()
+            self._jobs[job_id] = job
+            self._started_jobs += 1
+        self._waiters[job_id] += 1
+        self._interval = self._min_interval
+        self._wakeup.set()
+        self._ensure_running()
+
+        try:
+            # shield so that one waiter timing out doesn't cancel the job for the others
+            return await asyncio.wait_for(asyncio.shield(job), timeout)
+        finally:
+            self._waiters[job_id] -= 1
+            if self._waiters[job_id] <= 0:
+                del self._waiters[job_id]
+                if not job.done():
+                    self._jobs.pop(job_id, None)
+                    job.cancel()
+
+    async def close(self) -> None:
+        """Stop polling, watched jobs are left unresolved."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _ensure_running(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while self._jobs:
+            await self._sleep()
+            try:
+                finished_any = await self._poll()
+            except (aiohttp.ClientError, TimeoutError):
+                # e.g. a slow `GET /jobs?expand`, which mustn't stop the waiters being resolved
+                logger.exception("Failed to get job states from Orthanc, will retry")
+                finished_any = False
+
+            if finished_any:
+                self._interval = self._min_interval
+            else:
+                self._interval = min(self._interval * self._backoff_factor, self._max_interval)
+
+    async def _sleep(self) -> None:
+        """Sleep for the current interval, or until woken up by a new job."""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=self._interval)
+        except TimeoutError:
+            return
+        # A new job was added, give it at least a moment to start before polling
+        self._wakeup.clear()
+        await asyncio.sleep(self._min_interval)
+
+    async def _poll(self) -> bool:
+        """Check all watched jobs, resolving those which have finished."""
+        jobs = await self._snapshot.get(max_age=self._min_interval)
+        jobs_by_id = {job["ID"]: job for job in jobs}
+        finished_any = False
+        for job_id in list(self._jobs):
+            job_info = jobs_by_id.get(job_id)
+            if job_info is None:
+                # Finished jobs drop out of the list once Orthanc's job history is full
+                job_info = await self._get_job(job_id)
+            if job_info["State"] in FINISHED_JOB_STATES:
+                self._resolve(job_id, job_info)
+                finished_any = True
+        if finished_any:
+            await self._snapshot.notify()
+        return finished_any
+
+    async def _get_job(self, job_id: str) -> Any:
+        try:
+            return await self._orthanc.job_state(job_id=job_id)
+        except aiohttp.ClientResponseError as error:
+            if error.status != 404:  # noqa: PLR2004 - not found
+                raise
+            return {
+                "ID": job_id,
+                "State": "Failure",
+                "ErrorCode": error.status,
+                "ErrorDescription": "Job is no longer known to Orthanc",
+            }
+
+    def _resolve(self, job_id: str, job_info: dict) -> None:
+        job = self._jobs.pop(job_id, None)
+        if job is not None and not job.done():
+            job.set_result(job_info)
+
+
+class JobAdmissionController:
+    """
+    Hold back new messages while Orthanc is saturated with jobs.
+
+    Orthanc is saturated if it has any pending jobs, or if the jobs that we created ourselves and
+    are still waiting on reach `max_active_jobs`. Rather than requeueing the message, we wait for
+    job states to change, and only give up with a PixlRequeueMessageError after `max_wait` seconds.
+
+    Each admitted message reserves a job until the next job starts being watched, or for
+    `reservation_ttl` seconds if it doesn't create one, so that the messages woken up together by
+    a change of job states can't all be admitted against the same count.
+    """
+
+    def __init__(
+        self,
+        snapshot: JobsSnapshot,
+        watcher: JobWatcher,
+        max_active_jobs: int = 20,
+        max_wait: float = 300,
+        reservation_ttl: float = 60,
+    ) -> None:
+        self._snapshot = snapshot
+        self._watcher = watcher
+        self._max_active_jobs = max_active_jobs
+        self._max_wait = max_wait
+        self._reservation_ttl = reservation_ttl
+        # Expiry times of the jobs reserved by admitted messages, oldest first
+        self._reservations: deque[float] = deque()
+        self._started_jobs = watcher.started_jobs
+
+    async def wait_for_capacity(self) -> None:
+        """
+        Wait until Orthanc can accept more jobs.
+
+        :raises PixlRequeueMessageError: if Orthanc is still saturated after waiting
+        """
+        deadline = monotonic() + self._max_wait
+        jobs = await self._snapshot.get()
+        while not self._has_capacity(jobs):
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                msg = "Pending messages in orthanc raw"
+                raise PixlRequeueMessageError(msg)
+            # Also wake up once the snapshot is stale, as nothing else may refresh it
+            async with self._snapshot.changed:
+                with contextlib.suppress(TimeoutError):
+                    await asyncio.wait_for(
+                        self._snapshot.changed.wait(), timeout=min(remaining, self._snapshot.ttl)
+                    )
+            jobs = await self._snapshot.get()
+        # No await since checking the capacity, so no other message can have taken it
+        self._reservations.append(monotonic() + self._reservation_ttl)
+
+    def _reserved_jobs(self) -> int:
+        """Number of jobs reserved by admitted messages which haven't started yet."""
+        started_jobs = self._watcher.started_jobs
+        for _ in range(min(started_jobs - self._started_jobs, len(self._reservations))):
+            self._reservations.popleft()
+        self._started_jobs = started_jobs
+
+        now = monotonic()
+        while self._reservations and self._reservations[0] <= now:
+            self._reservations.popleft()
+        return len(self._reservations)
+
+    def _has_capacity(self, jobs: list[dict]) -> bool:
+        pending_jobs = [job for job in jobs if job["State"] == "Pending"]
+        for job in pending_jobs:
+            logger.trace(
+                "{}, {}, {}, {}, {}",
+                job["State"],
+                job.get("CreationTime"),
+                job.get("ID"),
+                job.get("Type"),
+                job.get("EffectiveRuntime"),
+            )
+        active_jobs = self._watcher.watched_jobs + self._reserved_jobs()
+        return not pending_jobs and active_jobs < self._max_active_jobs
@@ -14,20 +14,53 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
-from asyncio import sleep
-from time import time
-from typing import Any, Optional
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Optional
 
 import aiohttp
-from core.exceptions import PixlDiscardError, PixlRequeueMessageError
+from core.exceptions import PixlJobFailedError
+from core.metrics import HTTP_CLIENT_SECONDS, STAGE_SECONDS
 from decouple import config
 from loguru import logger
 
+from pixl_imaging._batching import StudyQueryBatcher
+from pixl_imaging._concurrency import _gather_with_concurrency
+from pixl_imaging._jobs import JobAdmissionController, JobsSnapshot, JobWatcher
+from pixl_imaging._query_cache import QueryCache
+
+if TYPE_CHECKING:
+    from typing_extensions import Self
+
+
+@dataclass(frozen=True)
+class RemoteQuery:
+    """A query against a remote modality, narrowed down to one of its answers if given."""
+
+    query_id: str
+    answer_id: Optional[str] = None
+
 
 class Orthanc(ABC):
-    def __init__(
-        self, url: str, username: str, password: str, http_timeout: int, dicom_timeout: int
+    def __init__(  # noqa: PLR0913 - too many args
+        self,
+        url: str,
+        username: str,
+        password: str,
+        http_timeout: int,
+        dicom_timeout: int,
+        connection_limit: int = 100,
+        connection_limit_per_host: int = 0,
     ) -> None:
+        """
+        Connection to an Orthanc instance's REST API.
+
+        All requests share a single keep-alive connection pool, which is created on first use
+        (so that it is bound to the running event loop) and released by `close()`.
+
+        :param connection_limit: maximum number of simultaneous connections, 0 for no limit
+        :param connection_limit_per_host: maximum number of simultaneous connections to the
+            same host, 0 for no limit
+        """
         if not url:
             msg = "URL for orthanc is required"
             raise ValueError(msg)
@@ -39,6 +72,51 @@ class Orthanc(ABC):
         self.http_timeout = http_timeout
         self.dicom_timeout = dicom_timeout
 
+        self._connection_limit = connection_limit
+        self._connection_limit_per_host = connection_limit_per_host
+        self._session: Optional[aiohttp.ClientSession] = None
+        cache_size = config("PIXL_QUERY_CACHE_SIZE", default=1000, cast=int)
+        cache_ttl = config("PIXL_QUERY_CACHE_TTL", default=300, cast=float)
+        self._query_cache: QueryCache[str] = QueryCache(max_size=cache_size, ttl=cache_ttl)
+        # Studies looked up by UID in batches, see `find_remote_study_by_uid`
+        self._study_uid_cache: QueryCache[RemoteQuery] = QueryCache(
+            max_size=cache_size, ttl=cache_ttl
+        )
+        self._study_query_batchers: dict[str, StudyQueryBatcher] = {}
+        self._jobs_snapshot = JobsSnapshot(
+            self, ttl=config("PIXL_ORTHANC_JOBS_CACHE_TTL", default=2, cast=float)
+        )
+        self._job_watcher = JobWatcher(
+            self,
+            self._jobs_snapshot,
+            min_interval=config("PIXL_JOB_POLL_MIN_INTERVAL", default=0.05, cast=float),
+            max_interval=config("PIXL_JOB_POLL_MAX_INTERVAL", default=10, cast=float),
+        )
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *args: object) -> None:
+        await self.close()
+
+    async def close(self) -> None:
+        """Close the shared connection pool, it will be recreated if used again."""
+        for batcher in self._study_query_batchers.values():
+            await batcher.close()
+        await self._job_watcher.close()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._connection_limit,
+                limit_per_host=self._connection_limit_per_host,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, auth=self._auth)
+        return self._session
+
     @property
     @abstractmethod
     def aet(self) -> str:
@@ -66,14 +144,54 @@ class Orthanc(ABC):
         """Query local Orthanc instance for instance."""
         return await self._get(f"/instances/{instance_id}")
 
+    async def query_local_study_series(self, study_id: str) -> Any:
+        """Query local Orthanc instance for the details of all series in a study."""
+        return await self._get(f"/studies/{study_id}/series")
+
+    async def query_local_study_instances(self, study_id: str) -> Any:
+        """Query local Orthanc instance for the details of all instances in a study."""
+        return await self._get(f"/studies/{study_id}/instances")
+
     async def query_remote(self, data: dict, modality: str) -> Optional[str]:
-        """Query a particular modality, available from this node"""
+        """
+        Query a particular modality, available from this node
+
+        Results, including queries without any answers, are cached for a while so that the same
+        query isn't repeated against the modality.
+        """
+        cache_key = self._query_cache.key(modality, data)
+        found, query_id = self._query_cache.get(cache_key)
+        if found and query_id is None:
+            logger.debug("Using cached empty query result for {} with {}", modality, data)
+            return None
+        if found and query_id is not None:
+            if await self._is_query_known(query_id):
+                logger.debug("Using cached query {} for {} with {}", query_id, modality, data)
+                return query_id
+            self._query_cache.invalidate(cache_key)
+
+        query_id = await self._query_remote(data, modality)
+        self._query_cache.put(cache_key, query_id)
+        return query_id
+
+    async def _is_query_known(self, query_id: str) -> bool:
+        """Does Orthanc still have a query's answers?"""
+        try:
+            await self.get_remote_query_answers(query_id)
+        except aiohttp.ClientResponseError:
+            # Orthanc only keeps a limited number of queries, so it may have been dropped
+            logger.debug("Cached query {} is no longer known to Orthanc", query_id)
+            return False
+        return True
+
+    async def _query_remote(self, data: dict, modality: str) -> Optional[str]:
         logger.debug("Running query on modality: {} with {}", modality, data)
 
-        response = await self._post(
-            f"/modalities/{modality}/query",
-            data=data,
-        )
+        with STAGE_SECONDS.time(stage="c-find"):
+            response = await self._post(
+                f"/modalities/{modality}/query",
+                data=data,
+            )
         logger.debug("Query response: {}", response)
         query_answers = await self.get_remote_query_answers(response["ID"])
         if len(query_answers) > 0:
@@ -81,6 +199,65 @@ class Orthanc(ABC):
 
         return None
 
+    async def find_remote_study_by_uid(
+        self, study_uid: str, modality: str
+    ) -> Optional[RemoteQuery]:
+        """
+        Find a study on a modality by its UID.
+
+        If PIXL_STUDY_QUERY_BATCH_SIZE is more than 1, lookups made within
+        PIXL_STUDY_QUERY_BATCH_WINDOW seconds of each other are sent as a single query. Each
+        study's answer, or that it wasn't found, is cached as for `query_remote`.
+        """
+        batch_size = config("PIXL_STUDY_QUERY_BATCH_SIZE", default=1, cast=int)
+        if batch_size <= 1:
+            query_id = await self.query_remote(
+                {"Level": "Study", "Query": {"StudyInstanceUID": study_uid}}, modality=modality
+            )
+            return RemoteQuery(query_id) if query_id is not None else None
+
+        cache_key = self._study_uid_cache.key(modality, {"StudyInstanceUID": study_uid})
+        found, study_query = self._study_uid_cache.get(cache_key)
+        if found and (study_query is None or await self._is_query_known(study_query.query_id)):
+            logger.debug("Using cached lookup of study {} in {}", study_uid, modality)
+            return study_query
+        if found:
+            self._study_uid_cache.invalidate(cache_key)
+
+        if modality not in self._study_query_batchers:
+            self._study_query_batchers[modality] = StudyQueryBatcher(
+                self,
+                modality,
+                max_size=batch_size,
+                window=config("PIXL_STUDY_QUERY_BATCH_WINDOW", default=0.5, cast=float),
+            )
+        study_query = await self._study_query_batchers[modality].find(study_uid)
+        self._study_uid_cache.put(cache_key, study_query)
+        return study_query
+
+    async def query_remote_study_uids(
+        self, study_uids: list[str], modality: str
+    ) -> dict[str, RemoteQuery]:
+        """Query a modality for several studies at once, returning the answer for each UID found."""
+        logger.debug("Running query on modality: {} for {} study UIDs", modality, len(study_uids))
+        with STAGE_SECONDS.time(stage="c-find"):
+            response = await self._post(
+                f"/modalities/{modality}/query",
+                data={"Level": "Study", "Query": {"StudyInstanceUID": "\\".join(study_uids)}},
+                timeout=self.dicom_timeout,
+            )
+        query_id = str(response["ID"])
+        answer_ids = await self.get_remote_query_answers(query_id)
+        contents = await _gather_with_concurrency(
+            self.get_remote_query_answer_content(query_id, answer_id) for answer_id in answer_ids
+        )
+
+        answers = {}
+        for answer_id, content in zip(answer_ids, contents, strict=True):
+            tags = {tag["Name"]: tag["Value"] for tag in content.values()}
+            answers.setdefault(tags.get("StudyInstanceUID"), RemoteQuery(query_id, answer_id))
+        return answers
+
     async def get_remote_query_answers(self, query_id: str) -> Any:
         """Get the answers to a query"""
         return await self._get(f"/queries/{query_id}/answers")
@@ -89,6 +266,21 @@ class Orthanc(ABC):
         """Get the content of a query answer"""
         return await self._get(f"/queries/{query_id}/answers/{answer_id}/content")
 
+    async def get_remote_query_answer_series(
+        self, query_id: str, answer_id: str, query: Optional[dict] = None
+    ) -> Any:
+        """
+        Get the series of a query answer, using DICOM timeout as can take a while
+
+        :param query: additional series-level tags to match or return
+        """
+        response = await self._post(
+            f"/queries/{query_id}/answers/{answer_id}/query-series",
+            data={"Query": query or {}},
+            timeout=self.dicom_timeout,
+        )
+        return response["ID"]
+
     async def get_remote_query_answer_instances(self, query_id: str, answer_id: str) -> Any:
         """Get the instances of a query answer, using DICOM timeout as can take a while"""
         response = await self._post(
@@ -125,9 +317,13 @@ class Orthanc(ABC):
         job_id = str(response["ID"])
         await self.wait_for_job_success_or_raise(job_id, "modify", timeout=self.dicom_timeout)
 
-    async def retrieve_from_remote(self, query_id: str) -> str:
+    async def retrieve_from_remote(self, query: RemoteQuery) -> str:
+        """Retrieve a query's answers, or only its given answer."""
+        path = f"/queries/{query.query_id}"
+        if query.answer_id is not None:
+            path += f"/answers/{query.answer_id}"
         response = await self._post(
-            f"/queries/{query_id}/retrieve",
+            f"{path}/retrieve",
             data={"TargetAet": self.aet, "Synchronous": False, "Timeout": self.dicom_timeout},
         )
         return str(response["ID"])
@@ -148,27 +344,38 @@ class Orthanc(ABC):
         )
         return str(response["ID"])
 
+    async def retrieve_series_from_remote(self, modality: str, series: list[dict[str, str]]) -> str:
+        """Retrieve series from remote modality in a single c-move query."""
+        response = await self._post(
+            f"/modalities/{modality}/move",
+            data={
+                "Level": "Series",
+                "TargetAet": self.aet,
+                "Synchronous": False,
+                "Resources": series,
+                "Timeout": self.dicom_timeout,
+            },
+        )
+        return str(response["ID"])
+
     async def wait_for_job_success_or_raise(self, job_id: str, job_type: str, timeout: int) -> None:
         """Wait for job to complete successfully, or raise exception if fails or exceeds timeout."""
-        job_info = {"State": "Pending"}
-        start_time = time()
-
-        while job_info["State"] != "Success":
-            if job_info["State"] == "Failure":
-                msg = (
-                    "Job failed: "
-                    f"Error code={job_info['ErrorCode']} Cause={job_info['ErrorDescription']}"
-                )
-                raise PixlDiscardError(msg)
-            if job_type == "modify":
-                logger.debug("Modify job: {}", job_info)
-            if (time() - start_time) > timeout:
-                msg = f"Failed to finish {job_type} job {job_id} in {timeout} seconds"
-                await sleep(10)
-                raise PixlDiscardError(msg)
-
-            await sleep(10)
-            job_info = await self.job_state(job_id=job_id)
+        try:
+            # Job types are e.g. "c-move for series", recorded as the "c-move" stage
+            with STAGE_SECONDS.time(stage=job_type.split()[0]):
+                job_info = await self._job_watcher.wait(job_id, timeout=timeout)
+        except TimeoutError:
+            msg = f"Failed to finish {job_type} job {job_id} in {timeout} seconds"
+            raise PixlJobFailedError(msg) from None
+
+        if job_type == "modify":
+            logger.debug("Modify job: {}", job_info)
+        if job_info["State"] == "Failure":
+            msg = (
+                "Job failed: "
+                f"Error code={job_info['ErrorCode']} Cause={job_info['ErrorDescription']}"
+            )
+            raise PixlJobFailedError(msg)
 
     async def job_state(self, job_id: str) -> Any:
         """Get job state from orthanc."""
@@ -176,35 +383,28 @@ class Orthanc(ABC):
         return await self._get(f"/jobs/{job_id}")
 
     async def _get(self, path: str) -> Any:
-        async with (
-            aiohttp.ClientSession() as session,
-            session.get(
+        with HTTP_CLIENT_SECONDS.time(server=self._url, method="GET"):
+            async with self._get_session().get(
                 f"{self._url}{path}",
-                auth=self._auth,
                 timeout=self.http_timeout,
-            ) as response,
-        ):
-            return await _deserialise(response)
+            ) as response:
+                return await _deserialise(response)
 
     async def _post(self, path: str, data: dict, timeout: int | None = None) -> Any:
         # Optionally override default http timeout
         http_timeout = timeout or self.http_timeout
-        async with (
-            aiohttp.ClientSession() as session,
-            session.post(
-                f"{self._url}{path}", json=data, auth=self._auth, timeout=http_timeout
-            ) as response,
-        ):
-            return await _deserialise(response)
+        with HTTP_CLIENT_SECONDS.time(server=self._url, method="POST"):
+            async with self._get_session().post(
+                f"{self._url}{path}", json=data, timeout=http_timeout
+            ) as response:
+                return await _deserialise(response)
 
     async def delete(self, path: str) -> None:
-        async with (
-            aiohttp.ClientSession() as session,
-            session.delete(
-                f"{self._url}{path}", auth=self._auth, timeout=self.http_timeout
-            ) as response,
-        ):
-            await _deserialise(response)
+        with HTTP_CLIENT_SECONDS.time(server=self._url, method="DELETE"):
+            async with self._get_session().delete(
+                f"{self._url}{path}", timeout=self.http_timeout
+            ) as response:
+                await _deserialise(response)
 
 
 async def _deserialise(response: aiohttp.ClientResponse) -> Any:
@@ -223,30 +423,32 @@ class PIXLRawOrthanc(Orthanc):
             password=config("ORTHANC_RAW_PASSWORD"),
             http_timeout=config("PIXL_QUERY_TIMEOUT", default=10, cast=int),
             dicom_timeout=config("PIXL_DICOM_TRANSFER_TIMEOUT", default=240, cast=int),
+            connection_limit=config("PIXL_ORTHANC_CONNECTION_LIMIT", default=100, cast=int),
+            connection_limit_per_host=config(
+                "PIXL_ORTHANC_CONNECTION_LIMIT_PER_HOST", default=0, cast=int
+            ),
+        )
+        self._job_admission = JobAdmissionController(
+            self._jobs_snapshot,
+            self._job_watcher,
+            max_active_jobs=config("PIXL_ORTHANC_MAX_ACTIVE_JOBS", default=20, cast=int),
+            max_wait=config("PIXL_ORTHANC_JOBS_MAX_WAIT", default=300, cast=float),
         )
 
-    async def raise_if_pending_jobs(self) -> None:
+    async def wait_for_job_capacity(self) -> None:
         """
-        Raise PixlRequeueMessageError if there are pending jobs on the server.
+        Wait until there are no pending jobs on the server, and we aren't running too many jobs.
 
         Otherwise orthanc starts to get buggy when there are a whole load of pending jobs.
-        PixlRequeueMessageError will cause the rabbitmq message to be requeued
+        If this takes too long, PixlRequeueMessageError is raised which will cause the rabbitmq
+        message to be requeued
         """
-        jobs = await self.get_jobs()
-        unfinished_jobs = [x for x in jobs if x["State"] not in ("Success", "Failure")]
-        for job in unfinished_jobs:
-            logger.trace(
-                "{}, {}, {}, {}, {}",
-                job["State"],
-                job.get("CreationTime"),
-                job.get("ID"),
-                job.get("Type"),
-                job.get("EffectiveRuntime"),
-            )
-        for job in jobs:
-            if job["State"] == "Pending":
-                msg = "Pending messages in orthanc raw"
-                raise PixlRequeueMessageError(msg)
+        await self._job_admission.wait_for_capacity()
+
+    async def count_pending_jobs(self) -> int:
+        """Number of pending jobs on the server, from the shared jobs snapshot."""
+        jobs = await self._jobs_snapshot.get()
+        return sum(job["State"] == "Pending" for job in jobs)
 
     @property
     def aet(self) -> str:
@@ -0,0 +1,413 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Processing of messages as a pipeline of stages, each with its own queue and pool of workers.
+
+Studies pass through the find, move, tag and store stages in turn, so that archive-bound
+(find, move) and Orthanc-bound (tag, store) work can be sized independently. If a stage fails
+with an error which may be transient, only that stage is retried, before the message fails.
+Whatever the job holds, such as the study's lock, is released before the stage is retried.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Optional
+
+from core.exceptions import (
+    PixlDiscardError,
+    PixlOutOfHoursError,
+    PixlRequeueMessageError,
+    PixlStudyNotInPrimaryArchiveError,
+)
+from decouple import config
+from loguru import logger
+
+from pixl_imaging._checkpoints import StudyCheckpoints
+from pixl_imaging._processing import (
+    ImagingStudy,
+    _add_project_to_study_if_missing,
+    _find_study,
+    _hold,
+    _is_retrieved_study_in_raw,
+    _retrieval_key_and_filter,
+    _retrieve_found_study,
+    _send_study_to_anon,
+    _study_locks,
+    _study_retrievals,
+    _timed,
+    _wait_until_archive_can_be_queried,
+)
+from pixl_imaging._tracing import current_trace, resume_trace, span, trace_study
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable, Sequence
+    from types import TracebackType
+
+    from core.patient_queue.message import Message
+    from core.token_buffer.controller import RateController
+    from core.token_buffer.limits import ConcurrencyLimits
+    from typing_extensions import Self
+
+    from pixl_imaging._orthanc import PIXLRawOrthanc, RemoteQuery
+    from pixl_imaging._processing import DicomModality
+    from pixl_imaging._tracing import StudyTrace
+
+# Errors which retrying a stage won't fix, so the message fails straight away
+FINAL_ERRORS = (
+    PixlDiscardError,
+    PixlOutOfHoursError,
+    PixlRequeueMessageError,
+    PixlStudyNotInPrimaryArchiveError,
+)
+
+
+@dataclass(eq=False)
+class StudyJob:
+    """A message passing through the pipeline, with what earlier stages found out."""
+
+    study: ImagingStudy
+    archive: DicomModality
+    done: asyncio.Future[None]
+    trace: Optional[StudyTrace] = None
+    study_query: Optional[RemoteQuery] = None
+    resource: dict = field(default_factory=dict)
+    checkpoints: Optional[StudyCheckpoints] = None
+    # The study was recently retrieved and is still in Orthanc Raw, so isn't found or moved
+    retrieved: bool = False
+    # Failed attempts at the current stage
+    attempts: int = 0
+    # Released when the job finishes, e.g. the study lock held from tagging until storing
+    cleanup: contextlib.AsyncExitStack = field(default_factory=contextlib.AsyncExitStack)
+    holds_study_lock: bool = False
+
+    async def release(self) -> None:
+        """Release what the job holds, so that it can be held again by a later attempt."""
+        await self.cleanup.aclose()
+        self.cleanup = contextlib.AsyncExitStack()
+        self.holds_study_lock = False
+
+
+class StageBusyError(Exception):
+    """The stage can't run for the job yet, e.g. the study is locked by another job."""
+
+
+@dataclass
+class Stage:
+    """A step of the pipeline, run by `workers` concurrent workers."""
+
+    name: str
+    handler: Callable[[StudyJob], Awaitable[None]]
+    workers: int
+
+
+class StagedPipeline:
+    """
+    Pass jobs through stages in order, with a queue and pool of workers for each stage.
+
+    A stage raising an error other than one of FINAL_ERRORS is retried, after `retry_delay`
+    seconds for each failed attempt, until it has been attempted `max_attempts` times. Then, or
+    on a final error, the job fails with the stage's error. A stage raising StageBusyError is
+    queued again after `retry_delay` seconds, without counting as an attempt, so that workers
+    never wait for one another's jobs.
+    """
+
+    def __init__(
+        self, stages: Sequence[Stage], *, max_attempts: int = 3, retry_delay: float = 1
+    ) -> None:
+        """Pipeline which isn't running until started, see `start()`."""
+        if not stages or any(stage.workers < 1 for stage in stages):
+            msg = "A pipeline needs at least one stage, each with at least one worker"
+            raise ValueError(msg)
+        self.stages = list(stages)
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._queues: list[asyncio.Queue[StudyJob]] = []
+        self._workers: list[asyncio.Task[None]] = []
+        self._jobs: set[StudyJob] = set()
+
+    async def __aenter__(self) -> Self:
+        """Start the workers."""
+        self.start()
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc_val: Optional[BaseException],
+        exc_tb: Optional[TracebackType],
+    ) -> None:
+        """Stop the workers, cancelling unfinished jobs."""
+        await self.stop()
+
+    def start(self) -> None:
+        """Start the workers of each stage."""
+        self._queues = [asyncio.Queue() for _ in self.stages]
+        self._workers = [
+            asyncio.create_task(self._work(index), name=f"pipeline-{stage.name}-{worker}")
+            for index, stage in enumerate(self.stages)
+            for worker in range(stage.workers)
+        ]
+
+    async def stop(self) -> None:
+        """Stop the workers, cancelling unfinished jobs."""
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for job in list(self._jobs):
+            job.done.cancel()
+            await self._finish(job)
+
+    @property
+    def queued(self) -> dict[str, int]:
+        """Number of jobs waiting for each stage"""
+        queues = zip(self.stages, self._queues, strict=True)
+        return {stage.name: queue.qsize() for stage, queue in queues}
+
+    async def submit(self, job: StudyJob) -> None:
+        """Pass a job through the pipeline, returning when it has finished or raising its error."""
+        if not self._workers:
+            msg = "Pipeline has not been started"
+            raise RuntimeError(msg)
+        self._jobs.add(job)
+        self._queues[0].put_nowait(job)
+        await job.done
+
+    async def _work(self, index: int) -> None:
+        stage = self.stages[index]
+        queue = self._queues[index]
+        while True:
+            job = await queue.get()
+            try:
+                await self._run_stage(index, stage, job)
+            finally:
+                queue.task_done()
+
+    async def _run_stage(self, index: int, stage: Stage, job: StudyJob) -> None:
+        if job.done.done():
+            # cancelled while waiting in the queue
+            await self._finish(job)
+            return
+
+        try:
+            with resume_trace(job.trace):
+                await stage.handler(job)
+        except FINAL_ERRORS as error:
+            await self._finish(job, error)
+        except StageBusyError:
+            asyncio.get_running_loop().call_later(
+                self.retry_delay, self._queues[index].put_nowait, job
+            )
+        except Exception as error:  # noqa: BLE001 - any other error may be transient
+            await job.release()
+            job.attempts += 1
+            if job.attempts >= self.max_attempts:
+                logger.warning(
+                    "Stage {} failed {} times for {}: {}",
+                    stage.name,
+                    job.attempts,
+                    job.study.message.identifier,
+                    error,
+                )
+                await self._finish(job, error)
+                return
+            logger.info(
+                "Retrying stage {} for {} after error: {}",
+                stage.name,
+                job.study.message.identifier,
+                error,
+            )
+            asyncio.get_running_loop().call_later(
+                self.retry_delay * job.attempts, self._queues[index].put_nowait, job
+            )
+        else:
+            job.attempts = 0
+            if index + 1 < len(self.stages):
+                self._queues[index + 1].put_nowait(job)
+            else:
+                await self._finish(job)
+
+    async def _finish(self, job: StudyJob, error: Optional[BaseException] = None) -> None:
+        self._jobs.discard(job)
+        await job.release()
+        if job.done.done():
+            return
+        if error is None:
+            job.done.set_result(None)
+        else:
+            job.done.set_exception(error)
+
+
+class ImagingPipeline(StagedPipeline):
+    """
+    Retrieve studies and send them to Orthanc Anon in the find, move, tag and store stages.
+
+    - find: wait for Orthanc Raw to have capacity, then query the archive for the study
+    - move: retrieve the study, or its missing instances, shared with concurrent messages for
+      the same study as in `_process_message`
+    - tag: set the project name of the study in Orthanc Raw, holding the study's lock until the
+      study has been stored so that another project can't change it in between
+    - store: send the study to Orthanc Anon, tagging it again if the lock was released when a
+      previous attempt failed
+
+    Jobs whose study is locked by another job are queued again rather than waiting for the lock.
+
+    If PIXL_STAGE_CHECKPOINTS is set, each stage records its checkpoint as in `_process_message`,
+    and a redelivered message skips the stages which its study recently completed.
+    """
+
+    def __init__(  # noqa: PLR0913 - too many args
+        self,
+        orthanc_raw: PIXLRawOrthanc,
+        *,
+        workers: dict[str, int],
+        rate_controller: Optional[RateController] = None,
+        limits: Optional[ConcurrencyLimits] = None,
+        max_attempts: int = 3,
+        retry_delay: float = 1,
+    ) -> None:
+        """
+        Pipeline for messages using a shared Orthanc Raw connection.
+
+        :param workers: number of workers for each of the find, move, tag and store stages
+        :param rate_controller: if given, told how long querying and retrieving each study takes
+        :param limits: if given, the limits on messages in each archive and stage at once
+        """
+        self.orthanc_raw = orthanc_raw
+        self.rate_controller = rate_controller
+        self.limits = limits
+        super().__init__(
+            [
+                Stage("find", self._find, workers["find"]),
+                Stage("move", self._move, workers["move"]),
+                Stage("tag", self._tag, workers["tag"]),
+                Stage("store", self._store, workers["store"]),
+            ],
+            max_attempts=max_attempts,
+            retry_delay=retry_delay,
+        )
+
+    @classmethod
+    def from_config(
+        cls,
+        orthanc_raw: PIXLRawOrthanc,
+        rate_controller: Optional[RateController] = None,
+        limits: Optional[ConcurrencyLimits] = None,
+    ) -> ImagingPipeline:
+        """
+        Pipeline with workers for each stage from PIXL_PIPELINE_<STAGE>_WORKERS, and stages
+        attempted up to PIXL_PIPELINE_STAGE_ATTEMPTS times.
+        """
+        defaults = {"find": 4, "move": 4, "tag": 4, "store": 2}
+        return cls(
+            orthanc_raw,
+            workers={
+                stage: config(f"PIXL_PIPELINE_{stage.upper()}_WORKERS", default=default, cast=int)
+                for stage, default in defaults.items()
+            },
+            rate_controller=rate_controller,
+            limits=limits,
+            max_attempts=config("PIXL_PIPELINE_STAGE_ATTEMPTS", default=3, cast=int),
+        )
+
+    async def process_message(self, message: Message, archive: DicomModality) -> None:
+        """Process a message from the queue through the pipeline, see `process_message`."""
+        study = ImagingStudy.from_message(message)
+        with trace_study(message.identifier, message.study_uid, archive.name):
+            checkpoints = await StudyCheckpoints.load(message)
+            if checkpoints.is_done("sent"):
+                logger.info(
+                    "Study {} was sent at {}, not processing it again",
+                    message.identifier,
+                    checkpoints.completed["sent"],
+                )
+                return
+            job = StudyJob(
+                study=study,
+                archive=archive,
+                done=asyncio.get_running_loop().create_future(),
+                trace=current_trace(),
+                checkpoints=checkpoints,
+            )
+            await self.submit(job)
+
+    async def _find(self, job: StudyJob) -> None:
+        checkpoints = job.checkpoints
+        if checkpoints is not None and await _is_retrieved_study_in_raw(
+            job.study, self.orthanc_raw, checkpoints
+        ):
+            job.retrieved = True
+            return
+
+        await _wait_until_archive_can_be_queried(job.study, self.orthanc_raw, job.archive)
+        async with _hold(self.limits, job.archive.name):
+            if checkpoints is not None:
+                job.study_query = await checkpoints.resume_query(self.orthanc_raw)
+            if job.study_query is None:
+                job.study_query = await _find_study(
+                    job.study, self.orthanc_raw, job.archive, self.rate_controller, self.limits
+                )
+                if checkpoints is not None:
+                    await checkpoints.record("found", job.study_query)
+
+    async def _move(self, job: StudyJob) -> None:
+        if job.retrieved:
+            return
+        study_query = job.study_query
+        if study_query is None:
+            msg = f"Study {job.study.message.identifier} must be found before it is moved"
+            raise RuntimeError(msg)
+        retrieval_key, series_filter = _retrieval_key_and_filter(job.study, job.archive)
+
+        async def retrieve() -> None:
+            async with _hold(self.limits, job.archive.name):
+                with _timed(self.rate_controller, "retrieval", job.archive.name):
+                    await _retrieve_found_study(
+                        job.study,
+                        self.orthanc_raw,
+                        job.archive,
+                        study_query,
+                        series_filter,
+                        self.limits,
+                    )
+
+        with span("retrieval"):
+            await _study_retrievals.run(retrieval_key, retrieve)
+        if job.checkpoints is not None:
+            await job.checkpoints.record("retrieved")
+
+    async def _tag(self, job: StudyJob) -> None:
+        if not job.holds_study_lock:
+            if _study_locks.locked(job.study.key):
+                msg = f"Study {job.study.message.identifier} is locked by another message"
+                raise StageBusyError(msg)
+            # The lock is free, so this takes it without waiting
+            await job.cleanup.enter_async_context(_study_locks.hold(job.study.key))
+            job.holds_study_lock = True
+        job.resource = await _add_project_to_study_if_missing(
+            job.study, self.orthanc_raw, self.limits
+        )
+        if job.checkpoints is not None:
+            await job.checkpoints.record("tagged")
+
+    async def _store(self, job: StudyJob) -> None:
+        if not job.holds_study_lock:
+            # Released when a previous attempt failed, so another project may have tagged it
+            await self._tag(job)
+        sent = await _send_study_to_anon(job.resource, self.orthanc_raw, self.limits)
+        if sent and job.checkpoints is not None:
+            await job.checkpoints.record("sent")
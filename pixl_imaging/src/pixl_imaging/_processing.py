@@ -13,44 +13,92 @@
 #  limitations under the License.
 from __future__ import annotations
 
+import contextlib
 import datetime
 from dataclasses import dataclass
 from enum import StrEnum
-from typing import TYPE_CHECKING, Any, Optional
+from typing import TYPE_CHECKING, Any, Literal, Optional
 from zoneinfo import ZoneInfo
 
+import aiohttp
 from core.dicom_tags import DICOM_TAG_PROJECT_NAME
-from core.exceptions import PixlDiscardError, PixlOutOfHoursError, PixlStudyNotInPrimaryArchiveError
+from core.exceptions import (
+    PixlDiscardError,
+    PixlJobFailedError,
+    PixlOutOfHoursError,
+    PixlStudyNotInPrimaryArchiveError,
+)
+from core.project_config import load_project_config
 from decouple import config
 
-from pixl_imaging._orthanc import Orthanc, PIXLRawOrthanc
+from pixl_imaging._checkpoints import StudyCheckpoints
+from pixl_imaging._concurrency import _gather_with_concurrency
+from pixl_imaging._orthanc import Orthanc, PIXLRawOrthanc, RemoteQuery
+from pixl_imaging._single_flight import KeyedLock, SingleFlight
+from pixl_imaging._tracing import span, trace_study
 
 if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable, Iterable, Sequence
+    from contextlib import AbstractAsyncContextManager, AbstractContextManager
+
     from core.patient_queue.message import Message
+    from core.project_config.pixl_config_model import PixlConfig
+    from core.token_buffer.controller import RateController
+    from core.token_buffer.limits import ConcurrencyLimits
 
 from loguru import logger
 
+# Errors which count as the archive failing a retrieval, for the rate controller. Others, such as
+# no series of a study being wanted by its project, aren't the archive's fault.
+RETRIEVAL_FAILURES = (PixlJobFailedError, aiohttp.ClientError, TimeoutError)
+
+# Shared by all messages processed in this process, see `_process_message`
+_study_retrievals: SingleFlight[None] = SingleFlight()
+_study_locks = KeyedLock()
+
 
 class DicomModality(StrEnum):
     primary = config("PRIMARY_DICOM_SOURCE_MODALITY")
     secondary = config("SECONDARY_DICOM_SOURCE_MODALITY")
 
 
-async def process_message(message: Message, archive: DicomModality) -> None:
+async def process_message(
+    message: Message,
+    archive: DicomModality,
+    orthanc_raw: Optional[PIXLRawOrthanc] = None,
+    rate_controller: Optional[RateController] = None,
+    limits: Optional[ConcurrencyLimits] = None,
+) -> None:
     """
     Process message from queue by retrieving a study with the given Patient and Accession Number.
     We may receive multiple messages with same Patient + Acc Num, either as retries or because
     they are needed for multiple projects.
+
+    :param orthanc_raw: long-lived Orthanc Raw connection shared between messages. If not given,
+        a connection is created for this message only.
+    :param rate_controller: if given, told how long querying and retrieving the study takes
+    :param limits: if given, the limits on messages in each archive and stage at once
+
+    If PIXL_TRACE_FILE is set, how long each stage takes is written to it for each message.
     """
     logger.trace("Processing: {}. Querying {} archive.", message.identifier, archive.name)
 
     study = ImagingStudy.from_message(message)
-    orthanc_raw = PIXLRawOrthanc()
-    await _process_message(study, orthanc_raw, archive)
+    with trace_study(message.identifier, message.study_uid, archive.name):
+        if orthanc_raw is not None:
+            await _process_message(study, orthanc_raw, archive, rate_controller, limits)
+            return
+
+        async with PIXLRawOrthanc() as message_orthanc_raw:
+            await _process_message(study, message_orthanc_raw, archive, rate_controller, limits)
 
 
 async def _process_message(
-    study: ImagingStudy, orthanc_raw: PIXLRawOrthanc, archive: DicomModality
+    study: ImagingStudy,
+    orthanc_raw: PIXLRawOrthanc,
+    archive: DicomModality,
+    rate_controller: Optional[RateController] = None,
+    limits: Optional[ConcurrencyLimits] = None,
 ) -> None:
     """
     Retrieve a study from the archives and send it to Orthanc Anon.
@@ -75,67 +123,297 @@ async def _process_message(
     Then:
         - set the project name tag for the study if it's not already set
         - send the study to Orthanc Anon
+
+    Concurrent messages for the same study (e.g. for different projects) share a single retrieval
+    from the archive, then each sets its own project name and sends the study in turn.
+
+    If PIXL_SELECTIVE_RETRIEVAL is set, only the series which the message's project would keep
+    are retrieved, so the retrieval is only shared by messages for the same project.
+
+    If `limits` are given, a shared retrieval holds one place in its archive, and each stage
+    waits for a place in that stage before starting.
+
+    If PIXL_STAGE_CHECKPOINTS is set, each stage completed is recorded against the study's image
+    in the database (see `StudyCheckpoints`). A redelivered message then skips the archive if its
+    study was recently retrieved and is still in Orthanc Raw, and is done if it was recently sent.
     """
-    await orthanc_raw.raise_if_pending_jobs()
+    checkpoints = await StudyCheckpoints.load(study.message)
+    if checkpoints.is_done("sent"):
+        logger.info(
+            "Study {} was sent at {}, not processing it again",
+            study.message.identifier,
+            checkpoints.completed["sent"],
+        )
+        return
 
-    if archive.name == "secondary" and (_is_daytime() or _is_weekend()):
+    if not await _is_retrieved_study_in_raw(study, orthanc_raw, checkpoints):
+        await _wait_until_archive_can_be_queried(study, orthanc_raw, archive)
+
+        retrieval_key, series_filter = _retrieval_key_and_filter(study, archive)
+
+        # Messages sharing another message's retrieval only record how long they waited for it
+        with span("retrieval"):
+            await _study_retrievals.run(
+                retrieval_key,
+                lambda: _retrieve_study_from_archive(
+                    study=study,
+                    orthanc_raw=orthanc_raw,
+                    archive=archive,
+                    series_filter=series_filter,
+                    rate_controller=rate_controller,
+                    limits=limits,
+                    checkpoints=checkpoints,
+                ),
+            )
+        await checkpoints.record("retrieved")
+
+    async with _study_locks.hold(study.key):
+        await _add_project_and_send_study(
+            study=study, orthanc_raw=orthanc_raw, limits=limits, checkpoints=checkpoints
+        )
+
+
+async def _is_retrieved_study_in_raw(
+    study: ImagingStudy, orthanc_raw: PIXLRawOrthanc, checkpoints: StudyCheckpoints
+) -> bool:
+    """Was the study recently retrieved for this message, and is it still in Orthanc Raw?"""
+    if not checkpoints.is_done("retrieved"):
+        return False
+    with span("local_lookup"):
+        existing_resources = await study.query_local(orthanc_raw)
+    if not existing_resources:
+        logger.info(
+            "Study {} was retrieved but is no longer in Orthanc Raw", study.message.identifier
+        )
+        return False
+    logger.info(
+        "Study {} was retrieved at {}, not querying the archive again",
+        study.message.identifier,
+        checkpoints.completed["retrieved"],
+    )
+    return True
+
+
+async def _wait_until_archive_can_be_queried(
+    study: ImagingStudy, orthanc_raw: PIXLRawOrthanc, archive: DicomModality
+) -> None:
+    """
+    Wait until Orthanc Raw has capacity for more jobs.
+
+    Raise a PixlOutOfHoursError if 'archive' is 'secondary' and it's during working hours.
+    """
+    with span("pending_jobs"):
+        await orthanc_raw.wait_for_job_capacity()
+
+    if archive.name == "secondary" and not is_secondary_archive_available():
         msg = "Not querying secondary archive during the daytime or on the weekend."
         raise PixlOutOfHoursError(msg)
 
     logger.info("Processing: {}. Querying {} archive.", study.message.identifier, archive.name)
 
-    study_query_id = await _find_study_in_archive_or_raise(
-        orthanc_raw=orthanc_raw,
-        study=study,
-        archive=archive,
-    )
 
-    existing_local_resource = await _get_existing_study(
-        orthanc_raw=orthanc_raw,
-        study=study,
-    )
+def _retrieval_key_and_filter(
+    study: ImagingStudy, archive: DicomModality
+) -> tuple[tuple, Optional[Callable[[dict], bool]]]:
+    """Key shared by messages which can share a retrieval, and the filter for its series."""
+    series_filter = None
+    retrieval_key: tuple = (study.key, archive.name)
+    if config("PIXL_SELECTIVE_RETRIEVAL", default=False, cast=bool):
+        series_filter = _project_series_filter(load_project_config(study.message.project_name))
+        retrieval_key += (study.message.project_name,)
+    return retrieval_key, series_filter
 
-    if not existing_local_resource:
-        await _retrieve_study(
-            orthanc_raw=orthanc_raw,
-            study_query_id=study_query_id,
-        )
-    else:
-        await _retrieve_missing_instances(
-            resource=existing_local_resource,
-            orthanc_raw=orthanc_raw,
-            study=study,
-            study_query_id=study_query_id,
-            modality=archive.value,
-        )
 
+async def _retrieve_study_from_archive(  # noqa: PLR0913 - too many args
+    study: ImagingStudy,
+    orthanc_raw: PIXLRawOrthanc,
+    archive: DicomModality,
+    series_filter: Optional[Callable[[dict], bool]] = None,
+    rate_controller: Optional[RateController] = None,
+    limits: Optional[ConcurrencyLimits] = None,
+    checkpoints: Optional[StudyCheckpoints] = None,
+) -> None:
+    """
+    Retrieve a study, or the instances of it which are missing from Orthanc Raw.
+
+    :param series_filter: if given, only retrieve the series whose archive query tags it accepts
+    :param rate_controller: if given, told how long the query and retrieval take
+    :param limits: if given, the limits on studies retrieved from the archive and in each stage
+    :param checkpoints: if given, the query which recently found the study is reused if Orthanc
+        Raw still has it, otherwise the query which finds it is recorded
+    """
+    async with _hold(limits, archive.name):
+        study_query = await checkpoints.resume_query(orthanc_raw) if checkpoints else None
+        if study_query is None:
+            study_query = await _find_study(study, orthanc_raw, archive, rate_controller, limits)
+            if checkpoints is not None:
+                await checkpoints.record("found", study_query)
+
+        with _timed(rate_controller, "retrieval", archive.name):
+            await _retrieve_found_study(
+                study, orthanc_raw, archive, study_query, series_filter, limits
+            )
+
+
+async def _find_study(
+    study: ImagingStudy,
+    orthanc_raw: PIXLRawOrthanc,
+    archive: DicomModality,
+    rate_controller: Optional[RateController] = None,
+    limits: Optional[ConcurrencyLimits] = None,
+) -> RemoteQuery:
+    """Query the archive for a study, see `_find_study_in_archive_or_raise`."""
+    async with _hold(limits, "c-find"):
+        with _timed(rate_controller, "query", archive.name), span("archive_find"):
+            return await _find_study_in_archive_or_raise(
+                orthanc_raw=orthanc_raw,
+                study=study,
+                archive=archive,
+            )
+
+
+def _timed(
+    rate_controller: Optional[RateController], action: Literal["query", "retrieval"], key: str
+) -> AbstractContextManager[None]:
+    """Time an action for the rate controller, if there is one."""
+    if rate_controller is None:
+        return contextlib.nullcontext()
+    if action == "query":
+        return rate_controller.timed_query(key)
+    return rate_controller.timed_retrieval(key, failures=RETRIEVAL_FAILURES)
+
+
+def _hold(limits: Optional[ConcurrencyLimits], name: str) -> AbstractAsyncContextManager[None]:
+    """Hold a place in an archive or stage for the context, if there are limits."""
+    if limits is None:
+        return contextlib.nullcontext()
+    return limits.hold(name)
+
+
+async def _retrieve_found_study(  # noqa: PLR0913 - too many args
+    study: ImagingStudy,
+    orthanc_raw: PIXLRawOrthanc,
+    archive: DicomModality,
+    study_query: RemoteQuery,
+    series_filter: Optional[Callable[[dict], bool]],
+    limits: Optional[ConcurrencyLimits] = None,
+) -> None:
+    """Retrieve a study which has been found in the archive."""
+    async with _study_locks.hold(study.key):
+        with span("local_lookup"):
+            existing_local_resource = await _get_existing_study(
+                orthanc_raw=orthanc_raw,
+                study=study,
+            )
+
+    async with _hold(limits, "c-move"):
+        with span("c_move"):
+            if not existing_local_resource and series_filter is not None:
+                await _retrieve_selected_series(
+                    orthanc_raw=orthanc_raw,
+                    study=study,
+                    study_query=study_query,
+                    modality=archive.value,
+                    series_filter=series_filter,
+                )
+            elif not existing_local_resource:
+                await _retrieve_study(
+                    orthanc_raw=orthanc_raw,
+                    study=study,
+                    study_query=study_query,
+                    modality=archive.value,
+                )
+            else:
+                await _retrieve_missing_instances(
+                    resource=existing_local_resource,
+                    orthanc_raw=orthanc_raw,
+                    study=study,
+                    study_query=study_query,
+                    modality=archive.value,
+                    series_filter=series_filter,
+                )
+
+
+def _project_series_filter(project_config: PixlConfig) -> Callable[[dict], bool]:
+    """
+    Filter for series which a project keeps when anonymising, so others needn't be retrieved.
+
+    Series are kept if the archive didn't tell us their modality or description.
+    """
+
+    def _is_series_wanted(series_tags: dict) -> bool:
+        modality = series_tags.get("Modality")
+        if modality and modality not in project_config.project.modalities:
+            return False
+        return not project_config.is_series_excluded(series_tags.get("SeriesDescription", ""))
+
+    return _is_series_wanted
+
+
+async def _add_project_and_send_study(
+    study: ImagingStudy,
+    orthanc_raw: PIXLRawOrthanc,
+    limits: Optional[ConcurrencyLimits] = None,
+    checkpoints: Optional[StudyCheckpoints] = None,
+) -> None:
+    """
+    Set the project name tag of a study in Orthanc Raw, then send it to Orthanc Anon.
+
+    :param checkpoints: if given, told when the study has been tagged and sent
+    """
+    resource = await _add_project_to_study_if_missing(study, orthanc_raw, limits)
+    if checkpoints is not None:
+        await checkpoints.record("tagged")
+    sent = await _send_study_to_anon(resource, orthanc_raw, limits)
+    if sent and checkpoints is not None:
+        await checkpoints.record("sent")
+
+
+async def _add_project_to_study_if_missing(
+    study: ImagingStudy,
+    orthanc_raw: PIXLRawOrthanc,
+    limits: Optional[ConcurrencyLimits] = None,
+) -> dict:
+    """Set the project name tag of a study in Orthanc Raw, returning the study's resource."""
     # Now that study has arrived in orthanc raw, we can set its project name tag via the API
     logger.debug("Get existing study before setting project name")
-    resource = await _get_existing_study(
-        orthanc_raw=orthanc_raw,
-        study=study,
-    )
+    with span("local_lookup"):
+        resource = await _get_existing_study(
+            orthanc_raw=orthanc_raw,
+            study=study,
+        )
 
     if not await _project_name_is_correct(
         project_name=study.message.project_name,
         resource=resource,
     ):
-        await _add_project_to_study(
-            project_name=study.message.project_name,
-            orthanc_raw=orthanc_raw,
-            study=resource["ID"],
-        )
+        async with _hold(limits, "modify"):
+            with span("modify"):
+                await _add_project_to_study(
+                    project_name=study.message.project_name,
+                    orthanc_raw=orthanc_raw,
+                    study=resource["ID"],
+                )
 
     logger.debug("Local instances for study: {}", resource)
+    return resource
+
 
+async def _send_study_to_anon(
+    resource: dict, orthanc_raw: PIXLRawOrthanc, limits: Optional[ConcurrencyLimits] = None
+) -> bool:
+    """Send a study in Orthanc Raw to Orthanc Anon if auto-routing is enabled, returning if sent."""
     if config("ORTHANC_AUTOROUTE_RAW_TO_ANON", default=False, cast=bool):
-        job_id = await orthanc_raw.send_study_to_anon(resource_id=resource["ID"])
-        await orthanc_raw.wait_for_job_success_or_raise(
-            job_id, "c-store", timeout=orthanc_raw.dicom_timeout
-        )
-        return
+        async with _hold(limits, "c-store"):
+            with span("c_store"):
+                job_id = await orthanc_raw.send_study_to_anon(resource_id=resource["ID"])
+                await orthanc_raw.wait_for_job_success_or_raise(
+                    job_id, "c-store", timeout=orthanc_raw.dicom_timeout
+                )
+        return True
 
     logger.debug("Auto-routing to Orthanc Anon is not enabled. Not sending study {}", resource)
+    return False
 
 
 async def _get_existing_study(
@@ -230,7 +508,7 @@ async def _find_study_in_archive_or_raise(
     orthanc_raw: Orthanc,
     study: ImagingStudy,
     archive: DicomModality,
-) -> str:
+) -> RemoteQuery:
     """
     Query an archive for a study.
 
@@ -247,14 +525,14 @@ async def _find_study_in_archive_or_raise(
     the MRN and accession number.
 
     """
-    query_id = await _find_study_in_archive(
+    study_query = await _find_study_in_archive(
         orthanc_raw=orthanc_raw,
         study=study,
         modality=archive.value,
     )
 
-    if query_id is not None:
-        return query_id
+    if study_query is not None:
+        return study_query
 
     if archive.name == "secondary":
         msg = f"Failed to find study {study.message.identifier} in primary or secondary archive."
@@ -278,15 +556,15 @@ async def _find_study_in_archive(
     orthanc_raw: Orthanc,
     study: ImagingStudy,
     modality: str,
-) -> Optional[str]:
+) -> Optional[RemoteQuery]:
     """
     Query the primary archive for the study using its UID.
     If UID is not available, query on MRN and accession number.
     """
     query_response = None
     if study.message.study_uid:
-        query_response = await orthanc_raw.query_remote(
-            data=study.orthanc_uid_query_dict,
+        query_response = await orthanc_raw.find_remote_study_by_uid(
+            study_uid=study.message.study_uid,
             modality=modality,
         )
     if query_response is not None:
@@ -297,10 +575,16 @@ async def _find_study_in_archive(
         modality,
         study.message.study_uid,
     )
-    return await orthanc_raw.query_remote(
+    query_id = await orthanc_raw.query_remote(
         study.orthanc_query_dict,
         modality=modality,
     )
+    return RemoteQuery(query_id) if query_id is not None else None
+
+
+def is_secondary_archive_available() -> bool:
+    """The secondary archive may only be queried overnight on weekdays."""
+    return not (_is_daytime() or _is_weekend())
 
 
 def _is_daytime() -> bool:
@@ -319,92 +603,320 @@ def _is_weekend() -> bool:
     return datetime.datetime.now(tz=timezone).weekday() in (saturday, sunday)
 
 
-async def _retrieve_study(orthanc_raw: Orthanc, study_query_id: str) -> None:
-    """Retrieve all instances for a study from the VNA / PACS."""
-    job_id = await orthanc_raw.retrieve_from_remote(query_id=study_query_id)  # C-Move
+async def _retrieve_study(
+    orthanc_raw: Orthanc, study: ImagingStudy, study_query: RemoteQuery, modality: str
+) -> None:
+    """
+    Retrieve all instances for a study from the VNA / PACS.
+
+    If PIXL_SERIES_PARALLEL_MIN_INSTANCES is set, the study's series are queried first, and
+    studies with at least that many instances are retrieved series by series in parallel.
+    """
+    if config("PIXL_SERIES_PARALLEL_MIN_INSTANCES", default=0, cast=int) > 0:
+        _, series_answers = await _get_remote_study_series(orthanc_raw, study_query)
+        if _is_large_study(series_answers.values()):
+            await _retrieve_series(orthanc_raw, study, modality, list(series_answers.values()))
+            return
+
+    job_id = await orthanc_raw.retrieve_from_remote(query=study_query)  # C-Move
     await orthanc_raw.wait_for_job_success_or_raise(
         job_id, "c-move", timeout=orthanc_raw.dicom_timeout
     )
 
 
-async def _retrieve_missing_instances(
+async def _retrieve_missing_instances(  # noqa: PLR0913 - too many args
     resource: dict,
     orthanc_raw: Orthanc,
     study: ImagingStudy,
-    study_query_id: str,
+    study_query: RemoteQuery,
     modality: str,
+    series_filter: Optional[Callable[[dict], bool]] = None,
 ) -> None:
-    """Retrieve missing instances for a study from the VNA / PACS."""
-    missing_instance_uids = await _get_missing_instances(
-        orthanc_raw=orthanc_raw, study=study, resource=resource, study_query_id=study_query_id
+    """
+    Retrieve missing instances for a study from the VNA / PACS.
+
+    Series which are missing entirely are moved at series level, and other missing instances in
+    chunks of PIXL_MISSING_INSTANCES_CHUNK_SIZE. These C-MOVEs run concurrently, and all of them
+    are attempted even if some fail, so that a retry of the message only has to move what is
+    still missing.
+    """
+    missing_resources = await _get_missing_instances(
+        orthanc_raw=orthanc_raw,
+        study=study,
+        resource=resource,
+        study_query=study_query,
+        series_filter=series_filter,
     )
-    if not missing_instance_uids:
+    if not missing_resources:
         return
+
+    missing_series = [item for item in missing_resources if "SOPInstanceUID" not in item]
+    missing_instances = [item for item in missing_resources if "SOPInstanceUID" in item]
+    chunk_size = config("PIXL_MISSING_INSTANCES_CHUNK_SIZE", default=500, cast=int)
+    moves = [_move_series(orthanc_raw, modality, [series]) for series in missing_series]
+    moves += [
+        _move_instances(orthanc_raw, modality, missing_instances[start : start + chunk_size])
+        for start in range(0, len(missing_instances), chunk_size)
+    ]
     logger.debug(
-        "Retrieving {} missing instances for study {}",
-        len(missing_instance_uids),
+        "Retrieving {} missing series and {} missing instances in {} c-moves for study {}",
+        len(missing_series),
+        len(missing_instances),
+        len(moves),
         study.message.identifier,
     )
-    job_id = await orthanc_raw.retrieve_instances_from_remote(modality, missing_instance_uids)
+    await _run_moves(moves, study)
+
+
+async def _move_instances(
+    orthanc_raw: Orthanc, modality: str, instances: list[dict[str, str]]
+) -> None:
+    job_id = await orthanc_raw.retrieve_instances_from_remote(modality, instances)
     await orthanc_raw.wait_for_job_success_or_raise(
         job_id, "c-move for missing instances", timeout=orthanc_raw.dicom_timeout
     )
 
 
 async def _get_missing_instances(
-    orthanc_raw: Orthanc, study: ImagingStudy, resource: dict, study_query_id: str
+    orthanc_raw: Orthanc,
+    study: ImagingStudy,
+    resource: dict,
+    study_query: RemoteQuery,
+    series_filter: Optional[Callable[[dict], bool]] = None,
 ) -> list[dict[str, str]]:
     """
     Check if any study instances are missing from Orthanc Raw.
 
-    Return a list of missing instance UIDs (empty if none missing)
+    The archive is first queried at series level, and the number of instances it reports for each
+    series is compared to the number in Orthanc Raw. Only series where these differ are then
+    queried at instance level, to find which instances are missing. Series rejected by
+    `series_filter` are never considered to be missing.
+
+    Return a list of missing instance UIDs (empty if none missing). Series which are missing
+    entirely aren't queried at instance level, and are returned without a SOPInstanceUID.
     """
     # First get all SOPInstanceUIDs for the study that are in Orthanc Raw
-    orthanc_raw_sop_instance_uids = []
-    for series_id in resource["Series"]:
-        series = await orthanc_raw.query_local_series(series_id)
-        for instance_id in series["Instances"]:
-            instance = await orthanc_raw.query_local_instance(instance_id)
-            orthanc_raw_sop_instance_uids.append(instance["MainDicomTags"]["SOPInstanceUID"])
-
-    # Now query the VNA / PACS for the study instances
-    study_query_answers = await orthanc_raw.get_remote_query_answers(study_query_id)
-    instances_query_id = await orthanc_raw.get_remote_query_answer_instances(
-        query_id=study_query_id, answer_id=study_query_answers[0]
-    )
-    instances_query_answers = await orthanc_raw.get_remote_query_answers(instances_query_id)
-
-    missing_instances: list[dict[str, str]] = []
+    local_instances_by_series = await _get_local_instances_by_series(orthanc_raw, resource)
 
-    if len(instances_query_answers) == len(orthanc_raw_sop_instance_uids):
-        return missing_instances
+    # Now query the VNA / PACS for the study's series
+    series_query_id, series_answers = await _get_remote_study_series(orthanc_raw, study_query)
 
-    # If the SOPInstanceUID is not in the list of instances in Orthanc Raw
-    # retrieve the instance from the VNA / PACS
-    query_tags = ["0020,000d", "0020,000e", "0008,0018"]
-    for instance_query_answer in instances_query_answers:
-        instance_query_answer_content = await orthanc_raw.get_remote_query_answer_content(
-            query_id=instances_query_id,
-            answer_id=instance_query_answer,
+    missing_instances: list[dict[str, str]] = []
+    for series_answer_id, series_tags in series_answers.items():
+        if series_filter is not None and not series_filter(series_tags):
+            continue
+        local_sop_instance_uids = local_instances_by_series.get(
+            series_tags["SeriesInstanceUID"], set()
         )
-        uids_for_query = {
-            instance_query_answer_content[x]["Name"]: instance_query_answer_content[x]["Value"]
-            for x in query_tags
-        }
-        sop_instance_uid = uids_for_query["SOPInstanceUID"]
-        if sop_instance_uid in orthanc_raw_sop_instance_uids:
+        remote_instance_count = series_tags.get("NumberOfSeriesRelatedInstances")
+        if remote_instance_count and int(remote_instance_count) == len(local_sop_instance_uids):
+            continue
+        if not local_sop_instance_uids:
+            missing_instances.append(
+                {
+                    "StudyInstanceUID": series_tags["StudyInstanceUID"],
+                    "SeriesInstanceUID": series_tags["SeriesInstanceUID"],
+                }
+            )
             continue
 
-        logger.trace(
-            "Instance {} is missing from study {}",
-            sop_instance_uid,
-            study.message.study_uid,
+        # If the SOPInstanceUID is not in the list of instances in Orthanc Raw
+        # retrieve the instance from the VNA / PACS
+        instances_query_id = await orthanc_raw.get_remote_query_answer_instances(
+            query_id=series_query_id, answer_id=series_answer_id
         )
-        missing_instances.append(uids_for_query)
+        instances_answers = await _get_remote_query_answer_tags(orthanc_raw, instances_query_id)
+        for instance_tags in instances_answers.values():
+            sop_instance_uid = instance_tags["SOPInstanceUID"]
+            if sop_instance_uid in local_sop_instance_uids:
+                continue
+
+            logger.trace(
+                "Instance {} is missing from study {}",
+                sop_instance_uid,
+                study.message.study_uid,
+            )
+            missing_instances.append(
+                {
+                    "StudyInstanceUID": instance_tags["StudyInstanceUID"],
+                    "SeriesInstanceUID": instance_tags["SeriesInstanceUID"],
+                    "SOPInstanceUID": sop_instance_uid,
+                }
+            )
 
     return missing_instances
 
 
+async def _retrieve_selected_series(
+    orthanc_raw: Orthanc,
+    study: ImagingStudy,
+    study_query: RemoteQuery,
+    modality: str,
+    series_filter: Callable[[dict], bool],
+) -> None:
+    """Retrieve only the series of a study which are accepted by `series_filter`."""
+    _, series_answers = await _get_remote_study_series(orthanc_raw, study_query)
+    selected_series = [
+        series_tags for series_tags in series_answers.values() if series_filter(series_tags)
+    ]
+    logger.debug(
+        "Retrieving {} of {} series for study {}",
+        len(selected_series),
+        len(series_answers),
+        study.message.identifier,
+    )
+    if not selected_series:
+        msg = f"No series in study {study.message.identifier} are wanted by its project"
+        raise PixlDiscardError(msg)
+
+    await _retrieve_series(orthanc_raw, study, modality, selected_series)
+
+
+async def _retrieve_series(
+    orthanc_raw: Orthanc, study: ImagingStudy, modality: str, series: list[dict]
+) -> None:
+    """
+    Retrieve series of a study, given the tags of each series from the archive.
+
+    Large studies (see `_is_large_study`) are retrieved with a C-MOVE per series, running
+    concurrently. Otherwise all series are retrieved with a single C-MOVE.
+    """
+    resources = [
+        {
+            "StudyInstanceUID": series_tags["StudyInstanceUID"],
+            "SeriesInstanceUID": series_tags["SeriesInstanceUID"],
+        }
+        for series_tags in series
+    ]
+    if not _is_large_study(series):
+        await _move_series(orthanc_raw, modality, resources)
+        return
+
+    logger.debug("Retrieving {} series for study {}", len(resources), study.message.identifier)
+    await _run_moves(
+        [_move_series(orthanc_raw, modality, [resource]) for resource in resources], study
+    )
+
+
+async def _run_moves(moves: Sequence[Awaitable[None]], study: ImagingStudy) -> None:
+    """
+    Run C-MOVEs for a study concurrently, raising the first error once all have finished.
+
+    Up to PIXL_SERIES_PARALLEL_MOVES (and no more than Orthanc's ORTHANC_CONCURRENT_JOBS) run at
+    once.
+    """
+    limit = min(
+        config("PIXL_SERIES_PARALLEL_MOVES", default=4, cast=int),
+        config("ORTHANC_CONCURRENT_JOBS", default=5, cast=int),
+    )
+    results = await _gather_with_concurrency(moves, limit=limit, return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        logger.warning(
+            "Failed {} of {} c-moves for study {}",
+            len(errors),
+            len(moves),
+            study.message.identifier,
+        )
+        raise errors[0]
+
+
+async def _move_series(orthanc_raw: Orthanc, modality: str, resources: list[dict]) -> None:
+    job_id = await orthanc_raw.retrieve_series_from_remote(modality, resources)
+    await orthanc_raw.wait_for_job_success_or_raise(
+        job_id, "c-move for series", timeout=orthanc_raw.dicom_timeout
+    )
+
+
+def _is_large_study(series: Iterable[dict]) -> bool:
+    """Whether a study has at least PIXL_SERIES_PARALLEL_MIN_INSTANCES instances, if it's set."""
+    min_instances: int = config("PIXL_SERIES_PARALLEL_MIN_INSTANCES", default=0, cast=int)
+    if min_instances <= 0:
+        return False
+    instances = sum(
+        int(series_tags.get("NumberOfSeriesRelatedInstances") or 0) for series_tags in series
+    )
+    return instances >= min_instances
+
+
+async def _get_remote_study_series(
+    orthanc_raw: Orthanc, study_query: RemoteQuery
+) -> tuple[str, dict[str, dict]]:
+    """
+    Query the archive for the series of a study.
+
+    :return: the series query ID, and the tags of each series by answer ID
+    """
+    study_answer_id = study_query.answer_id
+    if study_answer_id is None:
+        study_query_answers = await orthanc_raw.get_remote_query_answers(study_query.query_id)
+        study_answer_id = study_query_answers[0]
+    series_query_id = await orthanc_raw.get_remote_query_answer_series(
+        query_id=study_query.query_id,
+        answer_id=study_answer_id,
+        query={"NumberOfSeriesRelatedInstances": "", "Modality": "", "SeriesDescription": ""},
+    )
+    return series_query_id, await _get_remote_query_answer_tags(orthanc_raw, series_query_id)
+
+
+async def _get_remote_query_answer_tags(orthanc_raw: Orthanc, query_id: str) -> dict[str, dict]:
+    """
+    Get the DICOM tags of all answers to a query, by answer ID.
+
+    The answers' contents are requested concurrently, and tags are keyed by name.
+    """
+    answer_ids = await orthanc_raw.get_remote_query_answers(query_id)
+    contents = await _gather_with_concurrency(
+        orthanc_raw.get_remote_query_answer_content(query_id=query_id, answer_id=answer_id)
+        for answer_id in answer_ids
+    )
+    return {
+        answer_id: {tag["Name"]: tag["Value"] for tag in content.values()}
+        for answer_id, content in zip(answer_ids, contents, strict=True)
+    }
+
+
+async def _get_local_instances_by_series(
+    orthanc_raw: Orthanc, resource: dict
+) -> dict[str, set[str]]:
+    """
+    Get the SOPInstanceUIDs of all instances of a study in Orthanc Raw, by SeriesInstanceUID.
+
+    All series and instances are listed with a request each, falling back to requesting each
+    series and instance (with bounded concurrency) if the study's children can't be listed at once.
+    """
+    try:
+        series = await orthanc_raw.query_local_study_series(resource["ID"])
+        instances = await orthanc_raw.query_local_study_instances(resource["ID"])
+    except aiohttp.ClientResponseError as error:
+        logger.warning(
+            "Failed to list instances of study {} in a single request ({}), "
+            "querying each series and instance instead",
+            resource["ID"],
+            error,
+        )
+        series = await _gather_with_concurrency(
+            orthanc_raw.query_local_series(series_id) for series_id in resource["Series"]
+        )
+        instances = await _gather_with_concurrency(
+            orthanc_raw.query_local_instance(instance_id)
+            for series_info in series
+            for instance_id in series_info["Instances"]
+        )
+
+    instances_by_series: dict[str, set[str]] = {
+        series_info["MainDicomTags"]["SeriesInstanceUID"]: set() for series_info in series
+    }
+    series_uids = {
+        series_info["ID"]: series_info["MainDicomTags"]["SeriesInstanceUID"]
+        for series_info in series
+    }
+    for instance in instances:
+        series_uid = series_uids[instance["ParentSeries"]]
+        instances_by_series[series_uid].add(instance["MainDicomTags"]["SOPInstanceUID"])
+    return instances_by_series
+
+
 @dataclass
 class ImagingStudy:
     """Dataclass for DICOM study unique to a patient and imaging study"""
@@ -416,6 +928,13 @@ class ImagingStudy:
         """Build an imaging study from a queue message."""
         return ImagingStudy(message=message)
 
+    @property
+    def key(self) -> tuple[str, ...]:
+        """Key identifying the study, its UID if available, otherwise MRN and accession number."""
+        if self.message.study_uid:
+            return ("StudyInstanceUID", self.message.study_uid)
+        return ("PatientID", self.message.mrn, "AccessionNumber", self.message.accession_number)
+
     @property
     def orthanc_uid_query_dict(self) -> dict:
         """Build a dictionary to query a study with a study UID."""
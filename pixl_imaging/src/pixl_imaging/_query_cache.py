@@ -0,0 +1,76 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Cache of remote query results, to avoid repeating the same C-FIND against an archive."""
+
+from __future__ import annotations
+
+import json
+from collections import OrderedDict
+from time import monotonic
+from typing import Generic, Optional, TypeVar
+
+QueryKey = tuple[str, str]
+V = TypeVar("V")
+
+
+class QueryCache(Generic[V]):
+    """
+    Bounded LRU cache of remote query results, with entries expiring after `ttl` seconds.
+
+    Results are usually query IDs. Queries which had no answers are cached as None, so that a
+    study which isn't in an archive isn't looked for again straight away.
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 300) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[QueryKey, tuple[float, Optional[V]]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def key(modality: str, query: dict) -> QueryKey:
+        """Key for a query, the same however the query dictionary is ordered."""
+        return modality, json.dumps(query, sort_keys=True, separators=(",", ":"))
+
+    def get(self, key: QueryKey) -> tuple[bool, Optional[V]]:
+        """
+        Look up a query.
+
+        :return: whether the query was found, and if so the cached result (None if no answers)
+        """
+        entry = self._entries.get(key)
+        if entry is None or monotonic() - entry[0] > self.ttl:
+            self._entries.pop(key, None)
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[1]
+
+    def put(self, key: QueryKey, result: Optional[V]) -> None:
+        """Cache the result of a query, evicting the least recently used entry if full."""
+        if self.max_size <= 0:
+            return
+        self._entries[key] = (monotonic(), result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: QueryKey) -> None:
+        """Forget a query, for example if Orthanc no longer has its answers."""
+        self._entries.pop(key, None)
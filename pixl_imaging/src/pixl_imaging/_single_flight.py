@@ -0,0 +1,92 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Coordination of concurrent messages which refer to the same study."""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+from collections import Counter
+from typing import TYPE_CHECKING, Generic, TypeVar
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    from collections.abc import AsyncIterator, Awaitable, Callable, Hashable
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    """
+    Share one run of a coroutine between all concurrent callers with the same key.
+
+    The first caller for a key starts the coroutine as a task, and callers arriving while it is
+    still running wait for the same task instead of starting their own. All of them get its
+    result or exception. Once the task has finished, the next caller starts a new run.
+    """
+
+    def __init__(self) -> None:
+        self._tasks: dict[Hashable, asyncio.Task[T]] = {}
+
+    @property
+    def in_flight(self) -> int:
+        """Number of keys with a running task."""
+        return len(self._tasks)
+
+    async def run(self, key: Hashable, coroutine_function: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run `coroutine_function()` for the key, or wait for the run which is already in flight.
+
+        :param coroutine_function: only called if there isn't already a run in flight for the key
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(coroutine_function())
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            logger.debug("Waiting for in-flight run for {}", key)
+        # shield so that one caller being cancelled doesn't cancel the run for the others
+        return await asyncio.shield(task)
+
+    def _forget(self, key: Hashable, task: asyncio.Task[T]) -> None:
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+
+class KeyedLock:
+    """Mutual exclusion per key, only keeping locks for keys which are in use."""
+
+    def __init__(self) -> None:
+        self._locks: dict[Hashable, asyncio.Lock] = {}
+        self._users: Counter[Hashable] = Counter()
+
+    def locked(self, key: Hashable) -> bool:
+        """Is the lock for the key held, or being waited for?"""
+        return key in self._locks
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        """Hold the lock for the key for the duration of the context."""
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._users[key] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._users[key] -= 1
+            if self._users[key] <= 0:
+                del self._users[key]
+                del self._locks[key]
@@ -0,0 +1,167 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Traces of how long each stage of processing a study takes.
+
+Each message is traced with `trace_study()`, and stages within it are recorded with `span()`.
+When the message has been processed, its trace is written as one line of JSON to the trace
+sink, if one has been set up with `add_trace_sink()`. `pixl traces` summarises the files.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import datetime
+import json
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import TYPE_CHECKING, Any, Optional
+
+from loguru import logger
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from pathlib import Path
+
+    from loguru import Record
+
+# Key in the extra dict of loguru records which marks them as traces
+TRACE_EXTRA_KEY = "pixl_trace"
+
+_current_trace: ContextVar[Optional[StudyTrace]] = ContextVar("pixl_study_trace", default=None)
+_trace_sink_id: Optional[int] = None
+
+
+@dataclass
+class StudyTrace:
+    """Spans recorded while processing one message."""
+
+    identifier: str
+    study_uid: str
+    archive: str
+    started: datetime.datetime = field(
+        default_factory=lambda: datetime.datetime.now(tz=datetime.timezone.utc)
+    )
+    spans: list[dict[str, Any]] = field(default_factory=list)
+    _start: float = field(default_factory=monotonic)
+
+    def add_span(self, name: str, start: float, end: float) -> None:
+        """Record a span, with times from `monotonic()`."""
+        self.spans.append(
+            {"name": name, "start": round(start - self._start, 6), "seconds": round(end - start, 6)}
+        )
+
+    def to_json(self, outcome: str) -> str:
+        """One line of JSON for the trace."""
+        return json.dumps(
+            {
+                "identifier": self.identifier,
+                "study_uid": self.study_uid,
+                "archive": self.archive,
+                "started": self.started.isoformat(),
+                "seconds": round(monotonic() - self._start, 6),
+                "outcome": outcome,
+                "spans": self.spans,
+            }
+        )
+
+
+def add_trace_sink(path: Path, rotation: str, retention: int) -> None:
+    """
+    Write traces to a JSONL file, and start tracing messages.
+
+    :param rotation: when to start a new file, e.g. "100 MB" or "1 day"
+    :param retention: number of old files to keep
+    """
+    global _trace_sink_id
+    remove_trace_sink()
+    _trace_sink_id = logger.add(
+        path,
+        format="{message}",
+        filter=is_trace,
+        rotation=rotation,
+        retention=retention,
+        enqueue=True,
+    )
+    logger.info("Writing study traces to {}", path)
+
+
+def remove_trace_sink() -> None:
+    """Stop tracing messages, after writing any traces still queued for the sink."""
+    global _trace_sink_id
+    if _trace_sink_id is not None:
+        logger.remove(_trace_sink_id)
+        _trace_sink_id = None
+
+
+def is_trace(record: Record) -> bool:
+    """Is this log record a trace, which should only be written to the trace sink?"""
+    return TRACE_EXTRA_KEY in record["extra"]
+
+
+def is_not_trace(record: Record) -> bool:
+    """Filter for other sinks, so that traces aren't logged there too."""
+    return not is_trace(record)
+
+
+@contextlib.contextmanager
+def trace_study(identifier: str, study_uid: str, archive: str) -> Iterator[None]:
+    """Trace processing a message, writing the trace when done if there is a trace sink."""
+    if _trace_sink_id is None:
+        yield
+        return
+
+    trace = StudyTrace(identifier=identifier, study_uid=study_uid, archive=archive)
+    token = _current_trace.set(trace)
+    outcome = "success"
+    try:
+        yield
+    except BaseException as exception:
+        # including cancellation, e.g. on shutdown, which mustn't be counted as a success
+        outcome = type(exception).__name__
+        raise
+    finally:
+        _current_trace.reset(token)
+        logger.bind(**{TRACE_EXTRA_KEY: True}).info(trace.to_json(outcome))
+
+
+def current_trace() -> Optional[StudyTrace]:
+    """Trace of the message being processed, if it is traced."""
+    return _current_trace.get()
+
+
+@contextlib.contextmanager
+def resume_trace(trace: Optional[StudyTrace]) -> Iterator[None]:
+    """Record spans to a trace started in another task, e.g. by a stage of the pipeline."""
+    token = _current_trace.set(trace)
+    try:
+        yield
+    finally:
+        _current_trace.reset(token)
+
+
+@contextlib.contextmanager
+def span(name: str) -> Iterator[None]:
+    """Record how long a stage of processing the current message takes, if it is traced."""
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    start = monotonic()
+    try:
+        yield
+    finally:
+        trace.add_span(name, start, monotonic())
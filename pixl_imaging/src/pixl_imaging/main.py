@@ -16,17 +16,28 @@
 from __future__ import annotations
 
 import asyncio
+import functools
 import importlib.metadata
 import sys
+from pathlib import Path
+from typing import TYPE_CHECKING
 
 from core.patient_queue.subscriber import PixlConsumer
 from core.rest_api.router import router, state
+from core.token_buffer.controller import RateController
+from core.token_buffer.schedule import load_rate_schedule
 from decouple import config
 from fastapi import FastAPI
 from fastapi.responses import JSONResponse
 from loguru import logger
 
-from ._processing import DicomModality, process_message
+from ._orthanc import PIXLRawOrthanc
+from ._pipeline import ImagingPipeline
+from ._processing import DicomModality, is_secondary_archive_available, process_message
+from ._tracing import add_trace_sink, is_not_trace, remove_trace_sink
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
 
 QUEUE_NAME = "imaging-primary"
 SECONDARY_QUEUE_NAME = "imaging-secondary"
@@ -44,10 +55,18 @@ logger.remove()  # Remove all handlers added so far, including the default one.
 logging_level = config("LOG_LEVEL", default="INFO")
 if not logging_level:
     logging_level = "INFO"
-logger.add(sys.stderr, level=logging_level)
+logger.add(sys.stderr, level=logging_level, filter=is_not_trace)
 
 logger.warning("Running logging at level {}", logging_level)
 
+trace_file = config("PIXL_TRACE_FILE", default="")
+if trace_file:
+    add_trace_sink(
+        Path(trace_file),
+        rotation=config("PIXL_TRACE_ROTATION", default="100 MB"),
+        retention=config("PIXL_TRACE_RETENTION", default=10, cast=int),
+    )
+
 
 @app.on_event("startup")
 async def startup_event() -> None:
@@ -56,20 +75,67 @@ async def startup_event() -> None:
     i.e. concurrently with the current task and all other tasks,
     switching between them at await points
     the task is consumer.run and the callback is _processing.process_message
+
+    Both consumers share one Orthanc Raw connection, so that its connection pool is reused
+    for the lifetime of the process. The secondary consumer only consumes while the secondary
+    archive may be queried, leaving messages in its queue during the day and at weekends.
+
+    If PIXL_RATE_SCHEDULE_FILE is set, the token bucket's rates follow its schedule. If
+    PIXL_RATE_CONTROLLER is set, the token bucket's rates are adjusted automatically
+    between PIXL_RATE_CONTROLLER_MIN_RATE and PIXL_RATE_CONTROLLER_MAX_RATE.
+
+    Messages in each archive and stage are limited by PIXL_LIMIT_<NAME>, see `ConcurrencyLimits`,
+    and the limits can be changed through the `/concurrency-limits` endpoint.
+
+    If PIXL_PIPELINE is set, messages are processed by an `ImagingPipeline` with separate pools of
+    workers for finding, moving, tagging and storing studies, rather than one coroutine each.
     """
+    rate_schedule_file = config("PIXL_RATE_SCHEDULE_FILE", default="")
+    if rate_schedule_file:
+        state.token_bucket.schedule = load_rate_schedule(Path(rate_schedule_file))
+
+    orthanc_raw = PIXLRawOrthanc()
+    app.state.orthanc_raw = orthanc_raw
     background_tasks = set()
+
+    if config("PIXL_RATE_CONTROLLER", default=False, cast=bool):
+        state.rate_controller = RateController(
+            state.token_bucket,
+            min_rate=config("PIXL_RATE_CONTROLLER_MIN_RATE", default=0.1, cast=float),
+            max_rate=config("PIXL_RATE_CONTROLLER_MAX_RATE", default=5, cast=float),
+            interval=config("PIXL_RATE_CONTROLLER_INTERVAL", default=30, cast=float),
+            pending_jobs=orthanc_raw.count_pending_jobs,
+        )
+        task = asyncio.create_task(state.rate_controller.run())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+    process: Callable[..., Awaitable[None]] = functools.partial(
+        process_message,
+        orthanc_raw=orthanc_raw,
+        rate_controller=state.rate_controller,
+        limits=state.concurrency_limits,
+    )
+    if config("PIXL_PIPELINE", default=False, cast=bool):
+        app.state.pipeline = ImagingPipeline.from_config(
+            orthanc_raw, rate_controller=state.rate_controller, limits=state.concurrency_limits
+        )
+        app.state.pipeline.start()
+        process = app.state.pipeline.process_message
+
     async with (
         PixlConsumer(
             QUEUE_NAME,
             token_bucket=state.token_bucket,
             token_bucket_key="primary",  # noqa: S106
-            callback=lambda message: process_message(message, archive=DicomModality.primary),
+            callback=lambda message: process(message, archive=DicomModality.primary),
         ) as primary_consumer,
         PixlConsumer(
             SECONDARY_QUEUE_NAME,
             token_bucket=state.token_bucket,
             token_bucket_key="secondary",  # noqa: S106
-            callback=lambda message: process_message(message, archive=DicomModality.secondary),
+            callback=lambda message: process(message, archive=DicomModality.secondary),
+            is_active=is_secondary_archive_available,
         ) as secondary_consumer,
     ):
         task = asyncio.create_task(primary_consumer.run())
@@ -79,3 +145,12 @@ async def startup_event() -> None:
         task = asyncio.create_task(secondary_consumer.run())
         background_tasks.add(task)
         task.add_done_callback(background_tasks.discard)
+
+
+@app.on_event("shutdown")
+async def shutdown_event() -> None:
+    """Stop the pipeline, release the Orthanc Raw connection pool, and finish writing traces."""
+    if getattr(app.state, "pipeline", None) is not None:
+        await app.state.pipeline.stop()
+    await app.state.orthanc_raw.close()
+    remove_trace_sink()
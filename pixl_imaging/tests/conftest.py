@@ -13,14 +13,23 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+from __future__ import annotations
+
 import os
 import shlex
-import subprocess
 from pathlib import Path
+from typing import TYPE_CHECKING, Any
 
 import pytest
+import pytest_asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
 from pytest_pixl.helpers import run_subprocess
 
+if TYPE_CHECKING:
+    import subprocess
+    from collections.abc import AsyncGenerator
+
 os.environ["TEST"] = "true"
 os.environ["LOG_LEVEL"] = "DEBUG"
 os.environ["RABBITMQ_PASSWORD"] = "guest"
@@ -65,3 +74,51 @@ def run_containers() -> subprocess.CompletedProcess[bytes]:
         TEST_DIR,
         timeout=60,
     )
+
+
+class FakeOrthanc:
+    """
+    Minimal stand-in for the Orthanc REST API, for tests which don't need the docker containers.
+
+    Responses are looked up by (method, path including query string), and can either be JSON
+    serialisable values or async callables taking the request and returning one.
+    """
+
+    def __init__(self) -> None:
+        self.responses: dict[tuple[str, str], Any] = {}
+        self.requests: list[tuple[str, str]] = []
+        self.peers: set[Any] = set()
+        self.url = ""
+        self.app = web.Application()
+        self.app.router.add_route("*", "/{path:.*}", self._handle)
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        key = (request.method, request.path_qs)
+        self.requests.append(key)
+        self.peers.add(request.transport.get_extra_info("peername"))
+        if key not in self.responses:
+            return web.json_response({}, status=404)
+        response = self.responses[key]
+        if callable(response):
+            response = await response(request)
+        return web.json_response(response)
+
+
+@pytest_asyncio.fixture()
+async def fake_orthanc() -> AsyncGenerator[FakeOrthanc, None]:
+    """Serve a FakeOrthanc on a local port."""
+    fake = FakeOrthanc()
+    async with TestServer(fake.app) as server:
+        fake.url = str(server.make_url(""))
+        yield fake
+
+
+@pytest_asyncio.fixture()
+async def fake_orthanc_raw(fake_orthanc, monkeypatch) -> AsyncGenerator[Any, None]:
+    """PIXLRawOrthanc connected to the FakeOrthanc server."""
+    from pixl_imaging._orthanc import PIXLRawOrthanc
+
+    monkeypatch.setenv("ORTHANC_RAW_URL", fake_orthanc.url)
+    monkeypatch.setenv("PIXL_ORTHANC_CONNECTION_LIMIT_PER_HOST", "1")
+    async with PIXLRawOrthanc() as orthanc_raw:
+        yield orthanc_raw
@@ -0,0 +1,130 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests for batching study lookups, using a fake Orthanc server rather than docker."""
+
+from __future__ import annotations
+
+import asyncio
+
+import aiohttp
+import pytest
+from pixl_imaging._orthanc import RemoteQuery
+
+ARCHIVE_STUDY_UIDS = ["1.1", "1.2"]
+
+
+@pytest.fixture()
+def archive(fake_orthanc) -> list[str]:
+    """An archive which has two studies, returning the UIDs it is queried for."""
+    queried_uids = []
+
+    async def query(request) -> dict:
+        queried_uids.append((await request.json())["Query"]["StudyInstanceUID"])
+        return {"ID": "batch-query"}
+
+    fake_orthanc.responses[("POST", "/modalities/PRIMARY/query")] = query
+    fake_orthanc.responses[("GET", "/queries/batch-query/answers")] = ["0", "1"]
+    for answer_id, study_uid in enumerate(ARCHIVE_STUDY_UIDS):
+        fake_orthanc.responses[("GET", f"/queries/batch-query/answers/{answer_id}/content")] = {
+            "0020,000d": {"Name": "StudyInstanceUID", "Type": "String", "Value": study_uid}
+        }
+    return queried_uids
+
+
+@pytest.mark.asyncio()
+async def test_study_lookups_are_batched(archive, fake_orthanc_raw, monkeypatch) -> None:
+    """
+    Given study lookup batching is enabled
+    When several studies are looked up at once, one of which isn't in the archive
+    Then the archive is queried once with all the UIDs, and each lookup gets its own answer
+    """
+    monkeypatch.setenv("PIXL_STUDY_QUERY_BATCH_SIZE", "10")
+    monkeypatch.setenv("PIXL_STUDY_QUERY_BATCH_WINDOW", "0.05")
+
+    found = await asyncio.gather(
+        *(
+            fake_orthanc_raw.find_remote_study_by_uid(study_uid, modality="PRIMARY")
+            for study_uid in ("1.2", "1.1", "9.9")
+        )
+    )
+
+    assert found == [RemoteQuery("batch-query", "1"), RemoteQuery("batch-query", "0"), None]
+    assert archive == ["1.2\\1.1\\9.9"]
+
+
+@pytest.mark.asyncio()
+async def test_full_batch_sent_straight_away(archive, fake_orthanc_raw, monkeypatch) -> None:
+    """
+    Given study lookup batching with a long window
+    When enough studies to fill a batch are looked up
+    Then the batch is sent without waiting for the window to end
+    """
+    monkeypatch.setenv("PIXL_STUDY_QUERY_BATCH_SIZE", "2")
+    monkeypatch.setenv("PIXL_STUDY_QUERY_BATCH_WINDOW", "60")
+
+    found = await asyncio.wait_for(
+        asyncio.gather(
+            *(
+                fake_orthanc_raw.find_remote_study_by_uid(study_uid, modality="PRIMARY")
+                for study_uid in ARCHIVE_STUDY_UIDS
+            )
+        ),
+        timeout=5,
+    )
+
+    assert found == [RemoteQuery("batch-query", "0"), RemoteQuery("batch-query", "1")]
+
+
+@pytest.mark.asyncio()
+async def test_batch_failure_raised_for_each_lookup(fake_orthanc_raw, monkeypatch) -> None:
+    """
+    Given an archive which can't be queried
+    When a batch of studies is looked up
+    Then every lookup raises the error
+    """
+    monkeypatch.setenv("PIXL_STUDY_QUERY_BATCH_SIZE", "10")
+    monkeypatch.setenv("PIXL_STUDY_QUERY_BATCH_WINDOW", "0.05")
+
+    found = await asyncio.gather(
+        *(
+            fake_orthanc_raw.find_remote_study_by_uid(study_uid, modality="PRIMARY")
+            for study_uid in ARCHIVE_STUDY_UIDS
+        ),
+        return_exceptions=True,
+    )
+
+    assert all(isinstance(result, aiohttp.ClientResponseError) for result in found)
+
+
+@pytest.mark.asyncio()
+async def test_batched_lookups_are_cached(archive, fake_orthanc_raw, monkeypatch) -> None:
+    """
+    Given study lookup batching is enabled
+    When studies are looked up again, one of which wasn't in the archive
+    Then the archive isn't queried again, and the study which wasn't found still isn't
+    """
+    monkeypatch.setenv("PIXL_STUDY_QUERY_BATCH_SIZE", "10")
+    monkeypatch.setenv("PIXL_STUDY_QUERY_BATCH_WINDOW", "0.05")
+    study_uids = ("1.1", "9.9")
+
+    for _ in range(2):
+        found = await asyncio.gather(
+            *(
+                fake_orthanc_raw.find_remote_study_by_uid(study_uid, modality="PRIMARY")
+                for study_uid in study_uids
+            )
+        )
+        assert found == [RemoteQuery("batch-query", "0"), None]
+
+    assert archive == ["1.1\\9.9"]
@@ -0,0 +1,176 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests for checkpoints of the stages each study has completed."""
+
+from __future__ import annotations
+
+import datetime
+from typing import TYPE_CHECKING, Any
+
+import pytest
+from core.patient_queue.message import Message
+from pixl_imaging import _checkpoints, _pipeline
+from pixl_imaging._checkpoints import StudyCheckpoints
+from pixl_imaging._orthanc import RemoteQuery
+from pixl_imaging._pipeline import ImagingPipeline
+from pixl_imaging._processing import DicomModality, ImagingStudy
+from sqlalchemy.exc import OperationalError
+
+if TYPE_CHECKING:
+    from collections.abc import Awaitable, Callable
+
+NOW = datetime.datetime.now(tz=datetime.timezone.utc)
+
+
+@pytest.fixture()
+def message() -> Message:
+    return Message(
+        mrn="mrn",
+        accession_number="accession",
+        study_uid="1",
+        study_date=datetime.date.fromisoformat("2024-01-01"),
+        procedure_occurrence_id=1,
+        project_name="test-project",
+        extract_generated_timestamp=NOW,
+    )
+
+
+@pytest.fixture()
+def progress(monkeypatch) -> dict[str, Any]:
+    """Progress of the message's image in a fake database, with checkpoints enabled."""
+    progress: dict[str, Any] = dict.fromkeys(
+        ["found_at", "query_id", "query_answer_id", "retrieved_at", "tagged_at", "sent_at"]
+    )
+
+    def update_study_progress(*_image_key: object, **values: Any) -> None:
+        progress.update(values)
+
+    monkeypatch.setenv("PIXL_STAGE_CHECKPOINTS", "true")
+    monkeypatch.setattr(_checkpoints, "get_study_progress", lambda *_image_key: dict(progress))
+    monkeypatch.setattr(_checkpoints, "update_study_progress", update_study_progress)
+    return progress
+
+
+@pytest.mark.asyncio()
+async def test_recent_stages_are_done(message, progress) -> None:
+    """
+    Given an image which was found yesterday and retrieved a minute ago
+    When its checkpoints are loaded
+    Then only the retrieval counts as done
+    """
+    progress.update(
+        found_at=NOW - datetime.timedelta(days=1),
+        query_id="query-1",
+        retrieved_at=NOW - datetime.timedelta(minutes=1),
+    )
+
+    checkpoints = await StudyCheckpoints.load(message)
+
+    assert checkpoints.is_done("retrieved")
+    assert not checkpoints.is_done("found")
+    assert checkpoints.query is None
+
+
+@pytest.mark.asyncio()
+async def test_record_clears_later_stages(message, progress) -> None:
+    """
+    Given an image which was recently retrieved, tagged and sent
+    When it is found again
+    Then the query is recorded, and the later stages are no longer done
+    """
+    progress.update(retrieved_at=NOW, tagged_at=NOW, sent_at=NOW)
+    checkpoints = await StudyCheckpoints.load(message)
+
+    await checkpoints.record("found", RemoteQuery("query-2", "0"))
+
+    assert progress["query_id"] == "query-2"
+    assert progress["query_answer_id"] == "0"
+    assert progress["retrieved_at"] is None
+    assert progress["sent_at"] is None
+    assert checkpoints.completed.keys() == {"found"}
+    assert (await StudyCheckpoints.load(message)).query == RemoteQuery("query-2", "0")
+
+
+@pytest.mark.asyncio()
+async def test_disabled_checkpoints_do_nothing(message, progress, monkeypatch) -> None:
+    """Checks that without PIXL_STAGE_CHECKPOINTS no stages are done or recorded."""
+    monkeypatch.setenv("PIXL_STAGE_CHECKPOINTS", "false")
+    progress.update(sent_at=NOW)
+
+    checkpoints = await StudyCheckpoints.load(message)
+    await checkpoints.record("retrieved")
+
+    assert not checkpoints.is_done("sent")
+    assert progress["retrieved_at"] is None
+
+
+@pytest.mark.asyncio()
+async def test_database_errors_are_not_raised(message, monkeypatch) -> None:
+    """Checks that processing can carry on without checkpoints if the database fails."""
+
+    def fail(*_args: object, **_kwargs: object) -> None:
+        statement = "SELECT"
+        raise OperationalError(statement, {}, ConnectionRefusedError())
+
+    monkeypatch.setenv("PIXL_STAGE_CHECKPOINTS", "true")
+    monkeypatch.setattr(_checkpoints, "get_study_progress", fail)
+    monkeypatch.setattr(_checkpoints, "update_study_progress", fail)
+
+    checkpoints = await StudyCheckpoints.load(message)
+    await checkpoints.record("found", RemoteQuery("query-1"))
+
+    assert not checkpoints.completed
+
+
+@pytest.mark.asyncio()
+async def test_pipeline_resumes_from_checkpoints(message, progress, monkeypatch) -> None:
+    """
+    Given an image which was retrieved a minute ago, and is still in Orthanc Raw
+    When its message is processed by the imaging pipeline
+    Then the study isn't found or moved again, and tagging and sending it are recorded
+    """
+    calls = []
+
+    def record_call(name: str) -> Callable[..., Awaitable[bool]]:
+        async def call(*_args: object) -> bool:
+            calls.append(name)
+            return True
+
+        return call
+
+    async def add_project(*_args: object) -> dict:
+        return {"ID": "study-1"}
+
+    async def query_local(*_args: object, **_kwargs: object) -> list[str]:
+        return ["study-1"]
+
+    monkeypatch.setattr(ImagingStudy, "query_local", query_local)
+    monkeypatch.setattr(
+        _pipeline, "_wait_until_archive_can_be_queried", record_call("pending_jobs")
+    )
+    monkeypatch.setattr(_pipeline, "_find_study", record_call("find"))
+    monkeypatch.setattr(_pipeline, "_retrieve_found_study", record_call("move"))
+    monkeypatch.setattr(_pipeline, "_add_project_to_study_if_missing", add_project)
+    monkeypatch.setattr(_pipeline, "_send_study_to_anon", record_call("store"))
+    progress.update(retrieved_at=NOW - datetime.timedelta(minutes=1))
+
+    workers = {"find": 1, "move": 1, "tag": 1, "store": 1}
+    async with ImagingPipeline(orthanc_raw=None, workers=workers) as pipeline:  # type: ignore[arg-type]
+        await pipeline.process_message(message, DicomModality.primary)
+        assert calls == ["store"]
+        assert progress["tagged_at"] is not None
+        assert progress["sent_at"] is not None
+
+        await pipeline.process_message(message, DicomModality.primary)
+        assert calls == ["store"]
@@ -229,6 +229,7 @@ async def orthanc_raw(run_containers) -> PIXLRawOrthanc:
         all_studies = await orthanc_raw._get("/studies")
         for study in all_studies:
             await orthanc_raw.delete(f"/studies/{study}")
+        await orthanc_raw.close()
 
 
 @pytest.mark.processing()
@@ -0,0 +1,211 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests for waiting on Orthanc jobs, using a fake Orthanc server rather than docker."""
+
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import TYPE_CHECKING
+
+import pytest
+from core.exceptions import PixlDiscardError, PixlRequeueMessageError
+from pixl_imaging._jobs import JobAdmissionController, JobsSnapshot, JobWatcher
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+
+
+def _jobs_finishing_after(polls: int, state: str = "Success") -> tuple[Callable, dict]:
+    """Jobs list response where the jobs are running until they have been polled enough times."""
+    count = {"polls": 0}
+
+    async def jobs(_request) -> list[dict]:
+        count["polls"] += 1
+        job_state = state if count["polls"] > polls else "Running"
+        return [
+            {"ID": "job-1", "State": job_state, "ErrorCode": 0, "ErrorDescription": "Success"},
+            {"ID": "job-2", "State": job_state, "ErrorCode": 9, "ErrorDescription": "Bad file"},
+        ]
+
+    return jobs, count
+
+
+@pytest.mark.asyncio()
+async def test_concurrent_jobs_share_polling(fake_orthanc, fake_orthanc_raw) -> None:
+    """
+    Given two jobs which finish quickly
+    When two coroutines wait for them
+    Then both return well within the maximum poll interval, from a single polling loop
+    """
+    jobs, count = _jobs_finishing_after(polls=2)
+    fake_orthanc.responses[("GET", "/jobs?expand")] = jobs
+
+    start = time.monotonic()
+    await asyncio.gather(
+        fake_orthanc_raw.wait_for_job_success_or_raise("job-1", "c-move", timeout=5),
+        fake_orthanc_raw.wait_for_job_success_or_raise("job-1", "c-move", timeout=5),
+    )
+
+    assert time.monotonic() - start < 2
+    assert count["polls"] == 3
+    assert ("GET", "/jobs/job-1") not in fake_orthanc.requests
+
+
+@pytest.mark.asyncio()
+async def test_failed_job_raises(fake_orthanc, fake_orthanc_raw) -> None:
+    """
+    Given a job which fails
+    When waiting for it
+    Then a PixlDiscardError is raised with Orthanc's error
+    """
+    jobs, _ = _jobs_finishing_after(polls=0, state="Failure")
+    fake_orthanc.responses[("GET", "/jobs?expand")] = jobs
+
+    with pytest.raises(PixlDiscardError, match="Error code=9 Cause=Bad file"):
+        await fake_orthanc_raw.wait_for_job_success_or_raise("job-2", "modify", timeout=5)
+
+
+@pytest.mark.asyncio()
+async def test_job_timeout_raises(fake_orthanc, fake_orthanc_raw) -> None:
+    """
+    Given a job which never finishes
+    When waiting for it with a timeout
+    Then a PixlDiscardError is raised after the timeout, and the job is no longer watched
+    """
+    jobs, _ = _jobs_finishing_after(polls=1000)
+    fake_orthanc.responses[("GET", "/jobs?expand")] = jobs
+
+    with pytest.raises(PixlDiscardError, match="Failed to finish c-store job job-1 in 0.3 seconds"):
+        await fake_orthanc_raw.wait_for_job_success_or_raise("job-1", "c-store", timeout=0.3)
+    assert fake_orthanc_raw._job_watcher.watched_jobs == 0
+
+
+@pytest.mark.asyncio()
+async def test_job_missing_from_history(fake_orthanc, fake_orthanc_raw) -> None:
+    """
+    Given a job which has dropped out of Orthanc's jobs list
+    When waiting for it
+    Then its state is looked up directly
+    """
+    fake_orthanc.responses[("GET", "/jobs?expand")] = []
+    fake_orthanc.responses[("GET", "/jobs/job-3")] = {"ID": "job-3", "State": "Success"}
+
+    await fake_orthanc_raw.wait_for_job_success_or_raise("job-3", "c-move", timeout=5)
+
+
+@pytest.mark.asyncio()
+async def test_failed_poll_is_retried(fake_orthanc, fake_orthanc_raw, monkeypatch) -> None:
+    """
+    Given a jobs list request which times out once
+    When waiting for a job
+    Then the jobs are polled again and the job still finishes
+    """
+    jobs, _ = _jobs_finishing_after(polls=0)
+    fake_orthanc.responses[("GET", "/jobs?expand")] = jobs
+    get_jobs = fake_orthanc_raw.get_jobs
+    calls = {"count": 0}
+
+    async def get_jobs_timing_out_once() -> list[dict]:
+        calls["count"] += 1
+        if calls["count"] == 1:
+            raise TimeoutError
+        return await get_jobs()
+
+    monkeypatch.setattr(fake_orthanc_raw, "get_jobs", get_jobs_timing_out_once)
+
+    await fake_orthanc_raw.wait_for_job_success_or_raise("job-1", "c-move", timeout=5)
+
+    assert calls["count"] == 2
+
+
+@pytest.mark.asyncio()
+async def test_jobs_snapshot_is_shared(fake_orthanc, fake_orthanc_raw) -> None:
+    """
+    Given a jobs snapshot with a time to live
+    When the jobs are requested several times concurrently
+    Then orthanc is only asked for its jobs once
+    """
+    fake_orthanc.responses[("GET", "/jobs?expand")] = [{"ID": "job-1", "State": "Running"}]
+    snapshot = JobsSnapshot(fake_orthanc_raw, ttl=60)
+
+    await asyncio.gather(*(snapshot.get() for _ in range(5)))
+
+    assert fake_orthanc.requests.count(("GET", "/jobs?expand")) == 1
+
+
+@pytest.mark.asyncio()
+async def test_admission_waits_for_pending_jobs(fake_orthanc, fake_orthanc_raw) -> None:
+    """
+    Given orthanc has a pending job which then starts running
+    When waiting for capacity to process a message
+    Then we wait rather than requeueing the message
+    """
+    count = {"polls": 0}
+
+    async def pending_jobs(_request) -> list[dict]:
+        count["polls"] += 1
+        return [{"ID": "job-1", "State": "Pending" if count["polls"] <= 3 else "Running"}]
+
+    fake_orthanc.responses[("GET", "/jobs?expand")] = pending_jobs
+    snapshot = JobsSnapshot(fake_orthanc_raw, ttl=0.05)
+    admission = JobAdmissionController(snapshot, JobWatcher(fake_orthanc_raw, snapshot), max_wait=5)
+
+    await admission.wait_for_capacity()
+
+    assert count["polls"] == 4
+
+
+@pytest.mark.asyncio()
+async def test_admission_requeues_after_waiting(fake_orthanc, fake_orthanc_raw) -> None:
+    """
+    Given orthanc has a pending job which doesn't start
+    When waiting for capacity to process a message
+    Then we give up and requeue the message
+    """
+    fake_orthanc.responses[("GET", "/jobs?expand")] = [{"ID": "job-1", "State": "Pending"}]
+    snapshot = JobsSnapshot(fake_orthanc_raw, ttl=0.05)
+    admission = JobAdmissionController(
+        snapshot, JobWatcher(fake_orthanc_raw, snapshot), max_wait=0.2
+    )
+
+    with pytest.raises(PixlRequeueMessageError, match="Pending messages in orthanc raw"):
+        await admission.wait_for_capacity()
+
+
+@pytest.mark.asyncio()
+async def test_admission_reserves_capacity(fake_orthanc, fake_orthanc_raw) -> None:
+    """
+    Given orthanc has a pending job which then starts running, and room for two more jobs
+    When four messages are waiting for capacity
+    Then only two of them are admitted, the others wait and are requeued
+    """
+    count = {"polls": 0}
+
+    async def pending_jobs(_request) -> list[dict]:
+        count["polls"] += 1
+        return [{"ID": "job-1", "State": "Pending" if count["polls"] <= 2 else "Running"}]
+
+    fake_orthanc.responses[("GET", "/jobs?expand")] = pending_jobs
+    snapshot = JobsSnapshot(fake_orthanc_raw, ttl=0.05)
+    admission = JobAdmissionController(
+        snapshot, JobWatcher(fake_orthanc_raw, snapshot), max_active_jobs=2, max_wait=0.3
+    )
+
+    results = await asyncio.gather(
+        *(admission.wait_for_capacity() for _ in range(4)), return_exceptions=True
+    )
+
+    assert results.count(None) == 2
+    assert sum(isinstance(result, PixlRequeueMessageError) for result in results) == 2
@@ -0,0 +1,114 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests for the Orthanc REST client, using a fake Orthanc server rather than docker."""
+
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+from pixl_imaging._query_cache import QueryCache
+
+
+@pytest.mark.asyncio()
+async def test_requests_reuse_pooled_connection(fake_orthanc, fake_orthanc_raw) -> None:
+    """
+    Given an Orthanc client limited to one connection per host
+    When several requests are made, some of them concurrently
+    Then they are all sent over the same keep-alive connection
+    """
+    fake_orthanc.responses[("GET", "/studies")] = ["a-study"]
+
+    for _ in range(3):
+        assert await fake_orthanc_raw._get("/studies") == ["a-study"]
+    await asyncio.gather(*(fake_orthanc_raw._get("/studies") for _ in range(5)))
+
+    assert len(fake_orthanc.requests) == 8
+    assert len(fake_orthanc.peers) == 1
+
+
+@pytest.mark.asyncio()
+async def test_session_recreated_after_close(fake_orthanc, fake_orthanc_raw) -> None:
+    """
+    Given an Orthanc client whose connection pool has been closed
+    When another request is made
+    Then a new pool is created and the request succeeds
+    """
+    fake_orthanc.responses[("GET", "/studies")] = []
+    await fake_orthanc_raw._get("/studies")
+    first_session = fake_orthanc_raw._session
+
+    await fake_orthanc_raw.close()
+    assert first_session.closed
+
+    assert await fake_orthanc_raw._get("/studies") == []
+    assert fake_orthanc_raw._session is not first_session
+
+
+@pytest.mark.asyncio()
+async def test_remote_queries_are_cached(fake_orthanc, fake_orthanc_raw) -> None:
+    """
+    Given a study found in one archive and not in another
+    When each archive is queried for it several times, with keys in a different order
+    Then each archive is only queried once, and both results are reused
+    """
+    fake_orthanc.responses[("POST", "/modalities/PRIMARY/query")] = {"ID": "query-1"}
+    fake_orthanc.responses[("POST", "/modalities/SECONDARY/query")] = {"ID": "query-2"}
+    fake_orthanc.responses[("GET", "/queries/query-1/answers")] = ["0"]
+    fake_orthanc.responses[("GET", "/queries/query-2/answers")] = []
+    query = {"Level": "Study", "Query": {"PatientID": "mrn", "AccessionNumber": "acc"}}
+    reordered_query = {"Query": {"AccessionNumber": "acc", "PatientID": "mrn"}, "Level": "Study"}
+
+    for data in (query, reordered_query, query):
+        assert await fake_orthanc_raw.query_remote(data, modality="PRIMARY") == "query-1"
+        assert await fake_orthanc_raw.query_remote(data, modality="SECONDARY") is None
+
+    assert fake_orthanc.requests.count(("POST", "/modalities/PRIMARY/query")) == 1
+    assert fake_orthanc.requests.count(("POST", "/modalities/SECONDARY/query")) == 1
+    assert fake_orthanc_raw._query_cache.misses == 2
+    assert fake_orthanc_raw._query_cache.hits == 4
+
+
+@pytest.mark.asyncio()
+async def test_forgotten_cached_query_is_repeated(fake_orthanc, fake_orthanc_raw) -> None:
+    """
+    Given a cached query which Orthanc has since dropped
+    When the archive is queried again
+    Then the query is run again rather than returning the dropped query
+    """
+    query = {"Level": "Study", "Query": {"StudyInstanceUID": "1"}}
+    fake_orthanc_raw._query_cache.put(fake_orthanc_raw._query_cache.key("PRIMARY", query), "old")
+    fake_orthanc.responses[("POST", "/modalities/PRIMARY/query")] = {"ID": "new"}
+    fake_orthanc.responses[("GET", "/queries/new/answers")] = ["0"]
+
+    assert await fake_orthanc_raw.query_remote(query, modality="PRIMARY") == "new"
+    assert ("POST", "/modalities/PRIMARY/query") in fake_orthanc.requests
+
+
+def test_query_cache_evicts_least_recently_used() -> None:
+    """
+    Given a full query cache
+    When another query is cached
+    Then the least recently used query is evicted
+    """
+    cache = QueryCache(max_size=2)
+    cache.put(("PRIMARY", "a"), "query-a")
+    cache.put(("PRIMARY", "b"), None)
+    cache.get(("PRIMARY", "a"))
+
+    cache.put(("PRIMARY", "c"), "query-c")
+
+    assert cache.get(("PRIMARY", "a")) == (True, "query-a")
+    assert cache.get(("PRIMARY", "b")) == (False, None)
+    assert len(cache) == 2
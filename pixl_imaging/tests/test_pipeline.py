@@ -0,0 +1,245 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests for processing messages as a pipeline of stages."""
+
+from __future__ import annotations
+
+import asyncio
+import datetime
+from collections import Counter
+
+import pytest
+from core.exceptions import PixlDiscardError
+from core.patient_queue.message import Message
+from pixl_imaging import _pipeline
+from pixl_imaging._pipeline import ImagingPipeline, Stage, StagedPipeline, StudyJob
+from pixl_imaging._processing import DicomModality, ImagingStudy
+
+
+def _job() -> StudyJob:
+    message = Message(
+        mrn="mrn",
+        accession_number="accession",
+        study_uid="1",
+        study_date=datetime.date.fromisoformat("2024-01-01"),
+        procedure_occurrence_id=1,
+        project_name="test project",
+        extract_generated_timestamp=datetime.datetime.now(tz=datetime.timezone.utc),
+    )
+    return StudyJob(
+        study=ImagingStudy.from_message(message),
+        archive=DicomModality.primary,
+        done=asyncio.get_running_loop().create_future(),
+    )
+
+
+class FakeStages:
+    """Stages recording each run, which fail a given number of times."""
+
+    def __init__(self, failures: dict[str, list[Exception]]) -> None:
+        self.failures = failures
+        self.runs: Counter[str] = Counter()
+        self.order: list[str] = []
+
+    def stage(self, name: str, workers: int = 1) -> Stage:
+        async def handler(_job: StudyJob) -> None:
+            self.runs[name] += 1
+            self.order.append(name)
+            await asyncio.sleep(0.001)
+            if self.failures.get(name):
+                raise self.failures[name].pop(0)
+
+        return Stage(name, handler, workers)
+
+
+@pytest.mark.asyncio()
+async def test_jobs_pass_through_stages_in_order() -> None:
+    """
+    Given a pipeline of find, move, tag and store stages
+    When several jobs are submitted
+    Then each goes through every stage once, in order
+    """
+    stages = FakeStages({})
+    names = ["find", "move", "tag", "store"]
+
+    async with StagedPipeline([stages.stage(name, workers=2) for name in names]) as pipeline:
+        await asyncio.gather(*(pipeline.submit(_job()) for _ in range(3)))
+
+    assert stages.runs == {name: 3 for name in names}
+
+
+@pytest.mark.asyncio()
+async def test_only_failed_stage_is_retried() -> None:
+    """
+    Given a pipeline whose move stage fails once
+    When a job is submitted
+    Then only the move stage is run again, and the job succeeds
+    """
+    stages = FakeStages({"move": [TimeoutError("c-move timed out")]})
+
+    async with StagedPipeline(
+        [stages.stage("find"), stages.stage("move"), stages.stage("store")], retry_delay=0.001
+    ) as pipeline:
+        await pipeline.submit(_job())
+
+    assert stages.order == ["find", "move", "move", "store"]
+
+
+@pytest.mark.asyncio()
+async def test_job_fails_after_max_attempts() -> None:
+    """
+    Given a pipeline whose move stage keeps failing
+    When a job is submitted
+    Then the job fails with the stage's error once it has been attempted max_attempts times
+    """
+    stages = FakeStages({"move": [TimeoutError("c-move timed out") for _ in range(5)]})
+
+    async with StagedPipeline(
+        [stages.stage("find"), stages.stage("move"), stages.stage("store")],
+        max_attempts=2,
+        retry_delay=0.001,
+    ) as pipeline:
+        with pytest.raises(TimeoutError, match="c-move timed out"):
+            await pipeline.submit(_job())
+
+    assert stages.runs == {"find": 1, "move": 2}
+
+
+@pytest.mark.asyncio()
+async def test_final_errors_are_not_retried() -> None:
+    """
+    Given a pipeline whose find stage discards the message
+    When a job is submitted
+    Then the job fails straight away, and later stages aren't run
+    """
+    stages = FakeStages({"find": [PixlDiscardError("Study not found")]})
+
+    async with StagedPipeline([stages.stage("find"), stages.stage("move")]) as pipeline:
+        with pytest.raises(PixlDiscardError):
+            await pipeline.submit(_job())
+
+    assert stages.runs == {"find": 1}
+
+
+@pytest.mark.asyncio()
+async def test_cleanup_runs_when_job_finishes() -> None:
+    """
+    Given a stage which holds a resource until the job finishes
+    When the job fails in a later stage
+    Then the resource is released
+    """
+    released = []
+
+    async def hold(job: StudyJob) -> None:
+        job.cleanup.callback(released.append, "lock")
+
+    async def fail(_job: StudyJob) -> None:
+        msg = "Study not found"
+        raise PixlDiscardError(msg)
+
+    async with StagedPipeline([Stage("tag", hold, 1), Stage("store", fail, 1)]) as pipeline:
+        with pytest.raises(PixlDiscardError):
+            await pipeline.submit(_job())
+
+    assert released == ["lock"]
+
+
+@pytest.mark.asyncio()
+async def test_imaging_pipeline_hands_results_between_stages(monkeypatch) -> None:
+    """
+    Given an imaging pipeline, with the archive and Orthanc calls replaced
+    When a message is processed
+    Then the study found is moved, the tagged resource is stored, and the study lock is released
+    """
+    calls = []
+
+    async def wait_until_archive_can_be_queried(*_args: object) -> None:
+        calls.append("pending_jobs")
+
+    async def find_study(*_args: object) -> str:
+        calls.append("find")
+        return "study-query"
+
+    async def retrieve_found_study(
+        _study, _orthanc_raw, _archive, study_query, *_args: object
+    ) -> None:
+        calls.append(f"move {study_query}")
+
+    async def add_project(*_args: object) -> dict:
+        calls.append("tag")
+        return {"ID": "study-1"}
+
+    async def send_study(resource, *_args: object) -> None:
+        calls.append(f"store {resource['ID']}")
+
+    monkeypatch.setattr(
+        _pipeline, "_wait_until_archive_can_be_queried", wait_until_archive_can_be_queried
+    )
+    monkeypatch.setattr(_pipeline, "_find_study", find_study)
+    monkeypatch.setattr(_pipeline, "_retrieve_found_study", retrieve_found_study)
+    monkeypatch.setattr(_pipeline, "_add_project_to_study_if_missing", add_project)
+    monkeypatch.setattr(_pipeline, "_send_study_to_anon", send_study)
+
+    workers = {"find": 1, "move": 1, "tag": 1, "store": 1}
+    async with ImagingPipeline(orthanc_raw=None, workers=workers) as pipeline:  # type: ignore[arg-type]
+        await pipeline.process_message(_job().study.message, DicomModality.primary)
+
+    assert calls == ["pending_jobs", "find", "move study-query", "tag", "store study-1"]
+    assert not _pipeline._study_locks._locks
+
+
+@pytest.mark.asyncio()
+async def test_failed_tag_releases_study_lock(monkeypatch) -> None:
+    """
+    Given an imaging pipeline with one tag worker, whose first attempt at tagging fails
+    When two messages for the same study are processed
+    Then the study lock is released before the failed tag is retried, so both messages finish
+    """
+    tagged = []
+
+    async def succeed(*_args: object) -> None:
+        return None
+
+    async def find_study(*_args: object) -> str:
+        return "study-query"
+
+    async def add_project(study: ImagingStudy, *_args: object) -> dict:
+        tagged.append(study.message.project_name)
+        if len(tagged) == 1:
+            msg = "Orthanc timed out"
+            raise TimeoutError(msg)
+        return {"ID": "study-1"}
+
+    monkeypatch.setattr(_pipeline, "_wait_until_archive_can_be_queried", succeed)
+    monkeypatch.setattr(_pipeline, "_find_study", find_study)
+    monkeypatch.setattr(_pipeline, "_retrieve_found_study", succeed)
+    monkeypatch.setattr(_pipeline, "_add_project_to_study_if_missing", add_project)
+    monkeypatch.setattr(_pipeline, "_send_study_to_anon", succeed)
+
+    workers = {"find": 2, "move": 2, "tag": 1, "store": 1}
+    messages = [_job().study.message for _ in range(2)]
+    async with ImagingPipeline(
+        orthanc_raw=None,  # type: ignore[arg-type]
+        workers=workers,
+        retry_delay=0.01,
+    ) as pipeline:
+        await asyncio.wait_for(
+            asyncio.gather(
+                *(pipeline.process_message(message, DicomModality.primary) for message in messages)
+            ),
+            timeout=5,
+        )
+
+    assert len(tagged) == 3
+    assert not _pipeline._study_locks._locks
@@ -0,0 +1,359 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests for working out what to retrieve, using a fake Orthanc server rather than docker."""
+
+from __future__ import annotations
+
+import datetime
+from pathlib import Path
+
+import pytest
+from core.exceptions import PixlDiscardError
+from core.patient_queue.message import Message
+from core.project_config import load_project_config
+from pixl_imaging._orthanc import RemoteQuery
+from pixl_imaging._processing import (
+    ImagingStudy,
+    _get_local_instances_by_series,
+    _get_missing_instances,
+    _project_series_filter,
+    _retrieve_missing_instances,
+    _retrieve_selected_series,
+    _retrieve_study,
+)
+
+PROJECT_CONFIGS_DIR = Path(__file__).parents[2] / "projects" / "configs"
+
+STUDY_UID = "1"
+STUDY_RESOURCE = {"ID": "study-1", "Series": ["series-1", "series-2"]}
+LOCAL_SERIES = [
+    {"ID": "series-1", "MainDicomTags": {"SeriesInstanceUID": "1.1"}, "Instances": ["i-1", "i-2"]},
+    {"ID": "series-2", "MainDicomTags": {"SeriesInstanceUID": "1.2"}, "Instances": ["i-3"]},
+]
+LOCAL_INSTANCES = {"i-1": "1.1.1", "i-2": "1.1.2", "i-3": "1.2.1"}
+
+
+@pytest.fixture()
+def study() -> ImagingStudy:
+    return ImagingStudy.from_message(
+        Message(
+            mrn="mrn",
+            accession_number="accession",
+            study_uid=STUDY_UID,
+            study_date=datetime.date.fromisoformat("2024-01-01"),
+            procedure_occurrence_id=1,
+            project_name="test project",
+            extract_generated_timestamp=datetime.datetime.now(tz=datetime.timezone.utc),
+        )
+    )
+
+
+def _local_instance(instance_id: str) -> dict:
+    parent_series = "series-1" if LOCAL_INSTANCES[instance_id].startswith("1.1.") else "series-2"
+    return {
+        "ID": instance_id,
+        "ParentSeries": parent_series,
+        "MainDicomTags": {"SOPInstanceUID": LOCAL_INSTANCES[instance_id]},
+    }
+
+
+def _answer_content(**tags: str) -> dict:
+    return {
+        f"tag-{i}": {"Name": name, "Value": value} for i, (name, value) in enumerate(tags.items())
+    }
+
+
+def _add_remote_answers(fake_orthanc, query_id: str, answers: list[dict]) -> None:
+    fake_orthanc.responses[("GET", f"/queries/{query_id}/answers")] = [
+        str(i) for i in range(len(answers))
+    ]
+    for i, answer in enumerate(answers):
+        fake_orthanc.responses[("GET", f"/queries/{query_id}/answers/{i}/content")] = (
+            _answer_content(**answer)
+        )
+
+
+@pytest.mark.asyncio()
+async def test_local_instances_listed_in_one_request(fake_orthanc, fake_orthanc_raw) -> None:
+    """
+    Given a study in orthanc raw
+    When getting the SOPInstanceUIDs of its instances
+    Then the series and instances are each listed in a single request
+    """
+    fake_orthanc.responses[("GET", "/studies/study-1/series")] = LOCAL_SERIES
+    fake_orthanc.responses[("GET", "/studies/study-1/instances")] = [
+        _local_instance(instance_id) for instance_id in LOCAL_INSTANCES
+    ]
+
+    uids = await _get_local_instances_by_series(fake_orthanc_raw, STUDY_RESOURCE)
+
+    assert uids == {"1.1": {"1.1.1", "1.1.2"}, "1.2": {"1.2.1"}}
+    assert len(fake_orthanc.requests) == 2
+
+
+@pytest.mark.asyncio()
+async def test_local_instances_fallback(fake_orthanc, fake_orthanc_raw) -> None:
+    """
+    Given an orthanc which can't list all instances of a study at once
+    When getting the SOPInstanceUIDs of the study's instances
+    Then each series and instance is queried instead
+    """
+    for series in LOCAL_SERIES:
+        fake_orthanc.responses[("GET", f"/series/{series['ID']}")] = series
+    for instance_id in LOCAL_INSTANCES:
+        fake_orthanc.responses[("GET", f"/instances/{instance_id}")] = _local_instance(instance_id)
+
+    uids = await _get_local_instances_by_series(fake_orthanc_raw, STUDY_RESOURCE)
+
+    assert uids == {"1.1": {"1.1.1", "1.1.2"}, "1.2": {"1.2.1"}}
+
+
+@pytest.mark.asyncio()
+async def test_missing_instances_only_queried_for_incomplete_series(
+    fake_orthanc, fake_orthanc_raw, study
+) -> None:
+    """
+    Given a study in orthanc raw with one complete series, and a series missing an instance
+    When checking the archive for missing instances
+    Then only the incomplete series is queried at instance level, and the missing instance found
+    """
+    fake_orthanc.responses[("GET", "/studies/study-1/series")] = LOCAL_SERIES
+    fake_orthanc.responses[("GET", "/studies/study-1/instances")] = [
+        _local_instance(instance_id) for instance_id in LOCAL_INSTANCES
+    ]
+    fake_orthanc.responses[("GET", "/queries/study-query/answers")] = ["0"]
+    fake_orthanc.responses[("POST", "/queries/study-query/answers/0/query-series")] = {
+        "ID": "series-query"
+    }
+    _add_remote_answers(
+        fake_orthanc,
+        "series-query",
+        [
+            {"SeriesInstanceUID": "1.1", "NumberOfSeriesRelatedInstances": "2"},
+            {"SeriesInstanceUID": "1.2", "NumberOfSeriesRelatedInstances": "2"},
+        ],
+    )
+    fake_orthanc.responses[("POST", "/queries/series-query/answers/1/query-instances")] = {
+        "ID": "instances-query"
+    }
+    _add_remote_answers(
+        fake_orthanc,
+        "instances-query",
+        [
+            {"StudyInstanceUID": STUDY_UID, "SeriesInstanceUID": "1.2", "SOPInstanceUID": uid}
+            for uid in ("1.2.1", "1.2.2")
+        ],
+    )
+
+    missing = await _get_missing_instances(
+        fake_orthanc_raw, study, resource=STUDY_RESOURCE, study_query=RemoteQuery("study-query")
+    )
+
+    assert missing == [
+        {"StudyInstanceUID": STUDY_UID, "SeriesInstanceUID": "1.2", "SOPInstanceUID": "1.2.2"}
+    ]
+    assert ("POST", "/queries/series-query/answers/0/query-instances") not in fake_orthanc.requests
+
+
+@pytest.mark.asyncio()
+async def test_selective_retrieval_moves_wanted_series_only(
+    fake_orthanc, fake_orthanc_raw, study, monkeypatch
+) -> None:
+    """
+    Given a study in the archive with a wanted series, a localiser and a series of another modality
+    When retrieving only the series wanted by the project
+    Then only the wanted series is moved
+    """
+    monkeypatch.setenv("PROJECT_CONFIGS_DIR", str(PROJECT_CONFIGS_DIR))
+    fake_orthanc.responses[("GET", "/queries/study-query/answers")] = ["0"]
+    fake_orthanc.responses[("POST", "/queries/study-query/answers/0/query-series")] = {
+        "ID": "series-query"
+    }
+    _add_remote_answers(
+        fake_orthanc,
+        "series-query",
+        [
+            {"StudyInstanceUID": STUDY_UID, "SeriesInstanceUID": uid, **tags}
+            for uid, tags in (
+                ("1.1", {"Modality": "DX", "SeriesDescription": "AP"}),
+                ("1.2", {"Modality": "DX", "SeriesDescription": "Localiser"}),
+                ("1.3", {"Modality": "SR", "SeriesDescription": "Report"}),
+            )
+        ],
+    )
+    moves = []
+
+    async def move(request) -> dict:
+        moves.append(await request.json())
+        return {"ID": "move-job"}
+
+    fake_orthanc.responses[("POST", "/modalities/PRIMARY/move")] = move
+    fake_orthanc.responses[("GET", "/jobs?expand")] = [{"ID": "move-job", "State": "Success"}]
+
+    await _retrieve_selected_series(
+        fake_orthanc_raw,
+        study,
+        study_query=RemoteQuery("study-query"),
+        modality="PRIMARY",
+        series_filter=_project_series_filter(load_project_config("test-extract-uclh-omop-cdm")),
+    )
+
+    assert len(moves) == 1
+    assert moves[0]["Level"] == "Series"
+    assert moves[0]["Resources"] == [{"StudyInstanceUID": STUDY_UID, "SeriesInstanceUID": "1.1"}]
+
+
+@pytest.fixture()
+def large_study_moves(fake_orthanc, monkeypatch) -> list[dict]:
+    """Archive with a large study of three series, returning the C-MOVEs requested from it."""
+    monkeypatch.setenv("PIXL_SERIES_PARALLEL_MIN_INSTANCES", "3")
+    monkeypatch.setenv("PIXL_SERIES_PARALLEL_MOVES", "2")
+    fake_orthanc.responses[("GET", "/queries/study-query/answers")] = ["0"]
+    fake_orthanc.responses[("POST", "/queries/study-query/answers/0/query-series")] = {
+        "ID": "series-query"
+    }
+    _add_remote_answers(
+        fake_orthanc,
+        "series-query",
+        [
+            {
+                "StudyInstanceUID": STUDY_UID,
+                "SeriesInstanceUID": f"1.{i}",
+                "NumberOfSeriesRelatedInstances": "2",
+            }
+            for i in range(1, 4)
+        ],
+    )
+    moves = []
+
+    async def move(request) -> dict:
+        moves.append(await request.json())
+        return {"ID": f"move-{moves[-1]['Resources'][0]['SeriesInstanceUID']}"}
+
+    fake_orthanc.responses[("POST", "/modalities/PRIMARY/move")] = move
+    return moves
+
+
+@pytest.mark.asyncio()
+async def test_large_study_retrieved_by_series(
+    fake_orthanc, fake_orthanc_raw, study, large_study_moves
+) -> None:
+    """
+    Given a study in the archive above the size for series-parallel retrieval
+    When retrieving the study
+    Then each series is moved with its own C-MOVE
+    """
+    fake_orthanc.responses[("GET", "/jobs?expand")] = [
+        {"ID": f"move-1.{i}", "State": "Success"} for i in range(1, 4)
+    ]
+
+    await _retrieve_study(fake_orthanc_raw, study, RemoteQuery("study-query"), "PRIMARY")
+
+    assert [move["Resources"] for move in large_study_moves] == [
+        [{"StudyInstanceUID": STUDY_UID, "SeriesInstanceUID": f"1.{i}"}] for i in range(1, 4)
+    ]
+    assert ("POST", "/queries/study-query/retrieve") not in fake_orthanc.requests
+
+
+@pytest.mark.asyncio()
+async def test_large_study_fails_if_any_series_fails(
+    fake_orthanc, fake_orthanc_raw, study, large_study_moves
+) -> None:
+    """
+    Given a large study where moving one series fails
+    When retrieving the study series by series
+    Then all series are still attempted, and the retrieval fails
+    """
+    fake_orthanc.responses[("GET", "/jobs?expand")] = [
+        {"ID": "move-1.1", "State": "Success"},
+        {"ID": "move-1.2", "State": "Failure", "ErrorCode": 9, "ErrorDescription": "C-MOVE"},
+        {"ID": "move-1.3", "State": "Success"},
+    ]
+
+    with pytest.raises(PixlDiscardError, match="Job failed"):
+        await _retrieve_study(fake_orthanc_raw, study, RemoteQuery("study-query"), "PRIMARY")
+
+    assert len(large_study_moves) == 3
+
+
+@pytest.mark.asyncio()
+async def test_missing_instances_moved_in_chunks(
+    fake_orthanc, fake_orthanc_raw, study, monkeypatch
+) -> None:
+    """
+    Given a study in orthanc raw missing three instances of a series, and a whole series
+    When retrieving missing instances in chunks of two, and moving one chunk fails
+    Then the whole series is moved at series level, the instances in two chunks, and an error
+      is raised after all moves have been attempted
+    """
+    monkeypatch.setenv("PIXL_MISSING_INSTANCES_CHUNK_SIZE", "2")
+    fake_orthanc.responses[("GET", "/studies/study-1/series")] = LOCAL_SERIES
+    fake_orthanc.responses[("GET", "/studies/study-1/instances")] = [
+        _local_instance(instance_id) for instance_id in LOCAL_INSTANCES
+    ]
+    fake_orthanc.responses[("GET", "/queries/study-query/answers")] = ["0"]
+    fake_orthanc.responses[("POST", "/queries/study-query/answers/0/query-series")] = {
+        "ID": "series-query"
+    }
+    _add_remote_answers(
+        fake_orthanc,
+        "series-query",
+        [
+            {"StudyInstanceUID": STUDY_UID, "SeriesInstanceUID": uid, **count}
+            for uid, count in (
+                ("1.1", {"NumberOfSeriesRelatedInstances": "5"}),
+                ("1.2", {"NumberOfSeriesRelatedInstances": "1"}),
+                ("1.3", {"NumberOfSeriesRelatedInstances": "4"}),
+            )
+        ],
+    )
+    fake_orthanc.responses[("POST", "/queries/series-query/answers/0/query-instances")] = {
+        "ID": "instances-query"
+    }
+    _add_remote_answers(
+        fake_orthanc,
+        "instances-query",
+        [
+            {"StudyInstanceUID": STUDY_UID, "SeriesInstanceUID": "1.1", "SOPInstanceUID": uid}
+            for uid in ("1.1.1", "1.1.2", "1.1.3", "1.1.4", "1.1.5")
+        ],
+    )
+    moves = []
+
+    async def move(request) -> dict:
+        moves.append(await request.json())
+        return {"ID": f"move-{len(moves)}"}
+
+    fake_orthanc.responses[("POST", "/modalities/PRIMARY/move")] = move
+    fake_orthanc.responses[("GET", "/jobs?expand")] = [
+        {"ID": "move-1", "State": "Success"},
+        {"ID": "move-2", "State": "Failure", "ErrorCode": 9, "ErrorDescription": "C-MOVE"},
+        {"ID": "move-3", "State": "Success"},
+    ]
+
+    with pytest.raises(PixlDiscardError, match="Job failed"):
+        await _retrieve_missing_instances(
+            STUDY_RESOURCE, fake_orthanc_raw, study, RemoteQuery("study-query"), "PRIMARY"
+        )
+
+    moved = sorted(
+        (move["Level"], [item.get("SOPInstanceUID") for item in move["Resources"]])
+        for move in moves
+    )
+    assert moved == [
+        ("Instance", ["1.1.3", "1.1.4"]),
+        ("Instance", ["1.1.5"]),
+        ("Series", [None]),
+    ]
+    assert ("POST", "/queries/series-query/answers/2/query-instances") not in fake_orthanc.requests
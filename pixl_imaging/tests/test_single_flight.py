@@ -0,0 +1,191 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests for coordinating concurrent messages for the same study."""
+
+from __future__ import annotations
+
+import asyncio
+import datetime
+
+import pytest
+from core.dicom_tags import DICOM_TAG_PROJECT_NAME
+from core.exceptions import PixlDiscardError
+from core.patient_queue.message import Message
+from pixl_imaging._processing import DicomModality, ImagingStudy, _process_message
+from pixl_imaging._single_flight import KeyedLock, SingleFlight
+
+
+@pytest.mark.asyncio()
+async def test_concurrent_runs_are_shared() -> None:
+    """
+    Given a single flight
+    When it is run concurrently for the same study by several messages
+    Then the study is only retrieved once, and a later run retrieves it again
+    """
+    single_flight: SingleFlight[int] = SingleFlight()
+    retrievals = []
+
+    async def retrieve() -> int:
+        retrievals.append("study")
+        await asyncio.sleep(0.01)
+        return len(retrievals)
+
+    results = await asyncio.gather(*(single_flight.run("study", retrieve) for _ in range(3)))
+    assert results == [1, 1, 1]
+    assert single_flight.in_flight == 0
+
+    assert await single_flight.run("study", retrieve) == 2
+
+
+@pytest.mark.asyncio()
+async def test_shared_run_failure_raised_for_all() -> None:
+    """
+    Given a single flight
+    When a shared run fails
+    Then every message waiting for it gets the error
+    """
+    single_flight: SingleFlight[None] = SingleFlight()
+
+    async def retrieve() -> None:
+        await asyncio.sleep(0.01)
+        msg = "Study not found"
+        raise PixlDiscardError(msg)
+
+    results = await asyncio.gather(
+        single_flight.run("study", retrieve),
+        single_flight.run("study", retrieve),
+        return_exceptions=True,
+    )
+    assert all(isinstance(result, PixlDiscardError) for result in results)
+
+
+@pytest.mark.asyncio()
+async def test_cancelled_caller_does_not_cancel_shared_run() -> None:
+    """
+    Given two messages sharing a run
+    When the first message is cancelled
+    Then the second still gets the result
+    """
+    single_flight: SingleFlight[str] = SingleFlight()
+
+    async def retrieve() -> str:
+        await asyncio.sleep(0.05)
+        return "retrieved"
+
+    first = asyncio.create_task(single_flight.run("study", retrieve))
+    second = asyncio.create_task(single_flight.run("study", retrieve))
+    await asyncio.sleep(0)
+    first.cancel()
+
+    assert await second == "retrieved"
+
+
+@pytest.mark.asyncio()
+async def test_keyed_lock_serialises_same_study_only() -> None:
+    """
+    Given a lock per study
+    When two messages for one study and one for another hold the lock
+    Then only the messages for the same study run one after the other
+    """
+    locks = KeyedLock()
+    events = []
+
+    async def hold(key: str, name: str) -> None:
+        async with locks.hold(key):
+            events.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            events.append(f"{name} end")
+
+    await asyncio.gather(hold("study-1", "a"), hold("study-1", "b"), hold("study-2", "c"))
+
+    assert events.index("a end") < events.index("b start")
+    assert events.index("c start") < events.index("a end")
+
+
+def _study_for_project(project_name: str) -> ImagingStudy:
+    return ImagingStudy.from_message(
+        Message(
+            mrn="mrn",
+            accession_number="accession",
+            study_uid="1",
+            study_date=datetime.date.fromisoformat("2024-01-01"),
+            procedure_occurrence_id=1,
+            project_name=project_name,
+            extract_generated_timestamp=datetime.datetime.now(tz=datetime.timezone.utc),
+        )
+    )
+
+
+@pytest.mark.asyncio()
+async def test_concurrent_messages_for_study_share_retrieval(
+    fake_orthanc, fake_orthanc_raw, monkeypatch
+) -> None:
+    """
+    Given messages for the same study from two projects
+    When they are processed concurrently
+    Then the study is found and moved once, and each message tags and sends it for its project
+    """
+    monkeypatch.setenv("ORTHANC_AUTOROUTE_RAW_TO_ANON", "true")
+    orthanc = {"retrieved": False, "project": None}
+    jobs: list[str] = []
+    sent_projects = []
+
+    def start_job(name: str) -> dict:
+        jobs.append(f"{name}-{len(jobs)}")
+        return {"ID": jobs[-1]}
+
+    async def find_local(_request) -> list[dict]:
+        if not orthanc["retrieved"]:
+            return []
+        tags = {DICOM_TAG_PROJECT_NAME.tag_nickname: orthanc["project"]}
+        return [{"ID": "study-1", "LastUpdate": "20240101T120000", "RequestedTags": tags}]
+
+    async def retrieve(_request) -> dict:
+        await asyncio.sleep(0.05)
+        orthanc["retrieved"] = True
+        return start_job("move")
+
+    async def modify(request) -> dict:
+        orthanc["project"] = (await request.json())["Replace"][DICOM_TAG_PROJECT_NAME.tag_nickname]
+        return start_job("modify")
+
+    async def store(_request) -> dict:
+        sent_projects.append(orthanc["project"])
+        return start_job("store")
+
+    async def job_states(_request) -> list[dict]:
+        return [{"ID": job_id, "State": "Success"} for job_id in jobs]
+
+    fake_orthanc.responses.update(
+        {
+            ("POST", "/tools/find"): find_local,
+            ("POST", f"/modalities/{DicomModality.primary.value}/query"): {"ID": "study-query"},
+            ("GET", "/queries/study-query/answers"): ["0"],
+            ("POST", "/queries/study-query/retrieve"): retrieve,
+            ("POST", "/studies/study-1/modify"): modify,
+            ("POST", "/modalities/PIXL-Anon/store"): store,
+            ("GET", "/jobs?expand"): job_states,
+        }
+    )
+
+    await asyncio.gather(
+        _process_message(_study_for_project("project-a"), fake_orthanc_raw, DicomModality.primary),
+        _process_message(_study_for_project("project-b"), fake_orthanc_raw, DicomModality.primary),
+    )
+
+    requests = fake_orthanc.requests
+    assert requests.count(("POST", f"/modalities/{DicomModality.primary.value}/query")) == 1
+    assert requests.count(("POST", "/queries/study-query/retrieve")) == 1
+    assert requests.count(("POST", "/studies/study-1/modify")) == 2
+    assert sorted(sent_projects) == ["project-a", "project-b"]
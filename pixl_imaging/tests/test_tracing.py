@@ -0,0 +1,105 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tests for tracing the stages of processing a study."""
+
+from __future__ import annotations
+
+import asyncio
+import json
+from typing import TYPE_CHECKING
+
+import pytest
+from pixl_imaging._tracing import add_trace_sink, remove_trace_sink, span, trace_study
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from pathlib import Path
+
+
+@pytest.fixture()
+def trace_file(tmp_path) -> Iterator[Path]:
+    """Trace sink writing to a temporary file."""
+    path = tmp_path / "traces.jsonl"
+    add_trace_sink(path, rotation="1 MB", retention=1)
+    yield path
+    remove_trace_sink()
+
+
+async def _process(*, fail: bool) -> None:
+    with span("archive_find"):
+        await asyncio.sleep(0.01)
+    # Spans in tasks started while processing belong to the same trace
+    await asyncio.create_task(_c_move())
+    if fail:
+        msg = "failed"
+        raise RuntimeError(msg)
+
+
+async def _c_move() -> None:
+    with span("c_move"):
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio()
+async def test_trace_written_for_each_message(trace_file) -> None:
+    """
+    Given a trace sink
+    When two messages are traced, one of which fails
+    Then a line is written for each, with its spans and outcome
+    """
+    with trace_study("message 1", "1.2.3", "primary"):
+        await _process(fail=False)
+    with pytest.raises(RuntimeError), trace_study("message 2", "1.2.4", "primary"):
+        await _process(fail=True)
+    remove_trace_sink()
+
+    first, second = (json.loads(line) for line in trace_file.read_text().splitlines())
+    assert first["identifier"] == "message 1"
+    assert first["outcome"] == "success"
+    assert [trace_span["name"] for trace_span in first["spans"]] == ["archive_find", "c_move"]
+    assert first["spans"][1]["start"] >= first["spans"][0]["seconds"]
+    assert first["seconds"] >= sum(trace_span["seconds"] for trace_span in first["spans"])
+    assert second["outcome"] == "RuntimeError"
+
+
+@pytest.mark.asyncio()
+async def test_cancelled_message_is_not_a_success(trace_file) -> None:
+    """
+    Given a trace sink
+    When processing a message is cancelled, e.g. on shutdown
+    Then its trace records the cancellation as its outcome
+    """
+
+    async def process() -> None:
+        with trace_study("message", "1.2.3", "primary"):
+            await asyncio.sleep(10)
+
+    task = asyncio.create_task(process())
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    remove_trace_sink()
+
+    trace = json.loads(trace_file.read_text())
+    assert trace["outcome"] == "CancelledError"
+
+
+@pytest.mark.asyncio()
+async def test_no_trace_without_sink(tmp_path) -> None:
+    """Without a trace sink, spans are ignored."""
+    with trace_study("message", "1.2.3", "primary"), span("archive_find"):
+        await asyncio.sleep(0)
+
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,66 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Compare serialising messages in the compact format with the legacy jsonpickle format."""
+
+from __future__ import annotations
+
+import argparse
+import datetime
+import timeit
+
+import jsonpickle
+from core.patient_queue.message import Message, deserialise
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=100_000, help="Number of messages")
+    return parser.parse_args()
+
+
+def report(name: str, number: int, seconds: float) -> None:
+    print(f"{name:<20} {number / seconds:>12,.0f} messages/s")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    message = Message(
+        mrn="12345678",
+        accession_number="ABC12345678",
+        study_uid="1.2.826.0.1.3680043.8.498.12345678901234567890",
+        study_date=datetime.date(2024, 1, 1),
+        procedure_occurrence_id=123456,
+        project_name="benchmark-project",
+        extract_generated_timestamp=datetime.datetime.now(tz=datetime.timezone.utc),
+    )
+    compact = message.serialise()
+    legacy = jsonpickle.encode(message).encode()
+    print(f"Message size: compact {len(compact)} bytes, legacy {len(legacy)} bytes")
+
+    report("compact serialise", args.number, timeit.timeit(message.serialise, number=args.number))
+    report(
+        "legacy serialise",
+        args.number,
+        timeit.timeit(lambda: jsonpickle.encode(message).encode(), number=args.number),
+    )
+    report(
+        "compact deserialise",
+        args.number,
+        timeit.timeit(lambda: deserialise(compact), number=args.number),
+    )
+    report(
+        "legacy deserialise",
+        args.number,
+        timeit.timeit(lambda: deserialise(legacy), number=args.number),
+    )
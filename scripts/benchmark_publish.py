@@ -0,0 +1,93 @@
+#  Copyright (c) University College London Hospitals NHS Foundation Trust
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""
+Benchmark publishing a cohort of messages to RabbitMQ.
+
+Connects using the RABBITMQ_* environment variables, and purges the benchmark queue before and
+after each run.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import datetime
+from time import monotonic
+from typing import TYPE_CHECKING
+
+from core.patient_queue.message import Message
+from core.patient_queue.producer import PixlBulkProducer, PixlProducer
+
+if TYPE_CHECKING:
+    from collections.abc import Iterator
+
+
+def generate_messages(number: int) -> Iterator[Message]:
+    timestamp = datetime.datetime.now(tz=datetime.timezone.utc)
+    for i in range(number):
+        yield Message(
+            mrn=f"mrn-{i}",
+            accession_number=f"acc-{i}",
+            study_uid=f"1.2.826.0.1.{i}",
+            study_date=datetime.date(2024, 1, 1),
+            procedure_occurrence_id=i,
+            project_name="benchmark",
+            extract_generated_timestamp=timestamp,
+        )
+
+
+def clear_queue(queue: str) -> None:
+    with PixlProducer(queue_name=queue) as producer:
+        producer.clear_queue()
+
+
+def benchmark_producer(queue: str, number: int) -> float:
+    start = monotonic()
+    with PixlProducer(queue_name=queue) as producer:
+        producer.publish(list(generate_messages(number)), priority=1)
+    return number / (monotonic() - start)
+
+
+async def benchmark_bulk_producer(queue: str, number: int, window: int) -> float:
+    async with PixlBulkProducer(queue, window=window) as producer:
+        stats = await producer.publish(generate_messages(number), priority=1)
+    if stats.failed:
+        print(f"{stats.failed} messages were not confirmed")
+    return stats.rate
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=100_000, help="Number of messages")
+    parser.add_argument("--window", type=int, default=1000, help="Unconfirmed publishes allowed")
+    parser.add_argument("--queue", default="benchmark-publish", help="Queue to publish to")
+    parser.add_argument(
+        "--compare", action="store_true", help="Also benchmark publishing without confirms"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(f"Publishing {args.number} messages to {args.queue}")
+
+    clear_queue(args.queue)
+    rate = asyncio.run(benchmark_bulk_producer(args.queue, args.number, args.window))
+    print(f"Bulk producer, window {args.window}: {rate:.0f} messages/s")
+    clear_queue(args.queue)
+
+    if args.compare:
+        rate = benchmark_producer(args.queue, args.number)
+        print(f"Producer without confirms: {rate:.0f} messages/s")
+        clear_queue(args.queue)